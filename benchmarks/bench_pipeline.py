@@ -0,0 +1,163 @@
+"""Throughput and latency benchmark of Utility_Bill_Processor against a local ADE stand-in.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.bench_pipeline --files 200 --workers 8 --latency 0.05 --json bench.json
+
+Every workload gets a fresh corpus of synthetic bills and a fresh cache directory, and ADE responses
+are replayed from output/, so results only depend on the code under test and the given options.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from src.iraklis7_ubp.utility_proc import Utility_Bill_Processor
+from benchmarks.fake_ade import Fake_ADE_Client
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+def make_corpus(directory, count, file_size, prefix="bill"):
+    # Synthetic bills: unique content per file, so every file has its own cache entry
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, prefix + "_" + format(i, "06d") + ".pdf")
+        with open(path, "wb") as f:
+            f.write(b"%PDF-1.4\n" + os.urandom(max(0, file_size - 9)))
+        paths.append(path)
+    return paths
+
+
+def run_workload(name, paths, cache_dir, args):
+    client = Fake_ADE_Client(args.replay_dir, latency=args.latency, jitter=args.jitter,
+                             error_rate=args.error_rate, seed=args.seed)
+    processor = Utility_Bill_Processor(output_dir=cache_dir, use_cache=True, ade_client=client)
+    latencies = []
+    errors = 0
+
+    def timed(path):
+        start = time.perf_counter()
+        result = processor.process(path)
+        return time.perf_counter() - start, result
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for latency, result in executor.map(timed, paths):
+            latencies.append(latency)
+            if not result.ok():
+                errors += 1
+    elapsed = time.perf_counter() - start
+    processor.close()
+
+    files = len(paths)
+    return dict(
+        workload=name,
+        files=files,
+        errors=errors,
+        elapsed_s=elapsed,
+        files_per_s=files / elapsed if elapsed else None,
+        latency_s=dict(
+            mean=statistics.mean(latencies) if latencies else None,
+            p50=percentile(latencies, 50),
+            p95=percentile(latencies, 95),
+            p99=percentile(latencies, 99),
+            max=max(latencies) if latencies else None,
+        ),
+        ade_calls=dict(parse=client.parse_calls, extract=client.extract_calls, errors=client.errors),
+        # Share of bills that didn't need an ADE call for the stage, retries of a call count once
+        cache_hit_rate=dict(
+            parse=round(1.0 - len(client.parsed) / files, 4) if files else None,
+            extract=round(1.0 - len(client.extracted) / files, 4) if files else None,
+        ),
+        peak_rss_bytes=peak_rss_bytes(),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Utility_Bill_Processor pipeline benchmark")
+    parser.add_argument("--files", type=int, default=100, help="Bills per workload (default: 100)")
+    parser.add_argument("--file-size", type=int, default=256 * 1024, help="Synthetic bill size in bytes")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent workers (default: 4)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated ADE latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="Simulated ADE latency jitter in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of failing ADE calls")
+    parser.add_argument("--mixed-new", type=float, default=0.2, help="Fraction of new bills in the mixed workload")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replay-dir", default="output", help="Recorded ADE responses (default: output)")
+    parser.add_argument("--json", default=None, help="Write results to this file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix="ubp_bench_")
+    try:
+        cache_dir = os.path.join(work_dir, "cache")
+        paths = make_corpus(os.path.join(work_dir, "bills"), args.files, args.file_size)
+        new_count = int(args.files * args.mixed_new)
+        new_paths = make_corpus(os.path.join(work_dir, "bills"), new_count, args.file_size, prefix="new")
+
+        results = [
+            # Empty cache: every bill costs a parse and an extract call
+            run_workload("cold", paths, cache_dir, args),
+            # Same bills again: everything is served from the cache
+            run_workload("warm", paths, cache_dir, args),
+            # Mostly cached bills, with a fraction of new ones
+            run_workload("mixed", new_paths + paths[new_count:], cache_dir, args),
+        ]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = dict(
+        benchmark="pipeline",
+        commit=git_commit(),
+        timestamp=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        config=vars(args),
+        results=results,
+    )
+    output = json.dumps(report, indent=2)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
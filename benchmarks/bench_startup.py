@@ -0,0 +1,118 @@
+"""Start-up benchmark: import time of the processor, construction time, and time to a first cache hit.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.bench_startup --runs 20 --max-import-ms 150 --max-construct-ms 20 --json startup.json
+
+Every measurement runs in a fresh interpreter, as short-lived workers do, and the median of --runs runs is
+reported. With --max-import-ms / --max-construct-ms the benchmark exits with status 1 when a median exceeds
+the budget, so it can guard CI against start-up regressions.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from benchmarks.bench_pipeline import git_commit
+
+# Modules that only the network path (or extraction schemas) should need
+HEAVY_MODULES = ("landingai_ade", "httpx", "pydantic")
+
+_CHILD = """
+import sys, time, json
+start = time.perf_counter()
+from src.iraklis7_ubp.utility_proc import Utility_Bill_Processor
+imported = time.perf_counter()
+processor = Utility_Bill_Processor(output_dir=sys.argv[1], offline=True)
+constructed = time.perf_counter()
+markdown = processor.parse(sys.argv[2]).markdown
+hit = time.perf_counter()
+processor.close()
+print(json.dumps(dict(import_ms=(imported - start) * 1000, construct_ms=(constructed - imported) * 1000,
+                      first_hit_ms=(hit - constructed) * 1000,
+                      heavy_modules=[name for name in sys.argv[3].split(",") if name in sys.modules])))
+"""
+
+
+def run_child(cache_dir, bill_path):
+    # Offline: no API key is needed, and no ADE client is created
+    output = subprocess.check_output([sys.executable, "-c", _CHILD, cache_dir, bill_path, ",".join(HEAVY_MODULES)],
+                                     stderr=subprocess.DEVNULL, text=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def prepare_cache(cache_dir, bill_path, replay_path):
+    # A cache holding the parse response of one bill, for the offline first-hit measurement
+    from landingai_ade.types.parse_response import ParseResponse
+    from src.iraklis7_ubp.utility_cache import Utility_Bill_Cache
+    with open(replay_path, encoding="utf-8") as f:
+        response = ParseResponse(**json.load(f))
+    cache = Utility_Bill_Cache(cache_dir)
+    cache.put_parse(cache.get_file_digest(bill_path), response)
+    cache.close()
+
+
+def summarize(values):
+    return dict(p50=statistics.median(values), min=min(values), max=max(values))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Utility_Bill_Processor start-up benchmark")
+    parser.add_argument("--runs", type=int, default=10, help="Fresh interpreters to measure (default: 10)")
+    parser.add_argument("--bill", default="tests/invoices/GasInvoice_2025-12-04.pdf", help="Bill to look up")
+    parser.add_argument("--replay", default="output/GasInvoice_2025-12-04.pdf.parse.json",
+                        help="Recorded parse response of --bill")
+    parser.add_argument("--max-import-ms", type=float, default=None, help="Fail when the median import exceeds this")
+    parser.add_argument("--max-construct-ms", type=float, default=None,
+                        help="Fail when the median construction exceeds this")
+    parser.add_argument("--json", default=None, help="Write results to this file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix="ubp_startup_")
+    try:
+        cache_dir = os.path.join(work_dir, "cache")
+        bill_path = os.path.join(work_dir, os.path.basename(args.bill))
+        shutil.copy(args.bill, bill_path)
+        prepare_cache(cache_dir, bill_path, args.replay)
+        runs = [run_child(cache_dir, bill_path) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = dict(
+        import_ms=summarize([run["import_ms"] for run in runs]),
+        construct_ms=summarize([run["construct_ms"] for run in runs]),
+        first_hit_ms=summarize([run["first_hit_ms"] for run in runs]),
+        heavy_modules=runs[-1]["heavy_modules"],
+    )
+    failures = []
+    if args.max_import_ms is not None and results["import_ms"]["p50"] > args.max_import_ms:
+        failures.append("import")
+    if args.max_construct_ms is not None and results["construct_ms"]["p50"] > args.max_construct_ms:
+        failures.append("construct")
+
+    report = dict(
+        benchmark="startup",
+        commit=git_commit(),
+        timestamp=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        config=vars(args),
+        results=results,
+        over_budget=failures,
+    )
+    output = json.dumps(report, indent=2)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
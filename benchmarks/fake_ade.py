@@ -0,0 +1,72 @@
+import os
+import json
+import glob
+import time
+import zlib
+import random
+import threading
+import httpx
+from landingai_ade import APIConnectionError
+from landingai_ade.types.parse_response import ParseResponse
+from landingai_ade.types.extract_response import ExtractResponse
+
+DOCUMENT_MARKER = "\n<!-- fake-ade document: "
+
+
+class Fake_ADE_Client(object):
+    # Stand-in for LandingAIADE, replaying recorded <filename>.parse.json / .extract.json responses
+    # (e.g. the ones in output/) with configurable latency, jitter and error rate.
+    # Documents are mapped to a recorded response by a stable hash of their file name, and a per-document
+    # marker is appended to the markdown, so that every document also gets its own extract cache entry.
+    def __init__(self, replay_dir="output", latency=0.05, jitter=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.parse_calls = 0
+        self.extract_calls = 0
+        # Names of the documents sent to each endpoint: unlike the call counts, these don't grow with retries
+        self.parsed = set()
+        self.extracted = set()
+        self.errors = 0
+        self.__parses = []
+        self.__extracts = {}
+        for parse_file in sorted(glob.glob(os.path.join(replay_dir, "*.parse.json"))):
+            with open(parse_file, 'r', encoding='utf-8') as f:
+                parse_json = json.load(f)
+            self.__parses.append(parse_json)
+            extract_file = parse_file[:-len(".parse.json")] + ".extract.json"
+            if os.path.exists(extract_file):
+                with open(extract_file, 'r', encoding='utf-8') as f:
+                    self.__extracts[parse_json['markdown']] = json.load(f)
+        if not self.__parses:
+            raise ValueError("No recorded parse responses found in " + str(replay_dir))
+
+    def __simulate(self, endpoint):
+        with self.__lock:
+            delay = max(0.0, self.latency + self.__random.uniform(-self.jitter, self.jitter))
+            fail = self.__random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        time.sleep(delay)
+        if fail:
+            raise APIConnectionError(request=httpx.Request("POST", "https://fake-ade.local/v1/ade/" + endpoint))
+
+    def parse(self, document=None, model=None, **kwargs):
+        name = os.path.basename(str(document))
+        with self.__lock:
+            self.parse_calls += 1
+            self.parsed.add(name)
+        self.__simulate("parse")
+        parse_json = dict(self.__parses[zlib.crc32(name.encode("utf-8")) % len(self.__parses)])
+        parse_json['markdown'] = parse_json['markdown'] + DOCUMENT_MARKER + name + " -->"
+        return ParseResponse(**parse_json)
+
+    def extract(self, schema=None, markdown=None, model=None, **kwargs):
+        recorded, _, name = markdown.rpartition(DOCUMENT_MARKER)
+        with self.__lock:
+            self.extract_calls += 1
+            self.extracted.add(name)
+        self.__simulate("extract")
+        return ExtractResponse(**self.__extracts[recorded])
@@ -1 +1,33 @@
-__all__ = ['Utility_Bill_Processor']
\ No newline at end of file
+import importlib
+
+# Public names and their modules. They are imported on first access, so that importing the package
+# (e.g. for a single submodule) doesn't pull in the whole processing stack.
+_exports = {
+    'Utility_Bill_Processor': 'utility_proc',
+    'Utility_Bill_Result': 'utility_proc',
+    'Offline_Error': 'utility_proc',
+    'Async_Utility_Bill_Processor': 'utility_async',
+    'Utility_Bill_Cache': 'utility_cache',
+    'Cache_Policy': 'utility_cache',
+    'Redis_Store': 'utility_store',
+    'Utility_Bill_Batch': 'utility_batch',
+    'Utility_Bill_Watcher': 'utility_watch',
+    'Utility_Bill_Metrics': 'utility_metrics',
+    'Page_Splitter': 'utility_pages',
+    'Utility_Bill_Regression': 'utility_regression',
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    module = _exports.get(name)
+    if module is None:
+        raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+    value = getattr(importlib.import_module("." + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,4 @@
+import sys
+from .utility_cli import main
+
+sys.exit(main())
@@ -0,0 +1,318 @@
+import os
+import asyncio
+from typing import TYPE_CHECKING
+from pathlib import Path
+from .utility_cache import (Utility_Bill_Cache, DEFAULT_PARSE_MODEL, DEFAULT_EXTRACT_MODEL, STAGE_PARSE,
+                            STAGE_EXTRACT, digest_text, digest_schema)
+from .utility_flight import Async_Single_Flight, File_Lock_Pool
+from .utility_metrics import NULL_METRICS
+from .utility_proc import Utility_Bill_Result, Offline_Error, expand_paths
+from .utility_logging import get_logger, log_payload
+from .utility_transport import Async_ADE_Transport
+from .utility_pages import merge_page_responses
+
+# Imported on first use, as in utility_proc
+if TYPE_CHECKING:
+    from landingai_ade.types.parse_response import ParseResponse
+    from landingai_ade.types.extract_response import ExtractResponse
+
+# Seconds between attempts to take a cross-process lock held elsewhere, doubling up to the maximum
+LOCK_POLL_MIN_INTERVAL = 0.005
+LOCK_POLL_MAX_INTERVAL = 0.1
+
+
+class Async_Utility_Bill_Processor(object):
+    # asyncio counterpart of Utility_Bill_Processor.
+    # ADE calls go through an async client (AsyncLandingAIADE by default, or any object exposing
+    # awaitable parse() / extract() passed as ade_client), and at most max_in_flight calls are
+    # outstanding at any time. Hashing and cache file I/O run in worker threads.
+    def __init__(self, env="eu", output_dir="./output", use_cache=False, max_in_flight=4, ade_client=None,
+                 parse_model=DEFAULT_PARSE_MODEL, extract_model=DEFAULT_EXTRACT_MODEL, strict_cache=False,
+                 local_extraction=False, metrics=None, log_payloads=None, sink=None,
+                 retry_policy=None, rate_limiter=None, circuit_breaker=None, lock_dir=None, cache_policy=None,
+                 page_splitter=None, offline=False, cache_store=None):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1, got " + str(max_in_flight))
+        self.__output_dir = output_dir
+        # Offline processors only use the cache, and never create an ADE client
+        self.__offline = offline
+        self.__use_cache = use_cache or offline
+        self.__parse_model = parse_model
+        self.__extract_model = extract_model
+        self.__max_in_flight = max_in_flight
+        # Created on first use, so that it binds to the running event loop
+        self.__semaphore = None
+
+        # Logging is left to the application (see configure_logging). Full response dumps are logged if
+        # log_payloads is set, or, when it's None, if they are enabled for the process.
+        self.__logger = get_logger()
+        self.__log_payloads = log_payloads
+
+        # Per-stage timers and counters, a no-op unless a Utility_Bill_Metrics is given
+        self.__metrics = metrics if metrics is not None else NULL_METRICS
+
+        # Create output directory if it doesn't exist. cache_policy (a Cache_Policy) bounds the cache's size and age.
+        # cache_store (a utility_store.Cache_Store) shares cached responses with processors on other hosts.
+        self.__cache = Utility_Bill_Cache(self.__output_dir, self.__logger, strict=strict_cache,
+                                          metrics=self.__metrics, policy=cache_policy,
+                                          store=cache_store, log_payloads=log_payloads)
+
+        # Optional rule based extraction for known issuers, falling back to the ADE extract API
+        self.__local_extractor = None
+        if local_extraction:
+            from .utility_rules import Local_Extractor
+            self.__local_extractor = Local_Extractor(self.__logger)
+
+        # Concurrent requests for the same content share one ADE call, across processes too with lock_dir
+        self.__flights = Async_Single_Flight()
+        self.__file_locks = File_Lock_Pool(lock_dir) if lock_dir is not None else None
+
+        # Optional Utility_Bill_Sink, receiving a record for every successfully processed bill
+        self.__sink = sink
+
+        # Optional Page_Splitter, to parse multi-page documents page by page as Utility_Bill_Processor does
+        self.__page_splitter = page_splitter
+
+        # The ADE client is created on the first API call, unless one is given.
+        # Retries with backoff, optional rate limiting and circuit breaker, as in Utility_Bill_Processor
+        self.__env = env
+        self.__given_ade_client = ade_client
+        self.__transport_args = dict(retry_policy=retry_policy, rate_limiter=rate_limiter,
+                                     circuit_breaker=circuit_breaker, metrics=self.__metrics)
+        self.__ade_client = None
+
+    def __get_ade_client(self):
+        # Only called from the event loop, which makes the check and creation atomic
+        if self.__ade_client is None:
+            ade_client = self.__given_ade_client
+            if ade_client is None:
+                from landingai_ade import AsyncLandingAIADE
+                ade_client = AsyncLandingAIADE(
+                    apikey=os.environ.get("VISION_AGENT_API_KEY"),
+                    environment=self.__env,
+                    max_retries=0
+                )
+            self.__ade_client = Async_ADE_Transport(ade_client, **self.__transport_args)
+        return self.__ade_client
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        self.__cache.close()
+        if self.__sink is not None:
+            await asyncio.to_thread(self.__sink.flush)
+        if self.__ade_client is not None:
+            await self.__ade_client.close()
+
+    def get_metrics(self):
+        return self.__metrics
+
+    def get_local_extraction_stats(self):
+        # Hits / fallbacks of the local extraction engine, None when it is disabled
+        if self.__local_extractor is None:
+            return None
+        return self.__local_extractor.get_stats()
+
+    def __get_semaphore(self):
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.__max_in_flight)
+        return self.__semaphore
+
+    async def parse(self, input_path) -> "ParseResponse":
+        with self.__metrics.timer("parse"):
+            file_digest = await asyncio.to_thread(self.__cache.get_file_digest, input_path)
+            return await self.__parse(input_path, file_digest)
+
+    async def __parse(self, input_path, file_digest):
+        response = None
+        if(self.__use_cache):
+            response = await asyncio.to_thread(self.__cache.get_parse, file_digest, self.__parse_model, input_path)
+        if(self.__use_cache is False or response is None):
+            if self.__offline:
+                raise Offline_Error("No cached parse results for " + os.path.basename(input_path) + " (offline)")
+            try:
+                self.__logger.info("use_cache is disabled or cache miss. Calling ADE parse API.")
+                response = await self.__coalesce(
+                    (STAGE_PARSE, file_digest, self.__parse_model),
+                    lambda: self.__parse_document(input_path, file_digest),
+                    lambda: self.__cache.get_parse(file_digest, self.__parse_model))
+            except Exception as e:
+                self.__logger.error("Communication with the ADE server failed: %s", e)
+                raise
+
+        return response
+
+    async def __coalesce(self, key, call, lookup):
+        # As Utility_Bill_Processor's: call is a coroutine function, lookup a blocking cache lookup
+        response, shared = await self.__flights.do(key, lambda: self.__call_locked(key, call, lookup))
+        if shared:
+            self.__logger.info("Shared the in-flight ADE %s call of an identical request.", key[0])
+            self.__metrics.inc("coalesced_calls", stage=key[0])
+        return response
+
+    async def __call_locked(self, key, call, lookup):
+        if self.__file_locks is None:
+            return await call()
+        # Waiting on the lock in a worker thread could take all of the default executor's threads, leaving
+        # none to release it: poll instead, without blocking the event loop
+        lock = self.__file_locks.lock(key)
+        delay = LOCK_POLL_MIN_INTERVAL
+        while not lock.acquire(blocking=False):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LOCK_POLL_MAX_INTERVAL)
+        try:
+            if self.__use_cache:
+                response = await asyncio.to_thread(lookup)
+                if response is not None:
+                    self.__metrics.inc("coalesced_calls", stage=key[0])
+                    return response
+            return await call()
+        finally:
+            # Not awaited, so cancellation can't skip it
+            lock.release()
+
+    async def __parse_document(self, input_path, file_digest):
+        if self.__page_splitter is None:
+            return await self.__call_parse(Path(input_path), file_digest)
+        with self.__metrics.timer("split"):
+            pages = await asyncio.wrap_future(self.__page_splitter.submit(input_path))
+        if len(pages) < 2:
+            return await self.__call_parse(Path(input_path), file_digest)
+        filename = os.path.basename(input_path)
+        # Calls are bounded by the max_in_flight semaphore
+        responses = await asyncio.gather(*[self.__parse_page(filename, number, page)
+                                           for number, page in enumerate(pages)])
+        response = merge_page_responses(responses, filename)
+        await asyncio.to_thread(self.__cache.put_parse, file_digest, response, self.__parse_model)
+        return response
+
+    async def __parse_page(self, filename, number, page):
+        page_digest, data = page
+        response = None
+        if self.__use_cache:
+            response = await asyncio.to_thread(self.__cache.get_parse, page_digest, self.__parse_model)
+        if response is not None:
+            self.__metrics.inc("pages", source="cache")
+            return response
+        self.__metrics.inc("pages", source="api")
+        # Coalesced within the process only, the document's lock is already held
+        response, shared = await self.__flights.do(
+            (STAGE_PARSE, page_digest, self.__parse_model),
+            lambda: self.__call_parse((filename + ".page" + str(number + 1) + ".pdf", data), page_digest))
+        return response
+
+    async def __call_parse(self, document, file_digest):
+        async with self.__get_semaphore():
+            with self.__metrics.timer("api", endpoint="parse"):
+                response = await self.__get_ade_client().parse(
+                    document=document,
+                    model=self.__parse_model,
+                )
+        log_payload(self.__log_payloads, "Parse response from LandingAI ADE: %s", response)
+        await asyncio.to_thread(self.__cache.put_parse, file_digest, response, self.__parse_model)
+        return response
+
+    def get_bill_type(self, markdown):
+        from . import utility_schema
+        with self.__metrics.timer("schema"):
+            return utility_schema.get_bill_type(markdown)
+
+    def get_schema(self, markdown):
+        return self.__get_model_schema(self.get_bill_type(markdown))
+
+    def __get_model_schema(self, bill_type):
+        from . import utility_schema
+        return utility_schema.get_model_schema(bill_type)
+
+    async def extract(self, markdown, schema, filename=None) -> "ExtractResponse":
+        with self.__metrics.timer("extract"):
+            return await self.__extract(markdown, schema, filename)
+
+    async def __extract(self, markdown, schema, filename):
+        # filename is only used for logging and the metadata of local extractions
+        filename = filename or ""
+        if self.__local_extractor is not None:
+            with self.__metrics.timer("local_extract"):
+                values = self.__local_extractor.extract(markdown, schema)
+            if values is not None:
+                from .utility_rules import build_extract_response
+                return build_extract_response(values, filename)
+        response = None
+        if(self.__use_cache):
+            self.__logger.info("Checking extract cache for file: %s", filename)
+            response = await asyncio.to_thread(self.__cache.get_extract, markdown, schema, self.__extract_model)
+        if(self.__use_cache is False or response is None):
+            if self.__offline:
+                raise Offline_Error("No cached extract results for " + filename + " (offline)")
+            try:
+                self.__logger.info("use_cache is disabled or cache miss. Calling ADE extract API.")
+                response = await self.__coalesce(
+                    (STAGE_EXTRACT, digest_text(markdown), digest_schema(schema), self.__extract_model),
+                    lambda: self.__call_extract(markdown, schema),
+                    lambda: self.__cache.get_extract(markdown, schema, self.__extract_model))
+            except Exception as e:
+                self.__logger.error("Communication with the ADE server failed: %s", e)
+                raise
+
+        return response
+
+    async def __call_extract(self, markdown, schema):
+        async with self.__get_semaphore():
+            with self.__metrics.timer("api", endpoint="extract"):
+                response = await self.__get_ade_client().extract(
+                    schema=schema,
+                    markdown=markdown,
+                    model=self.__extract_model
+                )
+        log_payload(self.__log_payloads, "Extract response from LandingAI ADE: %s", response)
+        await asyncio.to_thread(self.__cache.put_extract, markdown, schema, response, self.__extract_model)
+        return response
+
+    async def process(self, input_path) -> Utility_Bill_Result:
+        result = Utility_Bill_Result(input_path)
+        try:
+            with self.__metrics.timer("parse"):
+                result.file_digest = await asyncio.to_thread(self.__cache.get_file_digest, input_path)
+                result.parse_response = await self.__parse(input_path, result.file_digest)
+            result.bill_type = self.get_bill_type(result.parse_response.markdown)
+            schema = self.__get_model_schema(result.bill_type)
+            result.extract_response = await self.extract(result.parse_response.markdown, schema, result.filename)
+        except Exception as e:
+            self.__logger.error("Processing of file %s failed: %s", input_path, e)
+            result.error = e
+            return result
+        if self.__sink is not None:
+            try:
+                # A full batch is written out by the calling thread, keep that off the event loop
+                await asyncio.to_thread(self.__sink.write, result)
+            except Exception as e:
+                self.__logger.error("Writing the result of %s to the sink failed: %s", input_path, e)
+                result.sink_error = e
+        return result
+
+    async def process_many(self, paths, max_pending=None):
+        # Async generator yielding a Utility_Bill_Result per file, as it completes.
+        # At most max_pending files (default: twice max_in_flight) are being processed at any time,
+        # so the consumer applies backpressure to the producer.
+        if max_pending is None:
+            max_pending = self.__max_in_flight * 2
+        pending = set()
+        try:
+            for path in expand_paths(paths):
+                pending.add(asyncio.ensure_future(self.process(path)))
+                if len(pending) >= max_pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            # The consumer stopped early (break / aclose()), don't leave orphaned tasks behind
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import tempfile
+import threading
+from .utility_proc import expand_paths
+from .utility_logging import get_logger
+
+STATE_QUEUED = "queued"
+STATE_EXTRACTED = "extracted"
+STATE_FAILED = "failed"
+
+_logger = get_logger()
+
+
+def write_atomic(path, data):
+    # Write bytes or text to path through a temporary file in the same directory and a rename, so that
+    # readers see either the previous or the complete new content, never a truncated file
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data.encode("utf-8") if isinstance(data, str) else data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_json_atomic(path, value):
+    write_atomic(path, json.dumps(value, ensure_ascii=False, indent=4))
+
+
+class Utility_Bill_Journal(object):
+    # Append-only journal of per-file batch states, one JSON document per line:
+    # {"path", "state", "digest", "size", "mtime_ns", "error", "result", "time"}, result being the name of
+    # the file an extraction was written to, if any. The last line of a file wins.
+    # A line cut short by a crash is ignored when the journal is read back.
+    def __init__(self, path, fsync=False):
+        self.__path = path
+        self.__fsync = fsync
+        self.__lock = threading.Lock()
+        self.__states = {}
+        if os.path.exists(path):
+            self.__load()
+            self.__truncate_partial_line()
+        self.__file = open(path, "a", encoding="utf-8")
+
+    def __load(self):
+        with open(self.__path, "r", encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                    self.__states[record["path"]] = record
+                except (ValueError, KeyError, TypeError):
+                    _logger.warning("Ignoring unreadable line %d of journal %s", number, self.__path)
+
+    def __truncate_partial_line(self):
+        # Drop a line cut short by a crash, so that the next record starts on a line of its own
+        with open(self.__path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def record(self, path, state, digest=None, error=None, result=None):
+        record = dict(path=path, state=state, digest=digest, size=None, mtime_ns=None,
+                      error=None if error is None else str(error), result=result, time=time.time())
+        try:
+            st = os.stat(path)
+            record["size"] = st.st_size
+            record["mtime_ns"] = st.st_mtime_ns
+        except OSError:
+            pass
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.__lock:
+            self.__file.write(line)
+            self.__file.flush()
+            if self.__fsync:
+                os.fsync(self.__file.fileno())
+            self.__states[path] = record
+        return record
+
+    def get(self, path):
+        with self.__lock:
+            return self.__states.get(path)
+
+    def get_states(self):
+        with self.__lock:
+            return dict(self.__states)
+
+    def get_summary(self):
+        # Number of files per state
+        summary = {}
+        for record in self.get_states().values():
+            summary[record["state"]] = summary.get(record["state"], 0) + 1
+        return summary
+
+    def is_done(self, path):
+        # Extracted, and not modified since (size and mtime, no re-hashing)
+        record = self.get(path)
+        if record is None or record["state"] != STATE_EXTRACTED:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return st.st_size == record["size"] and st.st_mtime_ns == record["mtime_ns"]
+
+    def compact(self, keep=None):
+        # Rewrite the journal keeping only the last record of each file, and only of the files for which
+        # keep(path, record) is true when given
+        with self.__lock:
+            if keep is not None:
+                self.__states = {path: record for path, record in self.__states.items() if keep(path, record)}
+            self.__file.close()
+            write_atomic(self.__path, "".join(json.dumps(record, ensure_ascii=False) + "\n"
+                                              for record in self.__states.values()))
+            self.__file = open(self.__path, "a", encoding="utf-8")
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+
+def get_result_name(file_digest):
+    # Results are named after the bill's content digest: same-named bills from different directories
+    # don't overwrite each other
+    return file_digest.replace(":", "_") + ".json"
+
+
+def record_result(journal, result, results_dir=None):
+    # Journal the outcome of a Utility_Bill_Result, writing its extraction to results_dir when given
+    path = os.path.abspath(result.input_path)
+    if not result.ok():
+        journal.record(path, STATE_FAILED, result.file_digest, result.error)
+        return
+    name = None
+    if results_dir is not None:
+        name = get_result_name(result.file_digest)
+        write_json_atomic(os.path.join(results_dir, name), result.extract_response.extraction)
+    journal.record(path, STATE_EXTRACTED, result.file_digest, result=name)
+
+
+class Utility_Bill_Batch(object):
+    # Resumable batch run on top of a Utility_Bill_Processor. Every file's progress is recorded in a
+    # Utility_Bill_Journal, so a run that was interrupted can be started again with the same inputs and
+    # only processes what's left: files extracted (and unchanged) since are skipped without being read.
+    # Failed files are skipped as well unless retry_failed is set, or retried alone with retry_failures().
+    # With results_dir, each bill's extraction is written to <results_dir>/<digest>.json atomically, the
+    # journal recording each file's result name.
+    def __init__(self, processor, journal_path, results_dir=None, fsync=False):
+        self.__processor = processor
+        self.__journal = Utility_Bill_Journal(journal_path, fsync=fsync)
+        self.__results_dir = results_dir
+        if results_dir is not None:
+            os.makedirs(results_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def get_journal(self):
+        return self.__journal
+
+    def get_pending(self, paths, retry_failed=False):
+        # Absolute paths of the inputs still to be processed, in input order
+        for path in expand_paths(paths):
+            path = os.path.abspath(path)
+            if self.__journal.is_done(path):
+                continue
+            record = self.__journal.get(path)
+            if not retry_failed and record is not None and record["state"] == STATE_FAILED:
+                continue
+            yield path
+
+    def get_failed(self):
+        return [path for path, record in self.__journal.get_states().items() if record["state"] == STATE_FAILED]
+
+    def run(self, paths, max_workers=4, retry_failed=False):
+        # Process the pending inputs, yielding a Utility_Bill_Result for each as it completes
+        for result in self.__processor.process_many(self.__queue(self.get_pending(paths, retry_failed)),
+                                                    max_workers=max_workers):
+            self.__record(result)
+            yield result
+
+    def retry_failures(self, max_workers=4):
+        return self.run(self.get_failed(), max_workers=max_workers, retry_failed=True)
+
+    def close(self):
+        self.__journal.close()
+
+    def __queue(self, paths):
+        for path in paths:
+            self.__journal.record(path, STATE_QUEUED)
+            yield path
+
+    def __record(self, result):
+        record_result(self.__journal, result, self.__results_dir)
@@ -0,0 +1,828 @@
+import os
+import json
+import zlib
+import glob
+import time
+import mmap
+import hashlib
+import sqlite3
+import threading
+from functools import lru_cache
+from typing import TYPE_CHECKING
+from pathlib import Path
+from .utility_metrics import NULL_METRICS
+from .utility_logging import get_logger, is_logging_payloads, log_payload
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if TYPE_CHECKING:
+    from landingai_ade.types.parse_response import ParseResponse
+    from landingai_ade.types.extract_response import ExtractResponse
+
+DEFAULT_PARSE_MODEL = "dpt-2-latest"
+DEFAULT_EXTRACT_MODEL = "extract-latest"
+CACHE_INDEX_NAME = "cache.sqlite3"
+
+STAGE_PARSE = "parse"
+STAGE_EXTRACT = "extract"
+# The field of each stage's response callers actually need, stored apart from the rest of the response
+STAGE_MAIN_FIELDS = {
+    STAGE_PARSE: "markdown",
+    STAGE_EXTRACT: "extraction",
+}
+
+DEFAULT_DIGEST_ALGORITHM = "blake2b"
+READ_CHUNK_SIZE = 1024 * 1024
+# Seconds after a sidecar migration during which parse misses look for a migrated (MD5-keyed) entry of
+# the bill. Entries no bill claimed by then are dropped.
+LEGACY_REKEY_WINDOW = 30 * 24 * 3600
+
+# Order in which entries are evicted when the cache is over its limits
+EVICTION_POLICIES = {
+    "lru": "last_used ASC",
+    "lfu": "hits ASC, last_used ASC",
+}
+# Hits are recorded in memory and written to the index in batches of this many entries
+TOUCH_FLUSH_SIZE = 256
+
+
+class Cache_Policy(object):
+    # Lifecycle limits of a Utility_Bill_Cache, None meaning unlimited.
+    # max_bytes counts the stored (compressed) responses, not the size of the index file.
+    # When a limit is exceeded, entries are evicted in LRU or LFU order until the cache is back to
+    # low_water times its limits. ttl maps stages ("parse", "extract") to the entries' lifetime in seconds.
+    def __init__(self, max_bytes=None, max_entries=None, eviction="lru", ttl=None, low_water=0.9):
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError("Unknown eviction policy: " + str(eviction))
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.eviction = eviction
+        self.ttl = dict(ttl or {})
+        self.low_water = low_water
+
+    def get_ttl(self, stage):
+        return self.ttl.get(stage)
+
+    def is_bounded(self):
+        return self.max_bytes is not None or self.max_entries is not None
+
+
+def _new_blake2b():
+    return hashlib.blake2b(digest_size=16)
+
+
+def _new_md5():
+    return hashlib.md5()
+
+
+def _new_xxh3_128():
+    try:
+        import xxhash
+    except ImportError:
+        raise ImportError("The xxh3_128 digest requires the optional 'xxhash' package")
+    return xxhash.xxh3_128()
+
+
+DIGEST_ALGORITHMS = {
+    "blake2b": _new_blake2b,
+    "md5": _new_md5,
+    "xxh3_128": _new_xxh3_128,
+}
+
+
+def _json_codec():
+    # Uncompressed JSON text, as written by earlier versions of the index
+    return (lambda data: data, lambda data: data)
+
+
+def _zlib_codec():
+    return (lambda data: zlib.compress(data, 6), zlib.decompress)
+
+
+def _zstd_codec():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("The zstd payload codec requires the optional 'zstandard' package")
+    # Compressor / decompressor objects aren't thread-safe, so use a new one per call
+    return (lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+            lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+
+PAYLOAD_CODECS = {
+    "json": _json_codec,
+    "zlib": _zlib_codec,
+    "zstd": _zstd_codec,
+}
+
+
+@lru_cache(maxsize=None)
+def get_payload_codec(name):
+    # (compress, decompress) functions of a payload codec
+    return PAYLOAD_CODECS[name]()
+
+
+def get_default_payload_codec():
+    # zstd when available, zlib (the gzip format's deflate stream) otherwise
+    try:
+        get_payload_codec("zstd")
+        return "zstd"
+    except ImportError:
+        return "zlib"
+
+
+def dump_json(value):
+    # Compact UTF-8 JSON bytes, using orjson when it is installed
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def load_json(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def get_response_type(stage):
+    # ADE response model of a stage, imported on first use: landingai_ade is slow to import, and a cache
+    # hit usually only needs the main field
+    if stage == STAGE_PARSE:
+        from landingai_ade.types.parse_response import ParseResponse
+        return ParseResponse
+    from landingai_ade.types.extract_response import ExtractResponse
+    return ExtractResponse
+
+
+class Lazy_Response(object):
+    # Cached ADE response of which only the main field (markdown / extraction) is decoded up front.
+    # The full response model is decoded and built on first access to any other attribute, timed as
+    # cache_build.
+    def __init__(self, stage, value, load_rest, metrics=NULL_METRICS):
+        self._stage = stage
+        self._field = STAGE_MAIN_FIELDS[stage]
+        self._load_rest = load_rest
+        self._metrics = metrics
+        self._response = None
+        setattr(self, self._field, value)
+
+    def get_response(self):
+        if self._response is None:
+            with self._metrics.timer("cache_build", entry=self._stage):
+                data = self._load_rest()
+                data[self._field] = getattr(self, self._field)
+                self._response = get_response_type(self._stage)(**data)
+        return self._response
+
+    def __getattr__(self, name):
+        # Only called for attributes not set in __init__
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.get_response(), name)
+
+    def __repr__(self):
+        return "Lazy_Response(" + self._stage + ")"
+
+
+def digest_file(input_path, algorithm=DEFAULT_DIGEST_ALGORITHM):
+    # Digest of a file's content as "<algorithm>:<hex digest>".
+    # The file is memory mapped when possible, and read in large chunks otherwise (e.g. special files).
+    hasher = DIGEST_ALGORITHMS[algorithm]()
+    with open(input_path, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hasher.update(mapped)
+        except (ValueError, OSError):
+            # Empty files can't be mapped, and some file systems don't support mmap at all
+            f.seek(0)
+            for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+    return algorithm + ":" + hasher.hexdigest()
+
+
+def digest_bytes(data, algorithm=DEFAULT_DIGEST_ALGORITHM):
+    # Digest of in-memory document content (e.g. a single page), in the same form as digest_file()
+    hasher = DIGEST_ALGORITHMS[algorithm]()
+    hasher.update(data)
+    return algorithm + ":" + hasher.hexdigest()
+
+
+def digest_text(text):
+    # Digest of in-memory content (markdown, schemas)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def digest_schema(schema):
+    # Schemas are compared by content, so key them by their canonical JSON form
+    if isinstance(schema, str):
+        return _digest_schema_str(schema)
+    return digest_text(json.dumps(schema, sort_keys=True, separators=(",", ":"), ensure_ascii=False))
+
+
+@lru_cache(maxsize=64)
+def _digest_schema_str(schema):
+    # Schema strings come from a handful of memoized models, so avoid re-decoding them for every bill
+    return digest_schema(json.loads(schema))
+
+
+class Utility_Bill_Cache(object):
+    # Content-addressed cache of ADE responses, stored in a single SQLite index in output_dir.
+    # Parse results are keyed by (file digest, parse model), extract results by
+    # (markdown digest, schema digest, extract model), so renamed or duplicate bills share entries
+    # and bills with the same name never clobber each other.
+    # File digests are remembered together with the file's size, mtime_ns and inode, and are only
+    # recomputed when one of those changes, or on every call when strict is True.
+    # Responses are stored as compact, compressed JSON, with their main field (markdown / extraction) in a
+    # column of its own, so that cache hits only decode what the pipeline needs.
+    # With a shared store (a utility_store.Cache_Store), local misses are looked up in the store, and new
+    # entries are written to both, so processors on several hosts pay for each bill only once.
+    # log_payloads is the owning processor's: responses read from the cache are logged as it logs them.
+    def __init__(self, output_dir, logger=None, strict=False, digest_algorithm=DEFAULT_DIGEST_ALGORITHM,
+                 metrics=NULL_METRICS, codec=None, policy=None, store=None, log_payloads=None):
+        if digest_algorithm not in DIGEST_ALGORITHMS:
+            raise ValueError("Unknown digest algorithm: " + str(digest_algorithm))
+        if codec is None:
+            codec = get_default_payload_codec()
+        if codec not in PAYLOAD_CODECS:
+            raise ValueError("Unknown payload codec: " + str(codec))
+        self.__codec = codec
+        self.__compress = get_payload_codec(codec)[0]
+        self.__policy = policy if policy is not None else Cache_Policy()
+        self.__store = store
+        # Pending hit counts per entry key
+        self.__touches = {}
+        self.__lifecycle_lock = threading.Lock()
+        self.__output_dir = output_dir
+        self.__logger = logger if logger is not None else get_logger()
+        self.__metrics = metrics
+        self.__log_payloads = log_payloads
+        self.__strict = strict
+        self.__digest_algorithm = digest_algorithm
+        self.__index_path = str(Path(output_dir) / CACHE_INDEX_NAME)
+        # sqlite3 connections can't be shared between threads, so keep one per thread
+        self.__local = threading.local()
+        self.__connections = []
+        self.__connections_lock = threading.Lock()
+        # The directory and index are created on first use, keeping construction cheap
+        self.__open_lock = threading.RLock()
+        self.__opening = False
+        self.__ready = False
+        # False once no migrated entries are left to re-key
+        self.__legacy_entries = True
+
+    def __open(self):
+        # Other threads wait here until the index is ready. The opening thread itself gets through
+        # (re-entrant lock), as creating the index and migrating sidecars use the cache.
+        with self.__open_lock:
+            if self.__ready or self.__opening:
+                return
+            self.__opening = True
+            try:
+                # Create output directory if it doesn't exist
+                self.__create_dir_if_not_exists(self.__output_dir)
+                self.__create_index()
+                # One-shot import of the legacy per-filename JSON sidecars
+                if self.__get_meta("sidecars_migrated") is None:
+                    self.migrate_sidecars()
+                self.__ready = True
+            finally:
+                self.__opening = False
+
+    def __create_dir_if_not_exists(self, path):
+        try:
+            Path(path).mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            self.__logger.error("Creation of the directory %s failed: %s", path, e)
+            raise
+
+    def __connect(self):
+        conn = getattr(self.__local, "conn", None)
+        if conn is None:
+            if not self.__ready:
+                self.__open()
+            conn = sqlite3.connect(self.__index_path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.__local.conn = conn
+            with self.__connections_lock:
+                self.__connections.append(conn)
+        return conn
+
+    def __create_index(self):
+        conn = self.__connect()
+        with conn:
+            # One transaction, so that processes opening the index at the same time don't count entries twice
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                         "stage TEXT NOT NULL, "
+                         "content_digest TEXT NOT NULL, "
+                         "schema_digest TEXT NOT NULL, "
+                         "model TEXT NOT NULL, "
+                         "payload BLOB NOT NULL, "
+                         "created_at REAL NOT NULL, "
+                         "codec TEXT NOT NULL DEFAULT 'json', "
+                         "main_value BLOB, "
+                         "size INTEGER NOT NULL DEFAULT 0, "
+                         "last_used REAL NOT NULL DEFAULT 0, "
+                         "hits INTEGER NOT NULL DEFAULT 0, "
+                         "PRIMARY KEY (stage, content_digest, schema_digest, model)) WITHOUT ROWID")
+            # Index written by an earlier version: add the missing columns. Existing rows stay readable
+            # as uncompressed JSON, and their size and last use are filled in.
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(entries)")]
+            for name, definition in (("codec", "TEXT NOT NULL DEFAULT 'json'"),
+                                     ("main_value", "BLOB"),
+                                     ("size", "INTEGER NOT NULL DEFAULT 0"),
+                                     ("last_used", "REAL NOT NULL DEFAULT 0"),
+                                     ("hits", "INTEGER NOT NULL DEFAULT 0")):
+                if name not in columns:
+                    conn.execute("ALTER TABLE entries ADD COLUMN " + name + " " + definition)
+            if "size" not in columns:
+                conn.execute("UPDATE entries SET size = length(payload) + coalesce(length(main_value), 0), "
+                             "last_used = created_at")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_used)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_lfu ON entries (hits, last_used)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_created ON entries (stage, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_model ON entries (model)")
+            conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                         "path TEXT PRIMARY KEY, "
+                         "size INTEGER NOT NULL, "
+                         "mtime_ns INTEGER NOT NULL, "
+                         "inode INTEGER NOT NULL, "
+                         "digest TEXT NOT NULL, "
+                         "legacy_checked INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID")
+            if "legacy_checked" not in [row[1] for row in conn.execute("PRAGMA table_info(files)")]:
+                conn.execute("ALTER TABLE files ADD COLUMN legacy_checked INTEGER NOT NULL DEFAULT 0")
+            # Running totals of the entries and their size, kept by triggers in the transaction of every
+            # write, so that the limits can be checked without counting the cache. Counted once here for
+            # an index written by an earlier version.
+            conn.execute("INSERT OR IGNORE INTO meta (name, value) SELECT 'total_entries', COUNT(*) FROM entries")
+            conn.execute("INSERT OR IGNORE INTO meta (name, value) "
+                         "SELECT 'total_bytes', COALESCE(SUM(size), 0) FROM entries")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN "
+                         "UPDATE meta SET value = value + 1 WHERE name = 'total_entries'; "
+                         "UPDATE meta SET value = value + NEW.size WHERE name = 'total_bytes'; END")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN "
+                         "UPDATE meta SET value = value - 1 WHERE name = 'total_entries'; "
+                         "UPDATE meta SET value = value - OLD.size WHERE name = 'total_bytes'; END")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS entries_resize AFTER UPDATE OF size ON entries BEGIN "
+                         "UPDATE meta SET value = value + NEW.size - OLD.size WHERE name = 'total_bytes'; END")
+
+    def __get_meta(self, name):
+        row = self.__connect().execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def __has_legacy_entries(self):
+        # Whether parse entries imported from sidecars (keyed by MD5) are left to re-key. A range seek on
+        # the primary key; once there are none, the answer is remembered until the next migration.
+        # Entries left over after LEGACY_REKEY_WINDOW are dropped, so unclaimed ones don't cost every new
+        # bill an MD5 pass for good.
+        if not self.__legacy_entries or self.__digest_algorithm == "md5":
+            return False
+        conn = self.__connect()
+        row = conn.execute(
+            "SELECT 1 FROM entries WHERE stage = ? AND content_digest >= 'md5:' AND content_digest < 'md5;' "
+            "LIMIT 1", (STAGE_PARSE,)).fetchone()
+        if row is not None:
+            migrated_at = self.__get_meta("sidecars_migrated_at")
+            if migrated_at is None:
+                # Migrated by an earlier version: the window starts now
+                with conn:
+                    self.__set_meta(conn, "sidecars_migrated_at", time.time())
+            elif time.time() - float(migrated_at) > LEGACY_REKEY_WINDOW:
+                with conn:
+                    cursor = conn.execute("DELETE FROM entries WHERE stage = ? AND content_digest >= 'md5:' "
+                                          "AND content_digest < 'md5;'", (STAGE_PARSE,))
+                self.__logger.info("Dropped %d migrated cache entries no bill was found for", cursor.rowcount)
+                row = None
+        if row is None:
+            self.__legacy_entries = False
+        return row is not None
+
+    def __set_meta(self, conn, name, value):
+        conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, str(value)))
+
+    def close(self):
+        self.__flush_touches()
+        if self.__store is not None:
+            self.__store.flush()
+        with self.__connections_lock:
+            for conn in self.__connections:
+                conn.close()
+            self.__connections = []
+        self.__local = threading.local()
+
+    def get_file_digest(self, input_path):
+        path = os.path.abspath(input_path)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError as e:
+            self.__logger.error("Error computing digest: %s", e)
+            raise
+
+        conn = self.__connect()
+        row = conn.execute("SELECT size, mtime_ns, inode, digest FROM files WHERE path = ?", (path,)).fetchone()
+        if (not self.__strict and row is not None
+                and row[0] == st.st_size and row[1] == st.st_mtime_ns and row[2] == st.st_ino
+                and row[3].startswith(self.__digest_algorithm + ":")):
+            self.__logger.debug("File %s is unchanged, using recorded digest: %s", input_path, row[3])
+            self.__metrics.inc("file_digests", result="unchanged")
+            return row[3]
+
+        with self.__metrics.timer("hash"):
+            result = digest_file(path, self.__digest_algorithm)
+        self.__metrics.inc("bytes_hashed", st.st_size)
+        if row is None:
+            self.__metrics.inc("file_digests", result="new")
+        elif row[3] != result:
+            self.__metrics.inc("file_digests", result="changed")
+            # Remembered so that a following parse cache miss can be attributed to the changed file
+            self.__local.changed_digest = result
+        else:
+            self.__metrics.inc("file_digests", result="verified")
+        self.__logger.debug("Computed digest for file %s: %s", input_path, result)
+        with conn:
+            # A file re-hashed to the same digest keeps its legacy_checked flag
+            conn.execute("INSERT INTO files (path, size, mtime_ns, inode, digest) VALUES (?, ?, ?, ?, ?) "
+                         "ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, "
+                         "inode = excluded.inode, digest = excluded.digest, "
+                         "legacy_checked = legacy_checked * (digest = excluded.digest)",
+                         (path, st.st_size, st.st_mtime_ns, st.st_ino, result))
+        return result
+
+    def __rekey_legacy_parse(self, file_digest, input_path, model):
+        # Entries imported from sidecars are keyed by MD5. Look one up for this file and, if found,
+        # move it to the current digest. Files are recorded as checked, so the MD5 pass is paid at most
+        # once per file, whether an entry is found or not.
+        path = os.path.abspath(input_path)
+        conn = self.__connect()
+        row = conn.execute("SELECT legacy_checked FROM files WHERE path = ? AND digest = ?",
+                           (path, file_digest)).fetchone()
+        if row is not None and row[0]:
+            return False
+        legacy_digest = digest_file(input_path, "md5")
+        if legacy_digest == file_digest:
+            return False
+        with conn:
+            # Rows deleted by a REPLACE conflict don't fire the triggers keeping the totals: drop the migrated
+            # entry if the bill has one under the current digest already
+            conn.execute("DELETE FROM entries WHERE stage = ? AND content_digest = ? AND model = ? AND EXISTS ("
+                         "SELECT 1 FROM entries WHERE stage = ? AND content_digest = ? AND model = ?)",
+                         (STAGE_PARSE, legacy_digest, model, STAGE_PARSE, file_digest, model))
+            cursor = conn.execute("UPDATE entries SET content_digest = ? "
+                                  "WHERE stage = ? AND content_digest = ? AND model = ?",
+                                  (file_digest, STAGE_PARSE, legacy_digest, model))
+            conn.execute("UPDATE files SET legacy_checked = 1 WHERE path = ? AND digest = ?", (path, file_digest))
+        if cursor.rowcount:
+            self.__logger.info("Re-keyed migrated cache entry %s to %s", legacy_digest, file_digest)
+        return cursor.rowcount > 0
+
+    def __get(self, stage, content_digest, schema_digest, model):
+        # Returns the (codec, main_value, payload, created_at) row of an entry, or None.
+        # Entries past their TTL are misses, and are deleted on the next prune().
+        with self.__metrics.timer("cache_read", entry=stage):
+            row = self.__connect().execute(
+                "SELECT codec, main_value, payload, created_at FROM entries "
+                "WHERE stage = ? AND content_digest = ? AND schema_digest = ? AND model = ?",
+                (stage, content_digest, schema_digest, model)).fetchone()
+        if row is None and self.__store is not None:
+            row = self.__get_shared((stage, content_digest, schema_digest, model))
+        if row is None:
+            return None
+        ttl = self.__policy.get_ttl(stage)
+        if ttl is not None and row[3] + ttl < time.time():
+            self.__logger.info("Cache entry has expired (%s, TTL %ss)", stage, ttl)
+            self.__metrics.inc("cache_misses", stage=stage, reason="expired")
+            # Keeps __count_miss from counting this miss a second time
+            self.__local.expired = True
+            return None
+        self.__touch((stage, content_digest, schema_digest, model))
+        return row
+
+    def __get_shared(self, key):
+        # Look a local miss up in the shared store, keeping a copy of a hit in the local index.
+        # The store only saves API calls: when it is unreachable, the lookup is a miss.
+        try:
+            with self.__metrics.timer("cache_read", entry=key[0], tier="shared"):
+                record = self.__store.get(key)
+        except Exception as e:
+            self.__logger.warning("Shared cache lookup failed: %s", e)
+            self.__metrics.inc("shared_cache", stage=key[0], result="error")
+            return None
+        if record is None:
+            self.__metrics.inc("shared_cache", stage=key[0], result="miss")
+            return None
+        self.__metrics.inc("shared_cache", stage=key[0], result="hit")
+        codec, main_value, payload, created_at = record
+        now = time.time()
+        conn = self.__connect()
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO entries "
+                         "(stage, content_digest, schema_digest, model, payload, created_at, codec, main_value, "
+                         "size, last_used, hits) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)",
+                         key + (payload, created_at, codec, main_value, len(payload) + len(main_value), now))
+        self.__after_write()
+        return record
+
+    def __put_shared(self, key, record):
+        if self.__store is None:
+            return
+        ttl = self.__policy.get_ttl(key[0])
+        try:
+            self.__store.put(key, record, ttl)
+        except Exception as e:
+            self.__logger.warning("Shared cache write failed: %s", e)
+            self.__metrics.inc("shared_cache", stage=key[0], result="error")
+
+    def __touch(self, key):
+        # Record a hit, for LRU / LFU eviction. Written to the index in batches, not on every read.
+        with self.__lifecycle_lock:
+            self.__touches[key] = self.__touches.get(key, 0) + 1
+            flush = len(self.__touches) >= TOUCH_FLUSH_SIZE
+        if flush:
+            self.__flush_touches()
+
+    def __flush_touches(self):
+        with self.__lifecycle_lock:
+            touches, self.__touches = self.__touches, {}
+        if not touches:
+            return
+        now = time.time()
+        conn = self.__connect()
+        with conn:
+            conn.executemany("UPDATE entries SET hits = hits + ?, last_used = ? "
+                             "WHERE stage = ? AND content_digest = ? AND schema_digest = ? AND model = ?",
+                             [(hits, now) + key for key, hits in touches.items()])
+
+    def __decode(self, stage, row):
+        codec, main_value, payload, _ = row
+        decompress = get_payload_codec(codec)[1]
+        field = STAGE_MAIN_FIELDS[stage]
+        with self.__metrics.timer("cache_decode", entry=stage):
+            if main_value is None:
+                # Rows written by earlier versions hold the whole response in payload
+                rest = load_json(decompress(payload))
+                value = rest.pop(field, None)
+                return Lazy_Response(stage, value, lambda: rest, self.__metrics)
+            value = load_json(decompress(main_value))
+            return Lazy_Response(stage, value, lambda: load_json(decompress(payload)), self.__metrics)
+
+    def __count_miss(self, stage, content_digest, schema_digest, model):
+        # Attribute a cache miss to its cause. Costs an extra lookup, so only done when metrics are enabled.
+        if getattr(self.__local, "expired", False):
+            self.__local.expired = False
+            return
+        if not self.__metrics.enabled:
+            return
+        rows = self.__connect().execute(
+            "SELECT schema_digest, model FROM entries WHERE stage = ? AND content_digest = ?",
+            (stage, content_digest)).fetchall()
+        if any(row[0] != schema_digest for row in rows):
+            reason = "dirty_schema"
+        elif rows:
+            reason = "model_changed"
+        elif stage == STAGE_PARSE and getattr(self.__local, "changed_digest", None) == content_digest:
+            reason = "dirty_digest"
+        else:
+            reason = "missing"
+        self.__metrics.inc("cache_misses", stage=stage, reason=reason)
+
+    def __put(self, conn, stage, content_digest, schema_digest, model, payload):
+        if hasattr(payload, "to_dict"):
+            payload = payload.to_dict(mode="json")
+        else:
+            payload = dict(payload)
+        main_value = self.__compress(dump_json(payload.pop(STAGE_MAIN_FIELDS[stage], None)))
+        payload = self.__compress(dump_json(payload))
+        now = time.time()
+        # An upsert rather than INSERT OR REPLACE, whose deletes wouldn't fire the triggers keeping the totals
+        conn.execute("INSERT INTO entries "
+                     "(stage, content_digest, schema_digest, model, payload, created_at, codec, main_value, "
+                     "size, last_used, hits) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0) "
+                     "ON CONFLICT (stage, content_digest, schema_digest, model) DO UPDATE SET "
+                     "payload = excluded.payload, created_at = excluded.created_at, codec = excluded.codec, "
+                     "main_value = excluded.main_value, size = excluded.size, last_used = excluded.last_used, "
+                     "hits = 0",
+                     (stage, content_digest, schema_digest, model, payload, now, self.__codec, main_value,
+                      len(payload) + len(main_value), now))
+        # The entry's key and (codec, main_value, payload, created_at) record, for the shared store
+        return (stage, content_digest, schema_digest, model), (self.__codec, main_value, payload, now)
+
+    def __after_write(self):
+        # Two primary key lookups in meta: cheap enough to check the limits on every write
+        if self.__policy.is_bounded():
+            self.enforce_limits()
+
+    def __get_totals(self, conn):
+        # (entries, bytes) of the whole cache, from the running totals
+        totals = dict(conn.execute("SELECT name, value FROM meta WHERE name IN ('total_entries', 'total_bytes')"))
+        return int(totals["total_entries"]), int(totals["total_bytes"])
+
+    def get_parse(self, file_digest, model=DEFAULT_PARSE_MODEL, input_path=None) -> "ParseResponse":
+        # Returns the cached parse response, or None on a cache miss.
+        # The response is a Lazy_Response: .markdown is decoded, anything else on first use.
+        # When input_path is given, entries migrated from legacy sidecars are found as well.
+        self.__logger.info("use_cache is enabled. Checking cache validity.")
+        row = self.__get(STAGE_PARSE, file_digest, "", model)
+        if row is None and input_path is not None and self.__has_legacy_entries():
+            if self.__rekey_legacy_parse(file_digest, input_path, model):
+                row = self.__get(STAGE_PARSE, file_digest, "", model)
+        if row is None:
+            self.__logger.info("Cache miss: no parse results for digest %s", file_digest)
+            self.__count_miss(STAGE_PARSE, file_digest, "", model)
+            return None
+        self.__logger.info("Cache is valid, will read parse results from cache.")
+        self.__metrics.inc("cache_hits", stage=STAGE_PARSE)
+        response = self.__decode(STAGE_PARSE, row)
+        if is_logging_payloads(self.__log_payloads):
+            log_payload(True, "Parse response from cache: %s", response.get_response())
+        return response
+
+    def get_markdown(self, file_digest, model=DEFAULT_PARSE_MODEL, input_path=None):
+        # Just the markdown of a cached parse response, or None on a cache miss
+        response = self.get_parse(file_digest, model, input_path)
+        return None if response is None else response.markdown
+
+    def put_parse(self, file_digest, response, model=DEFAULT_PARSE_MODEL):
+        self.__logger.debug("Writing parse response for digest %s to cache index", file_digest)
+        conn = self.__connect()
+        with self.__metrics.timer("cache_write", entry=STAGE_PARSE), conn:
+            key, record = self.__put(conn, STAGE_PARSE, file_digest, "", model, response)
+        self.__put_shared(key, record)
+        self.__after_write()
+
+    def get_extract(self, markdown, schema, model=DEFAULT_EXTRACT_MODEL) -> "ExtractResponse":
+        # Returns the cached extract response as a Lazy_Response, or None on a cache miss
+        self.__logger.info("use_cache is enabled. Checking cache validity.")
+        markdown_digest = digest_text(markdown)
+        schema_digest = digest_schema(schema)
+        row = self.__get(STAGE_EXTRACT, markdown_digest, schema_digest, model)
+        if row is None:
+            self.__logger.info("Cache miss: no extract results for this markdown and schema")
+            self.__count_miss(STAGE_EXTRACT, markdown_digest, schema_digest, model)
+            return None
+        self.__logger.info("Cache is valid, will read extract results from cache.")
+        self.__metrics.inc("cache_hits", stage=STAGE_EXTRACT)
+        response = self.__decode(STAGE_EXTRACT, row)
+        if is_logging_payloads(self.__log_payloads):
+            log_payload(True, "Extract response from cache: %s", response.get_response())
+        return response
+
+    def get_extraction(self, markdown, schema, model=DEFAULT_EXTRACT_MODEL):
+        # Just the extraction dict of a cached extract response, or None on a cache miss
+        response = self.get_extract(markdown, schema, model)
+        return None if response is None else response.extraction
+
+    def put_extract(self, markdown, schema, response, model=DEFAULT_EXTRACT_MODEL):
+        self.__logger.debug("Writing extract response to cache index")
+        conn = self.__connect()
+        with self.__metrics.timer("cache_write", entry=STAGE_EXTRACT), conn:
+            key, record = self.__put(conn, STAGE_EXTRACT, digest_text(markdown), digest_schema(schema), model,
+                                     response)
+        self.__put_shared(key, record)
+        self.__after_write()
+
+    def enforce_limits(self, policy=None):
+        # Evict entries until the cache is within the limits of policy (by default the cache's own).
+        # Returns the number of evicted entries.
+        policy = policy if policy is not None else self.__policy
+        if not policy.is_bounded():
+            return 0
+        conn = self.__connect()
+        count, total = self.__get_totals(conn)
+        excess_entries = 0
+        if policy.max_entries is not None and count > policy.max_entries:
+            excess_entries = count - int(policy.max_entries * policy.low_water)
+        excess_bytes = 0
+        if policy.max_bytes is not None and total > policy.max_bytes:
+            excess_bytes = total - int(policy.max_bytes * policy.low_water)
+        if excess_entries <= 0 and excess_bytes <= 0:
+            return 0
+
+        # Evict in the order of the latest hits
+        self.__flush_touches()
+        victims = []
+        freed = 0
+        cursor = conn.execute("SELECT stage, content_digest, schema_digest, model, size FROM entries "
+                              "ORDER BY " + EVICTION_POLICIES[policy.eviction])
+        for row in cursor:
+            if len(victims) >= excess_entries and freed >= excess_bytes:
+                break
+            victims.append(row[:4])
+            freed += row[4]
+        cursor.close()
+        with conn:
+            conn.executemany("DELETE FROM entries "
+                             "WHERE stage = ? AND content_digest = ? AND schema_digest = ? AND model = ?", victims)
+        self.__metrics.inc("cache_evictions", len(victims))
+        self.__logger.info("Evicted %d cache entries (%d bytes, %s)", len(victims), freed, policy.eviction)
+        return len(victims)
+
+    def invalidate(self, model=None, stage=None, before=None, shared=True):
+        # Delete the entries matching all of the given criteria: model id, stage, created before a
+        # timestamp. Without criteria, the whole cache is cleared. Returns the number of deleted entries.
+        # Unless shared is False, matching entries of the shared store are deleted as well (they would
+        # otherwise come back on the next lookup), and counted with the local ones.
+        conditions = []
+        values = []
+        for column, operator, value in (("model", "=", model), ("stage", "=", stage), ("created_at", "<", before)):
+            if value is not None:
+                conditions.append(column + " " + operator + " ?")
+                values.append(value)
+        sql = "DELETE FROM entries"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        self.__flush_touches()
+        conn = self.__connect()
+        with conn:
+            deleted = conn.execute(sql, values).rowcount
+        if shared and self.__store is not None:
+            deleted += self.__store.delete(stage=stage, model=model, before=before)
+        self.__logger.info("Invalidated %d cache entries", deleted)
+        return deleted
+
+    def prune(self, policy=None, vacuum=False):
+        # Delete expired entries and forget files which no longer exist, then enforce the size limits.
+        # With vacuum, the index file is compacted to release the freed space to the file system.
+        # Returns the number of expired / evicted entries and forgotten files.
+        policy = policy if policy is not None else self.__policy
+        self.__flush_touches()
+        conn = self.__connect()
+        now = time.time()
+        expired = 0
+        with conn:
+            for stage, ttl in policy.ttl.items():
+                if ttl is not None:
+                    expired += conn.execute("DELETE FROM entries WHERE stage = ? AND created_at < ?",
+                                            (stage, now - ttl)).rowcount
+        missing = [(path,) for (path,) in conn.execute("SELECT path FROM files") if not os.path.exists(path)]
+        with conn:
+            conn.executemany("DELETE FROM files WHERE path = ?", missing)
+        evicted = self.enforce_limits(policy)
+        if vacuum:
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.__logger.info("Pruned the cache: %d expired, %d evicted entries, %d missing files",
+                           expired, evicted, len(missing))
+        return dict(expired=expired, evicted=evicted, files=len(missing))
+
+    def get_stats(self):
+        # Entries, stored bytes and hits per stage and model, and the size of the index files
+        self.__flush_touches()
+        conn = self.__connect()
+        stages = [dict(stage=row[0], model=row[1], entries=row[2], bytes=row[3], hits=row[4],
+                       oldest=row[5], newest=row[6])
+                  for row in conn.execute("SELECT stage, model, COUNT(*), SUM(size), SUM(hits), MIN(created_at), "
+                                          "MAX(created_at) FROM entries GROUP BY stage, model ORDER BY stage, model")]
+        index_bytes = 0
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                index_bytes += os.path.getsize(self.__index_path + suffix)
+            except OSError:
+                pass
+        return dict(entries=sum(stage["entries"] for stage in stages),
+                    bytes=sum(stage["bytes"] for stage in stages),
+                    files=conn.execute("SELECT COUNT(*) FROM files").fetchone()[0],
+                    index_bytes=index_bytes,
+                    stages=stages)
+
+    def __read_sidecar(self, path):
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def migrate_sidecars(self, source_dir=None, parse_model=DEFAULT_PARSE_MODEL,
+                         extract_model=DEFAULT_EXTRACT_MODEL):
+        # Import <filename>.{md5,parse,schema,extract}.json sidecars, as written by earlier versions,
+        # into the index. Sidecars are left in place. Returns the number of bills imported.
+        if source_dir is None:
+            source_dir = self.__output_dir
+        migrated = 0
+        conn = self.__connect()
+        with conn:
+            for md5_path in sorted(glob.glob(os.path.join(glob.escape(str(source_dir)), "*.md5.json"))):
+                stem = md5_path[:-len(".md5.json")]
+                try:
+                    file_digest = "md5:" + self.__read_sidecar(md5_path)['md5']
+                    parse_json = self.__read_sidecar(stem + ".parse.json")
+                except (OSError, ValueError, KeyError) as e:
+                    self.__logger.warning("Skipping sidecars of %s: %s", stem, e)
+                    continue
+                self.__put(conn, STAGE_PARSE, file_digest, "", parse_model, parse_json)
+                if os.path.exists(stem + ".schema.json") and os.path.exists(stem + ".extract.json"):
+                    try:
+                        schema = self.__read_sidecar(stem + ".schema.json")
+                        extract_json = self.__read_sidecar(stem + ".extract.json")
+                        self.__put(conn, STAGE_EXTRACT, digest_text(parse_json['markdown']), digest_schema(schema),
+                                   extract_model, extract_json)
+                    except (OSError, ValueError, KeyError) as e:
+                        self.__logger.warning("Skipping extract sidecars of %s: %s", stem, e)
+                migrated += 1
+            self.__set_meta(conn, "sidecars_migrated", migrated)
+            if migrated:
+                self.__set_meta(conn, "sidecars_migrated_at", time.time())
+        self.__legacy_entries = True
+        self.__logger.info("Migrated %d sidecar cache entries from %s", migrated, source_dir)
+        return migrated
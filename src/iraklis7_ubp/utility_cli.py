@@ -0,0 +1,395 @@
+import sys
+import json
+import time
+import argparse
+from .utility_proc import Utility_Bill_Processor
+from .utility_cache import Utility_Bill_Cache, Cache_Policy, EVICTION_POLICIES, STAGE_PARSE, STAGE_EXTRACT
+from .utility_metrics import Utility_Bill_Metrics
+from .utility_sinks import SINK_FORMATS, DEFAULT_BATCH_SIZE, open_sink
+from .utility_transport import Retry_Policy, Token_Bucket, Shared_Token_Bucket, Circuit_Breaker
+from .utility_batch import Utility_Bill_Batch
+from .utility_pages import Page_Splitter
+from .utility_store import open_store
+from .utility_logging import configure_logging
+
+
+def _add_processor_args(parser):
+    parser.add_argument("--env", default="eu", help="LandingAI ADE environment (default: eu)")
+    parser.add_argument("--output-dir", default="./output", help="Cache / output directory (default: ./output)")
+    parser.add_argument("--use-cache", action="store_true", help="Use cached parse / extract results when valid")
+    parser.add_argument("--offline", action="store_true",
+                        help="Only use cached results, never call the ADE API: bills not in the cache fail")
+    parser.add_argument("--strict-cache", action="store_true",
+                        help="Always re-hash input files, instead of trusting unchanged size / mtime / inode")
+    parser.add_argument("--local-extraction", action="store_true",
+                        help="Extract known issuers' bills locally, calling the ADE extract API only as a fallback")
+    parser.add_argument("--metrics", metavar="FILE", default=None,
+                        help="Write per-stage timings and cache counters to FILE, in OpenMetrics text format")
+    parser.add_argument("--max-attempts", type=int, default=3,
+                        help="Attempts per ADE call on transient errors, with exponential backoff (default: 3)")
+    parser.add_argument("--rate-limit", type=float, default=None, metavar="RPS",
+                        help="Limit ADE calls to RPS requests per second")
+    parser.add_argument("--rate-limit-file", default=None, metavar="FILE",
+                        help="Share the --rate-limit budget with other processes using the same FILE")
+    parser.add_argument("--circuit-breaker", type=int, default=None, metavar="FAILURES",
+                        help="Stop calling the ADE API for a while after FAILURES consecutive transient errors")
+    parser.add_argument("--lock-dir", default=None, metavar="DIR",
+                        help="Coordinate with other processes sharing the cache through lock files in DIR, so that "
+                             "duplicate bills are sent to the ADE API only once")
+    parser.add_argument("--split-pages", action="store_true",
+                        help="Parse multi-page bills page by page, sending only pages not in the cache to the ADE API "
+                             "(requires pypdf)")
+    parser.add_argument("--page-workers", type=int, default=None, metavar="N",
+                        help="Processes splitting bills into pages (default: one per CPU)")
+    parser.add_argument("--cache-store", default=None, metavar="URL",
+                        help="Share cached responses with other hosts through a store, e.g. redis://host:6379/0 "
+                             "(requires redis)")
+    parser.add_argument("--log-payloads", action="store_true",
+                        help="Log full parse / extract responses to the log file (verbose, slow)")
+
+
+def _add_cache_policy_args(parser):
+    parser.add_argument("--cache-max-bytes", type=int, default=None, metavar="BYTES",
+                        help="Evict cache entries once the stored responses exceed BYTES")
+    parser.add_argument("--cache-max-entries", type=int, default=None, metavar="N",
+                        help="Evict cache entries once there are more than N")
+    parser.add_argument("--cache-eviction", choices=sorted(EVICTION_POLICIES), default="lru",
+                        help="Which entries to evict first: least recently or least frequently used (default: lru)")
+    parser.add_argument("--cache-ttl-parse", type=float, default=None, metavar="SECONDS",
+                        help="Treat cached parse responses older than SECONDS as missing")
+    parser.add_argument("--cache-ttl-extract", type=float, default=None, metavar="SECONDS",
+                        help="Treat cached extract responses older than SECONDS as missing")
+
+
+def _get_cache_policy(args):
+    ttl = {STAGE_PARSE: args.cache_ttl_parse, STAGE_EXTRACT: args.cache_ttl_extract}
+    return Cache_Policy(max_bytes=args.cache_max_bytes, max_entries=args.cache_max_entries,
+                        eviction=args.cache_eviction,
+                        ttl={stage: seconds for stage, seconds in ttl.items() if seconds is not None})
+
+
+def _get_processor(args, metrics=None, sink=None, page_splitter=None, store=None):
+    rate_limiter = None
+    if args.rate_limit is not None:
+        if args.rate_limit_file:
+            rate_limiter = Shared_Token_Bucket(args.rate_limit_file, args.rate_limit)
+        else:
+            rate_limiter = Token_Bucket(args.rate_limit)
+    circuit_breaker = Circuit_Breaker(args.circuit_breaker) if args.circuit_breaker else None
+    return Utility_Bill_Processor(env=args.env, output_dir=args.output_dir, use_cache=args.use_cache,
+                                  strict_cache=args.strict_cache, local_extraction=args.local_extraction,
+                                  metrics=metrics, log_payloads=args.log_payloads or None, sink=sink,
+                                  retry_policy=Retry_Policy(args.max_attempts), rate_limiter=rate_limiter,
+                                  circuit_breaker=circuit_breaker, lock_dir=args.lock_dir,
+                                  cache_policy=_get_cache_policy(args), page_splitter=page_splitter,
+                                  offline=args.offline, cache_store=store)
+
+
+def _print_result(result):
+    # One JSON document per line
+    record = dict(file=result.input_path)
+    if result.ok():
+        record["extraction"] = result.extract_response.extraction
+    else:
+        record["error"] = str(result.error)
+    if result.sink_error is not None:
+        record["sink_error"] = str(result.sink_error)
+    print(json.dumps(record, ensure_ascii=False), flush=True)
+
+
+def batch(args):
+    if not args.paths and not args.only_failed:
+        print("No input files given", file=sys.stderr)
+        return 2
+    if (args.retry_failed or args.only_failed or args.results_dir) and not args.journal:
+        print("--retry-failed, --only-failed and --results-dir require --journal", file=sys.stderr)
+        return 2
+    metrics = Utility_Bill_Metrics() if args.metrics else None
+    sink = open_sink(args.sink, args.sink_format, args.sink_batch_size) if args.sink else None
+    page_splitter = Page_Splitter(args.page_workers) if args.split_pages else None
+    store = open_store(args.cache_store) if args.cache_store else None
+    processor = _get_processor(args, metrics, sink, page_splitter, store)
+    runner = None
+    if args.journal:
+        runner = Utility_Bill_Batch(processor, args.journal, results_dir=args.results_dir)
+        if args.only_failed:
+            results = runner.retry_failures(max_workers=args.workers)
+        else:
+            results = runner.run(args.paths, max_workers=args.workers, retry_failed=args.retry_failed)
+    else:
+        results = processor.process_many(args.paths, max_workers=args.workers)
+    failures = 0
+    # In completion order
+    for result in results:
+        if not result.ok() or result.sink_error is not None:
+            failures += 1
+        _print_result(result)
+    processor.close()
+    if sink is not None:
+        sink.close()
+    if runner is not None:
+        runner.close()
+    if page_splitter is not None:
+        page_splitter.close()
+    if store is not None:
+        store.close()
+    stats = processor.get_local_extraction_stats()
+    if stats is not None:
+        print("Local extraction: " + str(stats["hits"]) + " hits, " + str(stats["fallbacks"]) + " fallbacks "
+              "(hit ratio " + format(stats["hit_ratio"], ".1%") + ")", file=sys.stderr)
+    if metrics is not None:
+        with open(args.metrics, "w") as f:
+            f.write(metrics.to_openmetrics())
+    return 1 if failures else 0
+
+
+def watch(args):
+    # Imported here, only the daemon needs the watcher
+    import signal
+    from .utility_watch import DEFAULT_PATTERNS, Utility_Bill_Watcher
+    metrics = Utility_Bill_Metrics() if args.metrics else None
+    sink = open_sink(args.sink, args.sink_format, args.sink_batch_size) if args.sink else None
+    page_splitter = Page_Splitter(args.page_workers) if args.split_pages else None
+    store = open_store(args.cache_store) if args.cache_store else None
+    processor = _get_processor(args, metrics, sink, page_splitter, store)
+    watcher = Utility_Bill_Watcher(processor, args.inbox, journal_path=args.journal, patterns=args.pattern or DEFAULT_PATTERNS,
+                                   max_workers=args.workers, queue_size=args.queue_size, settle=args.settle,
+                                   poll_interval=args.poll_interval, use_inotify=False if args.poll else None,
+                                   on_result=_print_result)
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+    watcher.close()
+    processor.close()
+    if sink is not None:
+        sink.close()
+    if page_splitter is not None:
+        page_splitter.close()
+    if store is not None:
+        store.close()
+    if metrics is not None:
+        with open(args.metrics, "w") as f:
+            f.write(metrics.to_openmetrics())
+    return 0
+
+
+def cache_migrate(args):
+    cache = Utility_Bill_Cache(args.output_dir)
+    migrated = cache.migrate_sidecars(args.source_dir)
+    print("Migrated " + str(migrated) + " bills into " + args.output_dir)
+    cache.close()
+    return 0
+
+
+def cache_stats(args):
+    cache = Utility_Bill_Cache(args.output_dir)
+    print(json.dumps(cache.get_stats(), indent=4))
+    cache.close()
+    return 0
+
+
+def cache_prune(args):
+    cache = Utility_Bill_Cache(args.output_dir, policy=_get_cache_policy(args))
+    print(json.dumps(cache.prune(vacuum=args.vacuum)))
+    cache.close()
+    return 0
+
+
+def cache_invalidate(args):
+    if args.model is None and args.stage is None and args.older_than is None and not args.all:
+        print("Give --model, --stage and / or --older-than, or --all to clear the whole cache", file=sys.stderr)
+        return 2
+    before = time.time() - args.older_than if args.older_than is not None else None
+    store = open_store(args.cache_store) if args.cache_store else None
+    cache = Utility_Bill_Cache(args.output_dir, store=store)
+    deleted = cache.invalidate(model=args.model, stage=args.stage, before=before)
+    print("Invalidated " + str(deleted) + " cache entries")
+    cache.close()
+    if store is not None:
+        store.close()
+    return 0
+
+
+def validate(args):
+    # Imported here, the validation stage needs pydantic and the bill models
+    from .utility_validate import build_frames_from_records
+    with open(args.records, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    issues = []
+    for frame in build_frames_from_records(records).values():
+        issues.extend(frame.validate(outlier_threshold=args.outlier_threshold))
+    for issue in issues:
+        print(json.dumps(issue, ensure_ascii=False))
+    print("Validated " + str(len(records)) + " bills: " + str(len(issues)) + " issues", file=sys.stderr)
+    return 1 if issues else 0
+
+
+def regress(args):
+    # Imported here, only regression runs need the report writers
+    from .utility_regression import (Utility_Bill_Regression, find_regressions, is_failure, write_json_report,
+                                     write_junit_report)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    metrics = Utility_Bill_Metrics() if args.metrics else None
+    store = open_store(args.cache_store) if args.cache_store else None
+    # Always served from the cache, with --offline bills missing from it are errors instead of API calls
+    processor = Utility_Bill_Processor(env=args.env, output_dir=args.output_dir, use_cache=True,
+                                       strict_cache=args.strict_cache, local_extraction=args.local_extraction,
+                                       metrics=metrics, log_payloads=args.log_payloads or None,
+                                       retry_policy=Retry_Policy(args.max_attempts), lock_dir=args.lock_dir,
+                                       offline=args.offline, cache_store=store)
+    report = Utility_Bill_Regression(processor, args.expected_dir, abs_tol=args.abs_tol,
+                                     rel_tol=args.rel_tol).run(args.paths, max_workers=args.workers)
+    processor.close()
+    if store is not None:
+        store.close()
+    if args.json:
+        write_json_report(report, args.json)
+    if args.junit:
+        write_junit_report(report, args.junit)
+    if metrics is not None:
+        with open(args.metrics, "w") as f:
+            f.write(metrics.to_openmetrics())
+    # One line per bill which isn't a plain pass, with its differing fields
+    for case in report["cases"]:
+        if case["status"] == "passed":
+            continue
+        record = dict(file=case["file"], status=case["status"])
+        if case["error"] is not None:
+            record["error"] = case["error"]
+        record["diffs"] = [diff for diff in case["diffs"] if diff["status"] != "match"]
+        print(json.dumps(record, ensure_ascii=False))
+    summary = report["summary"]
+    print("Compared " + str(summary["total"]) + " bills in " + str(summary["elapsed_s"]) + "s: " +
+          str(summary["passed"]) + " passed, " + str(summary["failed"]) + " failed, " + str(summary["error"]) +
+          " errors, " + str(summary["missing_expectations"]) + " without expectations", file=sys.stderr)
+    if baseline is not None:
+        print(str(len(find_regressions(report, baseline))) + " regressions against " + args.baseline,
+              file=sys.stderr)
+    return 1 if is_failure(report, baseline) else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="iraklis7_ubp", description="Utility Bill Processor")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batch_parser = subparsers.add_parser("batch", help="Parse and extract many bills concurrently")
+    batch_parser.add_argument("paths", nargs="*", help="PDF files or glob patterns (e.g. 'inbox/*.pdf')")
+    batch_parser.add_argument("-w", "--workers", type=int, default=4, help="Number of concurrent workers (default: 4)")
+    batch_parser.add_argument("--journal", metavar="FILE", default=None,
+                              help="Record per-file progress in FILE and skip files already done by earlier runs")
+    batch_parser.add_argument("--retry-failed", action="store_true",
+                              help="With --journal, also process files that failed in earlier runs")
+    batch_parser.add_argument("--only-failed", action="store_true",
+                              help="With --journal, only process files that failed in earlier runs")
+    batch_parser.add_argument("--results-dir", metavar="DIR", default=None,
+                              help="With --journal, write each bill's extraction to DIR/<digest>.json")
+    batch_parser.add_argument("--sink", metavar="PATH", default=None,
+                              help="Also stream one validated record per bill to PATH (a file, or a directory "
+                                   "for csv / parquet)")
+    batch_parser.add_argument("--sink-format", choices=sorted(SINK_FORMATS), default=None,
+                              help="Format of --sink (default: from its extension, .ndjson/.jsonl or .db/.sqlite)")
+    batch_parser.add_argument("--sink-batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                              help="Records per sink flush (default: " + str(DEFAULT_BATCH_SIZE) + ")")
+    _add_processor_args(batch_parser)
+    _add_cache_policy_args(batch_parser)
+    batch_parser.set_defaults(func=batch)
+
+    watch_parser = subparsers.add_parser("watch", help="Process the bills landing in an inbox directory as they arrive")
+    watch_parser.add_argument("inbox", help="Directory to watch")
+    watch_parser.add_argument("--pattern", action="append", default=None,
+                              help="File name pattern of bills, may be repeated (default: *.pdf)")
+    watch_parser.add_argument("-w", "--workers", type=int, default=4, help="Number of concurrent workers (default: 4)")
+    watch_parser.add_argument("--queue-size", type=int, default=None,
+                              help="Settled bills waiting for a worker, before the watcher waits (default: 4 per "
+                                   "worker)")
+    watch_parser.add_argument("--settle", type=float, default=2.0, metavar="SECONDS",
+                              help="Seconds a file must stay unchanged before it is processed, when its writer "
+                                   "isn't seen closing it (default: 2)")
+    watch_parser.add_argument("--poll-interval", type=float, default=1.0, metavar="SECONDS",
+                              help="Seconds between scans of the inbox when polling (default: 1)")
+    watch_parser.add_argument("--poll", action="store_true", help="Poll the inbox instead of using inotify")
+    watch_parser.add_argument("--journal", metavar="FILE", default=None,
+                              help="Record processed files in FILE, so that a restarted watcher skips them")
+    watch_parser.add_argument("--sink", metavar="PATH", default=None,
+                              help="Also stream one validated record per bill to PATH (a file, or a directory "
+                                   "for csv / parquet)")
+    watch_parser.add_argument("--sink-format", choices=sorted(SINK_FORMATS), default=None,
+                              help="Format of --sink (default: from its extension, .ndjson/.jsonl or .db/.sqlite)")
+    watch_parser.add_argument("--sink-batch-size", type=int, default=1,
+                              help="Records per sink flush (default: 1, every bill is written as it is processed)")
+    _add_processor_args(watch_parser)
+    _add_cache_policy_args(watch_parser)
+    watch_parser.set_defaults(func=watch)
+
+    validate_parser = subparsers.add_parser("validate", help="Check the records of an NDJSON sink for "
+                                                             "inconsistent amounts, dates and outliers")
+    validate_parser.add_argument("records", help="NDJSON file written with --sink")
+    validate_parser.add_argument("--outlier-threshold", type=float, default=3.5,
+                                 help="Robust z-score beyond which amounts are flagged as outliers (default: 3.5)")
+    validate_parser.set_defaults(func=validate)
+
+    regress_parser = subparsers.add_parser("regress", help="Compare the extractions of a corpus of bills with "
+                                                           "their expected values")
+    regress_parser.add_argument("paths", nargs="+", help="PDF files or glob patterns (e.g. 'tests/invoices/*.pdf')")
+    regress_parser.add_argument("--expected-dir", default="tests/expected",
+                                help="Directory of <filename>.exp expectations (default: tests/expected)")
+    regress_parser.add_argument("-w", "--workers", type=int, default=8,
+                                help="Number of concurrent workers (default: 8)")
+    regress_parser.add_argument("--abs-tol", type=float, default=0.005,
+                                help="Absolute tolerance for numeric fields (default: 0.005)")
+    regress_parser.add_argument("--rel-tol", type=float, default=0.0,
+                                help="Relative tolerance for numeric fields (default: 0)")
+    regress_parser.add_argument("--json", metavar="FILE", default=None, help="Write the per-field report to FILE")
+    regress_parser.add_argument("--junit", metavar="FILE", default=None, help="Write a JUnit XML report to FILE")
+    regress_parser.add_argument("--baseline", metavar="FILE", default=None,
+                                help="Earlier --json report: only fail on fields which matched in it")
+    _add_processor_args(regress_parser)
+    regress_parser.set_defaults(func=regress)
+
+    cache_parser = subparsers.add_parser("cache", help="Cache maintenance")
+    cache_subparsers = cache_parser.add_subparsers(dest="cache_command", required=True)
+    migrate_parser = cache_subparsers.add_parser("migrate", help="Import legacy JSON sidecars into the cache index")
+    migrate_parser.add_argument("--output-dir", default="./output", help="Cache directory (default: ./output)")
+    migrate_parser.add_argument("--source-dir", default=None,
+                                help="Directory holding the sidecars (default: the cache directory)")
+    migrate_parser.set_defaults(func=cache_migrate)
+
+    stats_parser = cache_subparsers.add_parser("stats", help="Print entries, sizes and hits per stage and model")
+    stats_parser.add_argument("--output-dir", default="./output", help="Cache directory (default: ./output)")
+    stats_parser.set_defaults(func=cache_stats)
+
+    prune_parser = cache_subparsers.add_parser("prune", help="Drop expired entries and evict down to the size limits")
+    prune_parser.add_argument("--output-dir", default="./output", help="Cache directory (default: ./output)")
+    prune_parser.add_argument("--vacuum", action="store_true",
+                              help="Compact the index file afterwards, returning the freed space to the file system")
+    _add_cache_policy_args(prune_parser)
+    prune_parser.set_defaults(func=cache_prune)
+
+    invalidate_parser = cache_subparsers.add_parser("invalidate", help="Delete cache entries, e.g. of an old model")
+    invalidate_parser.add_argument("--output-dir", default="./output", help="Cache directory (default: ./output)")
+    invalidate_parser.add_argument("--model", default=None, help="Only entries produced by this model version")
+    invalidate_parser.add_argument("--stage", choices=[STAGE_PARSE, STAGE_EXTRACT], default=None,
+                                   help="Only entries of this stage")
+    invalidate_parser.add_argument("--older-than", type=float, default=None, metavar="SECONDS",
+                                   help="Only entries created more than SECONDS ago")
+    invalidate_parser.add_argument("--all", action="store_true", help="Delete every entry")
+    invalidate_parser.add_argument("--cache-store", default=None, metavar="URL",
+                                   help="Delete the matching entries of this shared store as well")
+    invalidate_parser.set_defaults(func=cache_invalidate)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    configure_logging(log_payloads=getattr(args, "log_payloads", False) or None)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
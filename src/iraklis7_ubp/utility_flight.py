@@ -0,0 +1,139 @@
+import os
+import hashlib
+import threading
+from concurrent.futures import Future
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+DEFAULT_LOCK_STRIPES = 256
+
+
+class Single_Flight(object):
+    # Coalesces concurrent calls by key: while a call for a key is in flight, further calls for the same
+    # key wait for it and share its result (or exception) instead of running their own.
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls = {}
+
+    def do(self, key, fn):
+        # Returns (result, shared), shared being True when the result came from another caller's call
+        with self.__lock:
+            future = self.__calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.__calls[key] = Future()
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+
+
+class Async_Single_Flight(object):
+    # asyncio counterpart of Single_Flight, for coroutines running on one event loop
+    def __init__(self):
+        self.__calls = {}
+
+    async def do(self, key, fn):
+        # fn is a coroutine function, called without arguments.
+        # asyncio is imported here, keeping it out of the synchronous processor's start-up
+        import asyncio
+        future = self.__calls.get(key)
+        if future is not None:
+            # shield: a cancelled waiter mustn't cancel the leader's call
+            return await asyncio.shield(future), True
+        future = self.__calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            # Only the leader was cancelled, waiting callers see a regular error
+            future.set_exception(RuntimeError("Coalesced call was cancelled"))
+            future.exception()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved, in case nobody else was waiting for it
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self.__calls[key]
+
+
+class File_Lock_Pool(object):
+    # Cross-process exclusive locks by key, using advisory locks on a fixed set of lock files in
+    # lock_dir. Keys are hashed onto `stripes` files, so the number of files stays bounded and
+    # unrelated keys only rarely contend for the same file.
+    def __init__(self, lock_dir, stripes=DEFAULT_LOCK_STRIPES):
+        os.makedirs(lock_dir, exist_ok=True)
+        self.__lock_dir = lock_dir
+        self.__stripes = stripes
+
+    def get_path(self, key):
+        digest = hashlib.blake2b(repr(key).encode("utf-8"), digest_size=8).digest()
+        return os.path.join(self.__lock_dir, str(int.from_bytes(digest, "big") % self.__stripes) + ".lock")
+
+    def lock(self, key):
+        return File_Lock(self.get_path(key))
+
+
+class File_Lock(object):
+    # Exclusive lock on a file, held while the context is active. acquire(blocking=False) only tries
+    # to take it, for callers which can't block a thread while waiting (see Async_Utility_Bill_Processor).
+    def __init__(self, path):
+        self.__path = path
+        self.__file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+    def acquire(self, blocking=True):
+        # Returns False when blocking is False and the lock is held elsewhere
+        self.__file = open(self.__path, "a+b")
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.__file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self.__file.seek(0)
+                msvcrt.locking(self.__file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        except OSError:
+            self.__file.close()
+            self.__file = None
+            if blocking:
+                raise
+            return False
+        except BaseException:
+            self.__file.close()
+            self.__file = None
+            raise
+        return True
+
+    def release(self):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.__file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.__file.seek(0)
+                msvcrt.locking(self.__file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.__file.close()
+            self.__file = None
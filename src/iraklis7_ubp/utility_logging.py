@@ -0,0 +1,116 @@
+import os
+import sys
+import atexit
+import logging
+import threading
+from queue import SimpleQueue
+from logging.handlers import QueueHandler, QueueListener
+
+LOGGER_NAME = "iraklis7_ubp"
+# Full ParseResponse / ExtractResponse dumps go to this child logger, which is silenced unless asked for
+PAYLOAD_LOGGER_NAME = LOGGER_NAME + ".payload"
+LOG_FILE = "iraklis7_ubp.log"
+LOG_FORMAT = '%(asctime)s | %(levelname)s | %(message)s'
+LOG_PAYLOADS_ENV = "UBP_LOG_PAYLOADS"
+
+_lock = threading.Lock()
+
+
+def get_logger(name=None):
+    # Package scoped logger, e.g. get_logger("cache") -> "iraklis7_ubp.cache"
+    if name is None:
+        return logging.getLogger(LOGGER_NAME)
+    return logging.getLogger(LOGGER_NAME + "." + name)
+
+
+def get_payload_logger():
+    return logging.getLogger(PAYLOAD_LOGGER_NAME)
+
+
+def set_log_payloads(enabled):
+    # Heavy payload dumps are only written (to the log file, at DEBUG) when enabled, for the whole process
+    get_payload_logger().setLevel(logging.DEBUG if enabled else logging.INFO)
+
+
+def is_logging_payloads(log_payloads=None):
+    # A processor's log_payloads (True or False), or the process-wide setting when None
+    if log_payloads is None:
+        return get_payload_logger().isEnabledFor(logging.DEBUG)
+    return log_payloads
+
+
+def log_payload(log_payloads, msg, *args):
+    # Log a payload dump if is_logging_payloads(log_payloads). Handed to the payload logger's handlers
+    # directly, so that a processor can log payloads the process-wide setting leaves out.
+    if not is_logging_payloads(log_payloads):
+        return
+    logger = get_payload_logger()
+    logger.handle(logger.makeRecord(logger.name, logging.DEBUG, "", 0, msg, args, None))
+
+
+def _get_queue_handler(logger):
+    # Looked up by name rather than kept in a module global, so that the package imported under two
+    # names (e.g. "iraklis7_ubp" and "src.iraklis7_ubp") still shares a single set of handlers
+    for handler in logger.handlers:
+        if handler.get_name() == LOGGER_NAME:
+            return handler
+    return None
+
+
+def configure_logging(log_file=LOG_FILE, log_payloads=None):
+    # Set up the package logger for an application, such as the CLI. Importing or using the package
+    # doesn't configure logging: records go wherever the application's logging sends them.
+    # Here, records are handed to a queue and written by a background listener thread, so callers never
+    # block on console or disk I/O. Console output goes to stderr, keeping stdout free for results
+    # (e.g. the CLI's JSON lines), and everything goes to log_file unless it is None.
+    # Calling it again returns the same logger without adding handlers.
+    logger = get_logger()
+    with _lock:
+        if log_payloads is not None:
+            set_log_payloads(log_payloads)
+        if _get_queue_handler(logger) is not None:
+            return logger
+
+        formatter = logging.Formatter(LOG_FORMAT)
+        stderr_handler = logging.StreamHandler(sys.stderr)
+        stderr_handler.setLevel(logging.INFO)
+        stderr_handler.setFormatter(formatter)
+        handlers = [stderr_handler]
+        if log_file:
+            file_handler = logging.FileHandler(log_file, encoding="utf-8", delay=True)
+            file_handler.setLevel(logging.DEBUG)
+            file_handler.setFormatter(formatter)
+            handlers.append(file_handler)
+
+        queue = SimpleQueue()
+        queue_handler = QueueHandler(queue)
+        queue_handler.set_name(LOGGER_NAME)
+        queue_handler.listener = QueueListener(queue, *handlers, respect_handler_level=True)
+        queue_handler.listener.start()
+
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(queue_handler)
+        # Handled here, don't duplicate records through the root logger's handlers
+        logger.propagate = False
+    return logger
+
+
+def shutdown_logging():
+    # Flush pending records, detach the handlers and restore the logger's defaults, configure_logging() can
+    # be called again afterwards
+    logger = get_logger()
+    with _lock:
+        queue_handler = _get_queue_handler(logger)
+        if queue_handler is None:
+            return
+        queue_handler.listener.stop()
+        for handler in queue_handler.listener.handlers:
+            handler.close()
+        logger.removeHandler(queue_handler)
+        logger.setLevel(logging.NOTSET)
+        logger.propagate = True
+
+
+atexit.register(shutdown_logging)
+# Payload dumps stay off, also when an application logs everything at DEBUG, unless UBP_LOG_PAYLOADS is set
+set_log_payloads(os.environ.get(LOG_PAYLOADS_ENV, "") not in ("", "0"))
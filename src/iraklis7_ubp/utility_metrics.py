@@ -0,0 +1,138 @@
+import time
+import threading
+
+METRICS_PREFIX = "ubp_"
+
+
+class _Null_Timer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_TIMER = _Null_Timer()
+
+
+class Null_Metrics(object):
+    # Metrics sink used when instrumentation is disabled: every call is a no-op
+    enabled = False
+
+    def timer(self, stage, **labels):
+        return _NULL_TIMER
+
+    def observe(self, stage, seconds, **labels):
+        pass
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+
+NULL_METRICS = Null_Metrics()
+
+
+class _Timer(object):
+    def __init__(self, metrics, stage, labels):
+        self.__metrics = metrics
+        self.__stage = stage
+        self.__labels = labels
+        self.__start = 0.0
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        labels = self.__labels
+        if exc_type is not None:
+            labels = dict(labels, error=exc_type.__name__)
+        self.__metrics.observe(self.__stage, time.perf_counter() - self.__start, **labels)
+        return False
+
+
+class Utility_Bill_Metrics(object):
+    # Thread-safe per-stage timers and counters.
+    # Stage timings are kept as count / sum / max per (stage, labels), counters per (name, labels).
+    # An optional callback(kind, name, value, labels) is called for every observation, with kind being
+    # "timer" or "counter", e.g. to forward them to statsd or a tracing system.
+    enabled = True
+
+    def __init__(self, callback=None):
+        self.__callback = callback
+        self.__lock = threading.Lock()
+        self.__timers = {}
+        self.__counters = {}
+
+    def timer(self, stage, **labels):
+        return _Timer(self, stage, labels)
+
+    def observe(self, stage, seconds, **labels):
+        key = (stage, tuple(sorted(labels.items())))
+        with self.__lock:
+            timer = self.__timers.get(key)
+            if timer is None:
+                self.__timers[key] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                if seconds > timer[2]:
+                    timer[2] = seconds
+        if self.__callback is not None:
+            self.__callback("timer", stage, seconds, labels)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+        if self.__callback is not None:
+            self.__callback("counter", name, value, labels)
+
+    def reset(self):
+        with self.__lock:
+            self.__timers = {}
+            self.__counters = {}
+
+    def snapshot(self):
+        # Plain dict copy of the current values, e.g. for JSON reports
+        with self.__lock:
+            timers = [dict(stage=stage, labels=dict(labels), count=t[0], sum_s=t[1], max_s=t[2])
+                      for (stage, labels), t in sorted(self.__timers.items())]
+            counters = [dict(name=name, labels=dict(labels), value=value)
+                        for (name, labels), value in sorted(self.__counters.items())]
+        return dict(timers=timers, counters=counters)
+
+    def get_counter(self, name, **labels):
+        with self.__lock:
+            return self.__counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def to_openmetrics(self):
+        # OpenMetrics / Prometheus text exposition of the current values
+        def format_labels(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join(k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"'
+                                  for k, v in labels) + "}"
+
+        with self.__lock:
+            timers = sorted(self.__timers.items())
+            counters = sorted(self.__counters.items())
+
+        lines = []
+        name = METRICS_PREFIX + "stage_seconds"
+        if timers:
+            lines.append("# TYPE " + name + " summary")
+            lines.append("# HELP " + name + " Time spent per processing stage.")
+            for (stage, labels), (count, total, _) in timers:
+                stage_labels = format_labels((("stage", stage),) + labels)
+                lines.append(name + "_count" + stage_labels + " " + str(count))
+                lines.append(name + "_sum" + stage_labels + " " + repr(total))
+        seen = set()
+        for (counter, labels), value in counters:
+            name = METRICS_PREFIX + counter
+            if name not in seen:
+                seen.add(name)
+                lines.append("# TYPE " + name + " counter")
+            lines.append(name + "_total" + format_labels(labels) + " " + str(value))
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,96 @@
+import io
+from concurrent.futures import ProcessPoolExecutor
+from .utility_cache import DEFAULT_DIGEST_ALGORITHM, STAGE_PARSE, digest_bytes, get_response_type
+
+# Markdown of consecutive pages is joined with this separator in the merged parse response
+PAGE_SEPARATOR = "\n\n"
+
+
+def split_pdf(input_path):
+    # Split a PDF into single-page PDF documents, returned as bytes. Requires pypdf.
+    # pypdf writes the same bytes for the same page, so unchanged pages keep their digest from one run to the next.
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError as e:
+        raise ImportError("Page splitting requires pypdf, install it with: pip install pypdf") from e
+    pages = []
+    for page in PdfReader(input_path).pages:
+        writer = PdfWriter()
+        writer.add_page(page)
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        pages.append(buffer.getvalue())
+    return pages
+
+
+def split_and_digest(split, input_path, algorithm=DEFAULT_DIGEST_ALGORITHM):
+    # Runs in a worker process: the pages of input_path as (digest, bytes) pairs
+    return [(digest_bytes(page, algorithm), page) for page in split(input_path)]
+
+
+class Page_Splitter(object):
+    # Splits documents into pages and hashes them in a pool of worker processes, keeping the CPU bound
+    # PDF work off the threads that wait on the ADE API. split is a picklable function returning the
+    # pages of a document as bytes (split_pdf by default).
+    def __init__(self, max_workers=None, split=split_pdf, digest_algorithm=DEFAULT_DIGEST_ALGORITHM):
+        self.__split = split
+        self.__digest_algorithm = digest_algorithm
+        self.__executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def submit(self, input_path):
+        # Future of the list of (digest, bytes) pages of input_path
+        return self.__executor.submit(split_and_digest, self.__split, str(input_path), self.__digest_algorithm)
+
+    def split(self, input_path):
+        return self.submit(input_path).result()
+
+    def close(self):
+        self.__executor.shutdown()
+
+
+def merge_page_responses(responses, filename):
+    # Combine the parse responses of single pages (in page order) into the response for the whole
+    # document: markdown joined, chunks / splits / grounding renumbered to their page in the document,
+    # and usage metadata summed.
+    chunks = []
+    splits = []
+    grounding = {}
+    failed_pages = []
+    job_ids = []
+    for page, response in enumerate(responses):
+        for chunk in response.chunks:
+            chunk = chunk.model_dump(by_alias=True)
+            chunk["grounding"]["page"] = page
+            chunks.append(chunk)
+        for split in response.splits:
+            split = split.model_dump(by_alias=True)
+            split["pages"] = [page] * len(split["pages"])
+            splits.append(split)
+        for chunk_id, box in (response.grounding or {}).items():
+            box = box.model_dump(by_alias=True, exclude_none=True)
+            box["page"] = page
+            grounding[chunk_id] = box
+        if response.metadata.failed_pages:
+            failed_pages.append(page)
+        if response.metadata.job_id not in job_ids:
+            job_ids.append(response.metadata.job_id)
+    metadata = responses[0].metadata
+    return get_response_type(STAGE_PARSE).model_validate(dict(
+        markdown=PAGE_SEPARATOR.join(response.markdown for response in responses),
+        chunks=chunks,
+        splits=splits,
+        grounding=grounding or None,
+        metadata=dict(credit_usage=sum(response.metadata.credit_usage for response in responses),
+                      duration_ms=sum(response.metadata.duration_ms for response in responses),
+                      filename=filename,
+                      job_id=",".join(job_ids),
+                      org_id=metadata.org_id,
+                      page_count=len(responses),
+                      version=metadata.version,
+                      failed_pages=failed_pages or None)))
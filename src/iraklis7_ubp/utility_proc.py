@@ -1,215 +1,350 @@
 import os
-import json
-import logging
-import sys
+import glob
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import TYPE_CHECKING
 from pathlib import Path
-from landingai_ade import LandingAIADE
-from landingai_ade.lib import pydantic_to_json_schema
-from landingai_ade.types.parse_response import ParseResponse
-from landingai_ade.types.extract_response import ExtractResponse
-from . import utility_model
+from .utility_cache import (Utility_Bill_Cache, DEFAULT_PARSE_MODEL, DEFAULT_EXTRACT_MODEL, STAGE_PARSE,
+                            STAGE_EXTRACT, digest_text, digest_schema)
+from .utility_flight import Single_Flight, File_Lock_Pool
+from .utility_metrics import NULL_METRICS
+from .utility_logging import get_logger, log_payload
+from .utility_transport import ADE_Transport, get_shared_http_client
+from .utility_pages import merge_page_responses
+
+# landingai_ade, pydantic and the bill models are slow to import: they are imported on first use,
+# so that short-lived processes and cache-only runs start quickly
+if TYPE_CHECKING:
+    from landingai_ade.types.parse_response import ParseResponse
+    from landingai_ade.types.extract_response import ExtractResponse
+
+# Pages of one document sent to the ADE parse API concurrently
+MAX_PAGE_CALLS = 4
+
+
+class Offline_Error(Exception):
+    # Raised on a cache miss by a processor in offline mode, instead of calling the ADE API
+    pass
+
+
+def expand_paths(paths):
+    # Accept a single glob pattern / path, or an iterable of patterns / paths
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    for path in paths:
+        path = str(path)
+        if glob.has_magic(path):
+            yield from sorted(glob.iglob(path))
+        else:
+            yield path
+
+
+class Utility_Bill_Result(object):
+    def __init__(self, input_path, parse_response=None, extract_response=None, error=None, bill_type=None,
+                 file_digest=None):
+        self.input_path = input_path
+        self.filename = os.path.basename(input_path)
+        self.parse_response = parse_response
+        self.extract_response = extract_response
+        self.error = error
+        # utility_model class the bill was classified as
+        self.bill_type = bill_type
+        # Content digest of the input file, as used for the cache
+        self.file_digest = file_digest
+        # Writing the result to the processor's sink failed: the bill itself was processed
+        self.sink_error = None
+
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        status = "ok" if self.ok() else "error: " + str(self.error)
+        return "Utility_Bill_Result(" + self.filename + ", " + status + ")"
 
 
 class Utility_Bill_Processor(object):
-    def __init__(self, env="eu", output_dir="./output", use_cache=False):
+    def __init__(self, env="eu", output_dir="./output", use_cache=False,
+                 parse_model=DEFAULT_PARSE_MODEL, extract_model=DEFAULT_EXTRACT_MODEL, strict_cache=False,
+                 local_extraction=False, ade_client=None, metrics=None, log_payloads=None, sink=None,
+                 retry_policy=None, rate_limiter=None, circuit_breaker=None, lock_dir=None, cache_policy=None,
+                 page_splitter=None, offline=False, cache_store=None):
         self.__output_dir = output_dir
-        self.__use_cache = use_cache
-        self.__filename = ""
-        # Create output directory if it doesn't exist
-        self.__create_dir_if_not_exists(self.__output_dir)
-
-        # Initialize ADE client
-        self.__ade_client = LandingAIADE(
-            apikey=os.environ.get("VISION_AGENT_API_KEY"),
-            environment=env
-        )
-
-        # Set up logging
-        self.__logger = logging.getLogger()
-        self.__logger.setLevel(logging.DEBUG)
-        self.__formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s')
-
-        self.__stdout_handler = logging.StreamHandler(sys.stdout)
-        self.__stdout_handler.setLevel(logging.INFO)
-        self.__stdout_handler.setFormatter(self.__formatter)
-        self.__file_handler = logging.FileHandler('iraklis7_ubp.log')
-        self.__file_handler.setLevel(logging.DEBUG)
-        self.__file_handler.setFormatter(self.__formatter)
-
-        self.__logger.addHandler(self.__file_handler)
-        self.__logger.addHandler(self.__stdout_handler)
+        # Offline processors only use the cache, and never create an ADE client
+        self.__offline = offline
+        self.__use_cache = use_cache or offline
+        self.__parse_model = parse_model
+        self.__extract_model = extract_model
+        # The last parsed filename is kept per thread, so that get_filename() stays meaningful
+        # when the processor is shared between threads.
+        self.__local = threading.local()
+
+        # Logging is left to the application (see configure_logging). Full response dumps are logged if
+        # log_payloads is set, or, when it's None, if they are enabled for the process.
+        self.__logger = get_logger()
+        self.__log_payloads = log_payloads
+
+        # Per-stage timers and counters, a no-op unless a Utility_Bill_Metrics is given
+        self.__metrics = metrics if metrics is not None else NULL_METRICS
+
+        # The output directory is created on first use. cache_policy (a Cache_Policy) bounds the cache's size and age.
+        # cache_store (a utility_store.Cache_Store) shares cached responses with processors on other hosts.
+        self.__cache = Utility_Bill_Cache(self.__output_dir, self.__logger, strict=strict_cache,
+                                          metrics=self.__metrics, policy=cache_policy,
+                                          store=cache_store, log_payloads=log_payloads)
+
+        # Optional rule based extraction for known issuers, falling back to the ADE extract API
+        self.__local_extractor = None
+        if local_extraction:
+            from .utility_rules import Local_Extractor
+            self.__local_extractor = Local_Extractor(self.__logger)
+
+        # Concurrent requests for the same content share one ADE call. With lock_dir, processes using the
+        # same cache directory are coordinated as well: they wait for each other and then find the result
+        # in the cache.
+        self.__flights = Single_Flight()
+        self.__file_locks = File_Lock_Pool(lock_dir) if lock_dir is not None else None
+
+        # Optional Utility_Bill_Sink, receiving a record for every successfully processed bill
+        self.__sink = sink
+
+        # With a Page_Splitter, multi-page documents are parsed page by page: pages already in the cache
+        # (e.g. the unchanged pages of a recurring statement) aren't sent to the ADE API again
+        self.__page_splitter = page_splitter
+
+        # The ADE client is created on the first API call, unless one (e.g. a stand-in for testing) is given.
+        # Retries with backoff (retry_policy, a Retry_Policy by default), optional rate limiting
+        # (a Token_Bucket or Shared_Token_Bucket) and an optional Circuit_Breaker
+        self.__env = env
+        self.__given_ade_client = ade_client
+        self.__transport_args = dict(retry_policy=retry_policy, rate_limiter=rate_limiter,
+                                     circuit_breaker=circuit_breaker, metrics=self.__metrics)
+        self.__ade_client = None
+        self.__ade_client_lock = threading.Lock()
+
+    def __get_ade_client(self):
+        if self.__ade_client is None:
+            with self.__ade_client_lock:
+                if self.__ade_client is None:
+                    ade_client = self.__given_ade_client
+                    if ade_client is None:
+                        from landingai_ade import LandingAIADE
+                        # Connections are pooled across processors, and retries are left to the transport layer
+                        ade_client = LandingAIADE(
+                            apikey=os.environ.get("VISION_AGENT_API_KEY"),
+                            environment=self.__env,
+                            http_client=get_shared_http_client(),
+                            max_retries=0
+                        )
+                    self.__ade_client = ADE_Transport(ade_client, **self.__transport_args)
+        return self.__ade_client
 
     def get_filename(self):
-        return self.__filename
+        return getattr(self.__local, "filename", "")
 
-    def __read_file(self, input_path):
-        try:
-            self.__logger.debug("Reading file: " + str(input_path))
-            with open(input_path, 'r') as file:
-                content = json.load(file)
-                self.__logger.debug("File contents: " + str(content))
-                file.close()
-                return content
-        except FileNotFoundError as e:
-            print(str(e))
-            raise
-
-    def __create_dir_if_not_exists(self, path):
-        try:
-            Path(path).mkdir(parents=True, exist_ok=True)
-        except OSError as e:
-            self.__logger.error("Creation of the directory " + path + " failed: " + str(e))
-            raise
+    def close(self):
+        self.__cache.close()
+        if self.__sink is not None:
+            self.__sink.flush()
 
-    def __write_file(self, output_path, content):
-        try:
-            self.__logger.debug("Writing file: " + str(output_path))
-            self.__logger.debug("File contents: " + str(content))
-            with open(output_path, 'w', encoding='utf-8') as file:
-                json.dump(content, file, ensure_ascii=False, indent=4)
-                file.close()
-        except OSError as e:
-            self.__logger.error("Error writing to file " + str(output_path) + ": " + str(e))
-            raise
-
-    def __get_file_md5(self, input_path):
-        import hashlib
-
-        hash_md5 = hashlib.md5()
-        try:
-            with open(input_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-            result = hash_md5.hexdigest()
-            self.__logger.debug("Computed MD5 for file " + str(input_path) + ": " + result)
-            return result
-        except FileNotFoundError as e:
-            self.__logger.error("Error computing MD5: " + str(e))
-            raise
+    def get_metrics(self):
+        return self.__metrics
 
-    def parse(self, input_path)->ParseResponse:
+    def get_local_extraction_stats(self):
+        # Hits / fallbacks of the local extraction engine, None when it is disabled
+        if self.__local_extractor is None:
+            return None
+        return self.__local_extractor.get_stats()
+
+    def parse(self, input_path)->"ParseResponse":
+        with self.__metrics.timer("parse"):
+            return self.__parse(input_path, self.__cache.get_file_digest(input_path))
+
+    def __parse(self, input_path, file_digest):
         # Store filename
-        self.__filename = os.path.basename(input_path)
+        filename = os.path.basename(input_path)
+        self.__local.filename = filename
 
         response = None
         if(self.__use_cache):
-            try:
-                self.__logger.info("use_cache is enabled. Checking cache validity.")
-                # Check to see if cache is dirty
-                pout = Path(self.__output_dir + "/" + self.__filename + ".md5.json")
-                self.__logger.debug("Retrieving cache MD5 for : " + str(pout))
-                cached_md5 = self.__read_file(pout)
-                actual_md5 = self.__get_file_md5(input_path)
-                
-                self.__logger.debug("Input file MD5: " + actual_md5)
-                self.__logger.debug("Cached MD5: " + cached_md5['md5'])
-
-                if(cached_md5['md5'] != actual_md5):
-                    self.__logger.info("Cache is dirty. Will try to fetch fresh results.")
-                    raise Exception("Cache is dirty")
-                else:
-                    self.__logger.info("Cache is valid, will read parse results from cache.")
-
-                # If use_cache is True, read from cached markdown file
-                pout = Path(self.__output_dir + "/" + self.__filename + ".parse.json")
-                self.__logger.info("Using parse results from cache: " + str(pout))
-                json_s = self.__read_file(pout)
-                response = ParseResponse(**json_s)
-                self.__logger.debug("Parse response from cache: " + str(response))
-            except Exception as e:
-                self.__logger.info("Cache miss: " + str(e))                
+            response = self.__cache.get_parse(file_digest, self.__parse_model, input_path)
         if(self.__use_cache is False or response is None):
+            if self.__offline:
+                raise Offline_Error("No cached parse results for " + filename + " (offline)")
             try:
                 self.__logger.info("use_cache is disabled or cache miss. Calling ADE parse API.")
-                # ADE Client to Parse Utility bills and produce markdown
-                response = self.__ade_client.parse(
-                    # use document= for local files, document_url= for remote URLs
-                    document=Path(input_path),
-                    model="dpt-2-latest",
-                )
-                self.__logger.debug("Parse response from LandingAI ADE: " + str(response))
-
-                # Write MD5 to file
-                pout = Path(self.__output_dir + "/" + self.__filename + ".md5.json")
-                actual_md5 = self.__get_file_md5(input_path)
-                md5 = dict(md5=actual_md5)
-                # Write MD5 to file
-                self.__logger.debug("Writing MD5: " + actual_md5 + " to cache file: " + str(pout))
-                self.__write_file(pout, md5)
-                # Write parse response to file
-                pout = Path(self.__output_dir + "/" + self.__filename + ".parse.json")
-                self.__logger.debug("Writing parse response to file: " + str(pout))
-                self.__write_file(pout, response)
+                response = self.__coalesce(
+                    (STAGE_PARSE, file_digest, self.__parse_model),
+                    lambda: self.__parse_document(input_path, file_digest),
+                    lambda: self.__cache.get_parse(file_digest, self.__parse_model))
             except Exception as e:
-                self.__logger.error("Communication with the ADE server failed: " + str(e))
+                self.__logger.error("Communication with the ADE server failed: %s", e)
                 raise
-    
+
+        return response
+
+    def __coalesce(self, key, call, lookup):
+        # Run call() once for all concurrent requests with the same key. lookup() checks the cache for
+        # the result of the same call made by another process, once its lock is held.
+        response, shared = self.__flights.do(key, lambda: self.__call_locked(key, call, lookup))
+        if shared:
+            self.__logger.info("Shared the in-flight ADE %s call of an identical request.", key[0])
+            self.__metrics.inc("coalesced_calls", stage=key[0])
+        return response
+
+    def __call_locked(self, key, call, lookup):
+        if self.__file_locks is None:
+            return call()
+        with self.__file_locks.lock(key):
+            if self.__use_cache:
+                response = lookup()
+                if response is not None:
+                    self.__metrics.inc("coalesced_calls", stage=key[0])
+                    return response
+            return call()
+
+    def __parse_document(self, input_path, file_digest):
+        if self.__page_splitter is None:
+            return self.__call_parse(Path(input_path), file_digest)
+        with self.__metrics.timer("split"):
+            pages = self.__page_splitter.split(input_path)
+        if len(pages) < 2:
+            return self.__call_parse(Path(input_path), file_digest)
+        filename = os.path.basename(input_path)
+        with ThreadPoolExecutor(max_workers=min(len(pages), MAX_PAGE_CALLS), thread_name_prefix="ubp-page") as executor:
+            responses = list(executor.map(lambda page: self.__parse_page(filename, *page), enumerate(pages)))
+        response = merge_page_responses(responses, filename)
+        self.__cache.put_parse(file_digest, response, self.__parse_model)
         return response
 
+    def __parse_page(self, filename, number, page):
+        page_digest, data = page
+        response = None
+        if self.__use_cache:
+            response = self.__cache.get_parse(page_digest, self.__parse_model)
+        if response is not None:
+            self.__metrics.inc("pages", source="cache")
+            return response
+        self.__metrics.inc("pages", source="api")
+        # Coalesced within the process only: the document's lock is already held, and a page's lock
+        # could map onto the same lock file
+        response, shared = self.__flights.do(
+            (STAGE_PARSE, page_digest, self.__parse_model),
+            lambda: self.__call_parse((filename + ".page" + str(number + 1) + ".pdf", data), page_digest))
+        return response
+
+    def __call_parse(self, document, file_digest):
+        # ADE Client to Parse Utility bills and produce markdown.
+        # document is a Path, or a (filename, bytes) pair for a single page
+        with self.__metrics.timer("api", endpoint="parse"):
+            response = self.__get_ade_client().parse(
+                # use document= for local files, document_url= for remote URLs
+                document=document,
+                model=self.__parse_model,
+            )
+        log_payload(self.__log_payloads, "Parse response from LandingAI ADE: %s", response)
+        # Written before the call is marked complete, so that requests queued behind it find it in the cache
+        self.__cache.put_parse(file_digest, response, self.__parse_model)
+        return response
+
+    def get_bill_type(self, markdown):
+        from . import utility_schema
+        with self.__metrics.timer("schema"):
+            return utility_schema.get_bill_type(markdown)
+
     def get_schema(self, markdown):
-        bill_type = None
-        if "ΠΡΟΜΗΘΕΙΑ ΦΥΣΙΚΟΥ ΑΕΡΙΟΥ" in markdown:
-            bill_type = utility_model.Utility_Bill_Gas
-        elif "ΛΟΓΑΡΙΑΣΜΟΣ ΗΛΕΚΤΡΙΚΟΥ ΡΕΥΜΑΤΟΣ" in markdown:
-            bill_type = utility_model.Utility_Bill_Power
-        elif "Ύδρευσης" in markdown:
-            bill_type = utility_model.Utility_Bill_Water
-        else:
-            bill_type = utility_model.Utility_Bill
-            self.__logger.warning("Unrecognized utility bill type. Defaulting to base Utility_Bill schema.")
-        self.__logger.info("Determined bill type schema: " + str(bill_type))
-        return pydantic_to_json_schema(bill_type)
+        return self.__get_model_schema(self.get_bill_type(markdown))
 
-    def extract(self, markdown, schema):
+    def __get_model_schema(self, bill_type):
+        from . import utility_schema
+        return utility_schema.get_model_schema(bill_type)
+
+    def extract(self, markdown, schema, filename=None)->"ExtractResponse":
+        with self.__metrics.timer("extract"):
+            return self.__extract(markdown, schema, filename)
+
+    def __extract(self, markdown, schema, filename):
         # Use with the SDK
         # Convert markdown to structured data
+        # Results are cached by markdown and schema content, filename is only used for logging
+        if filename is None:
+            filename = self.get_filename()
+        if self.__local_extractor is not None:
+            with self.__metrics.timer("local_extract"):
+                values = self.__local_extractor.extract(markdown, schema)
+            if values is not None:
+                from .utility_rules import build_extract_response
+                return build_extract_response(values, filename)
         response = None
         if(self.__use_cache):
-            try:
-                self.__logger.info("use_cache is enabled. Checking cache validity.")
-                # Check to see if cache is dirty
-                pout = Path(self.__output_dir + "/" + self.__filename + ".schema.json")
-                self.__logger.debug("Retrieving cached schema from : " + str(pout))
-                cached_schema = self.__read_file(pout)
-                actual_schema = json.loads(schema)
-
-                self.__logger.debug("Input file schema: " + schema)
-                self.__logger.debug("Cached schema: " + json.dumps(cached_schema)) 
-                
-                if(cached_schema != actual_schema):
-                    self.__logger.info("Cache is dirty. Will try to fetch fresh results.")
-                    raise Exception("Cache is dirty")
-                else:
-                    self.__logger.info("Cache is valid, will read extract results from cache.")
-                # If use_cache is True, read from cached markdown file
-                pout = Path(self.__output_dir + "/" + self.__filename + ".extract.json")
-                self.__logger.info("Using extract results from cache: " + str(pout))
-                json_s = self.__read_file(pout)
-                response = ExtractResponse(**json_s)
-                self.__logger.debug("Extract response from cache: " + str(response))
-            except Exception as e:
-                self.__logger.info("Cache miss: " + str(e))                
+            self.__logger.info("Checking extract cache for file: %s", filename)
+            response = self.__cache.get_extract(markdown, schema, self.__extract_model)
         if(self.__use_cache is False or response is None):
+            if self.__offline:
+                raise Offline_Error("No cached extract results for " + filename + " (offline)")
             try:
-                self.__logger.info("use_cache is disabled or cache miss. Calling ADE parse API.")
-                response = self.__ade_client.extract(
-                    schema=schema,
-                    # use markdown= for local files, markdown_url= for remote URLs
-                    markdown=markdown,
-                    model="extract-latest"
-                )
-                self.__logger.debug("Extract response from LandingAI ADE: " + str(response))
-
-                # Write schema to file.
-                pout = Path(self.__output_dir + "/" + self.__filename + ".schema.json")
-                self.__logger.debug("Writing schema: " + schema + " to cache file: " + str(pout))
-                self.__write_file(pout, json.loads(schema))
-                # Write extract response to file.
-                pout = Path(self.__output_dir + "/" + self.__filename + ".extract.json")
-                self.__logger.debug("Writing extract response to cache file: " + str(pout))
-                self.__write_file(pout, response)
+                self.__logger.info("use_cache is disabled or cache miss. Calling ADE extract API.")
+                response = self.__coalesce(
+                    (STAGE_EXTRACT, digest_text(markdown), digest_schema(schema), self.__extract_model),
+                    lambda: self.__call_extract(markdown, schema),
+                    lambda: self.__cache.get_extract(markdown, schema, self.__extract_model))
             except Exception as e:
-                self.__logger.error("Communication with the ADE server failed: " + str(e))
+                self.__logger.error("Communication with the ADE server failed: %s", e)
                 raise
 
         return response
+
+    def __call_extract(self, markdown, schema):
+        with self.__metrics.timer("api", endpoint="extract"):
+            response = self.__get_ade_client().extract(
+                schema=schema,
+                # use markdown= for local files, markdown_url= for remote URLs
+                markdown=markdown,
+                model=self.__extract_model
+            )
+        log_payload(self.__log_payloads, "Extract response from LandingAI ADE: %s", response)
+        self.__cache.put_extract(markdown, schema, response, self.__extract_model)
+        return response
+
+    def process(self, input_path) -> Utility_Bill_Result:
+        # Run the full parse -> get_schema -> extract pipeline for a single file.
+        # Errors are captured in the result, so that a batch doesn't stop on a single bill.
+        result = Utility_Bill_Result(input_path)
+        try:
+            with self.__metrics.timer("parse"):
+                result.file_digest = self.__cache.get_file_digest(input_path)
+                result.parse_response = self.__parse(input_path, result.file_digest)
+            result.bill_type = self.get_bill_type(result.parse_response.markdown)
+            schema = self.__get_model_schema(result.bill_type)
+            result.extract_response = self.extract(result.parse_response.markdown, schema,
+                                                   filename=result.filename)
+        except Exception as e:
+            self.__logger.error("Processing of file %s failed: %s", input_path, e)
+            result.error = e
+            return result
+        if self.__sink is not None:
+            try:
+                self.__sink.write(result)
+            except Exception as e:
+                self.__logger.error("Writing the result of %s to the sink failed: %s", input_path, e)
+                result.sink_error = e
+        return result
+
+    def process_many(self, paths, max_workers=4):
+        # Process many files concurrently and yield a Utility_Bill_Result for each, as it completes.
+        # Submission is bounded, so that only a small window of files is queued at any time,
+        # no matter how large the input iterable is.
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1, got " + str(max_workers))
+        max_pending = max_workers * 2
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ubp") as executor:
+            pending = set()
+            for path in expand_paths(paths):
+                pending.add(executor.submit(self.process, path))
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
@@ -0,0 +1,184 @@
+import os
+import ast
+import json
+import time
+from xml.etree import ElementTree
+from .utility_proc import expand_paths
+from .utility_batch import write_atomic, write_json_atomic
+from .utility_rules import NONE_PLACEHOLDER
+from .utility_logging import get_logger
+
+EXPECTATION_SUFFIXES = (".exp", ".exp.json")
+# Numbers are equal when they differ by at most abs_tol + rel_tol * |expected|
+DEFAULT_ABS_TOLERANCE = 0.005
+DEFAULT_REL_TOLERANCE = 0.0
+
+STATUS_PASSED = "passed"
+STATUS_FAILED = "failed"
+STATUS_ERROR = "error"
+STATUS_MISSING = "missing_expectations"
+
+_logger = get_logger()
+
+
+def load_expectations(path):
+    # Expected extraction of a bill: a Python dict literal (.exp) or JSON (.exp.json)
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    if path.endswith(".json"):
+        return json.loads(text)
+    return ast.literal_eval(text)
+
+
+def find_expectations(expected_dir, filename):
+    for suffix in EXPECTATION_SUFFIXES:
+        path = os.path.join(expected_dir, filename + suffix)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def compare_fields(actual, expected, abs_tol=DEFAULT_ABS_TOLERANCE, rel_tol=DEFAULT_REL_TOLERANCE):
+    # Per-field diff of an extraction against its expectations. None and NONE_PLACEHOLDER are
+    # equal (also to a field left out of the extraction), numbers are compared with the given tolerances
+    # and everything else exactly.
+    # Returns a list of dicts (field, expected, actual, status), status being match, mismatch,
+    # missing (expected but not extracted) or unexpected (extracted but not expected).
+    diffs = []
+    for field in list(expected) + [field for field in actual if field not in expected]:
+        if field not in actual:
+            # Extractions leave out fields without a value
+            status = "match" if expected[field] in (None, NONE_PLACEHOLDER) else "missing"
+            diffs.append(dict(field=field, expected=expected[field], actual=None, status=status))
+            continue
+        if field not in expected:
+            diffs.append(dict(field=field, expected=None, actual=actual[field], status="unexpected"))
+            continue
+        value = NONE_PLACEHOLDER if actual[field] is None else actual[field]
+        expected_value = NONE_PLACEHOLDER if expected[field] is None else expected[field]
+        if _is_number(value) and _is_number(expected_value):
+            match = abs(value - expected_value) <= abs_tol + rel_tol * abs(expected_value)
+        else:
+            match = value == expected_value
+        diffs.append(dict(field=field, expected=expected[field], actual=actual[field],
+                          status="match" if match else "mismatch"))
+    return diffs
+
+
+def find_regressions(report, baseline):
+    # Fields of report which fail but matched in baseline (an earlier report), and cases which
+    # passed in baseline but don't now: known failures of the baseline aren't regressions
+    baseline_cases = {case["file"]: case for case in baseline["cases"]}
+    regressions = []
+    for case in report["cases"]:
+        previous = baseline_cases.get(case["file"])
+        if previous is None or previous["status"] == STATUS_MISSING:
+            continue
+        if case["status"] == STATUS_ERROR and previous["status"] != STATUS_ERROR:
+            regressions.append(dict(file=case["file"], field=None, error=case["error"]))
+            continue
+        matched = {diff["field"] for diff in previous.get("diffs", []) if diff["status"] == "match"}
+        regressions.extend(dict(file=case["file"], field=diff["field"], expected=diff["expected"],
+                                actual=diff["actual"])
+                           for diff in case.get("diffs", []) if diff["status"] != "match" and diff["field"] in matched)
+    return regressions
+
+
+class Utility_Bill_Regression(object):
+    # Regression run of a corpus of bills against their expected extractions (<expected_dir>/<filename>.exp).
+    # Bills are processed concurrently by the given processor (typically from the cache, with use_cache or
+    # offline), and every bill's fields are diffed, so one run reports all differences at once.
+    def __init__(self, processor, expected_dir, abs_tol=DEFAULT_ABS_TOLERANCE, rel_tol=DEFAULT_REL_TOLERANCE):
+        self.__processor = processor
+        self.__expected_dir = expected_dir
+        self.__abs_tol = abs_tol
+        self.__rel_tol = rel_tol
+
+    def run(self, paths, max_workers=8):
+        # Returns the report: {"cases": [...], "summary": {...}}, cases in input order
+        start = time.perf_counter()
+        paths = list(expand_paths(paths))
+        order = {path: number for number, path in enumerate(paths)}
+        cases = [self.__check(result) for result in self.__processor.process_many(paths, max_workers=max_workers)]
+        cases.sort(key=lambda case: order[case["input_path"]])
+        for case in cases:
+            del case["input_path"]
+
+        compared = {os.path.basename(path) for path in paths}
+        unmatched = []
+        if os.path.isdir(self.__expected_dir):
+            for name in sorted(os.listdir(self.__expected_dir)):
+                for suffix in EXPECTATION_SUFFIXES:
+                    if name.endswith(suffix) and name[:-len(suffix)] not in compared:
+                        unmatched.append(name)
+        summary = dict(total=len(cases), elapsed_s=round(time.perf_counter() - start, 3),
+                       fields=sum(len(case["diffs"]) for case in cases),
+                       field_mismatches=sum(1 for case in cases for diff in case["diffs"] if diff["status"] != "match"),
+                       unmatched_expectations=unmatched,
+                       abs_tol=self.__abs_tol, rel_tol=self.__rel_tol)
+        for status in (STATUS_PASSED, STATUS_FAILED, STATUS_ERROR, STATUS_MISSING):
+            summary[status] = sum(1 for case in cases if case["status"] == status)
+        _logger.info("Regression run of %d bills: %d passed, %d failed, %d errors, %d without expectations",
+                     len(cases), summary[STATUS_PASSED], summary[STATUS_FAILED], summary[STATUS_ERROR],
+                     summary[STATUS_MISSING])
+        return dict(cases=cases, summary=summary)
+
+    def __check(self, result):
+        case = dict(input_path=result.input_path, file=result.filename,
+                    bill_class=result.bill_type.__name__ if result.bill_type is not None else None,
+                    status=STATUS_PASSED, diffs=[], error=None)
+        if not result.ok():
+            case["status"] = STATUS_ERROR
+            case["error"] = str(result.error)
+            return case
+        expected_path = find_expectations(self.__expected_dir, result.filename)
+        if expected_path is None:
+            case["status"] = STATUS_MISSING
+            return case
+        try:
+            expected = load_expectations(expected_path)
+        except (ValueError, SyntaxError) as e:
+            case["status"] = STATUS_ERROR
+            case["error"] = "Unreadable expectations " + expected_path + ": " + str(e)
+            return case
+        case["diffs"] = compare_fields(result.extract_response.extraction, expected, self.__abs_tol, self.__rel_tol)
+        if any(diff["status"] != "match" for diff in case["diffs"]):
+            case["status"] = STATUS_FAILED
+        return case
+
+
+def is_failure(report, baseline=None):
+    # Without a baseline any failed or erroneous bill fails the run, with one only regressions do
+    if baseline is not None:
+        return bool(find_regressions(report, baseline))
+    return report["summary"][STATUS_FAILED] > 0 or report["summary"][STATUS_ERROR] > 0
+
+
+def write_json_report(report, path):
+    write_json_atomic(path, report)
+
+
+def write_junit_report(report, path, suite_name="iraklis7_ubp.regression"):
+    # JUnit XML, one test case per bill, for CI systems
+    summary = report["summary"]
+    suite = ElementTree.Element("testsuite", name=suite_name, tests=str(summary["total"]),
+                                failures=str(summary[STATUS_FAILED]), errors=str(summary[STATUS_ERROR]),
+                                skipped=str(summary[STATUS_MISSING]), time=str(summary["elapsed_s"]))
+    for case in report["cases"]:
+        testcase = ElementTree.SubElement(suite, "testcase", classname=case["bill_class"] or "Utility_Bill",
+                                          name=case["file"])
+        if case["status"] == STATUS_FAILED:
+            mismatches = [diff for diff in case["diffs"] if diff["status"] != "match"]
+            failure = ElementTree.SubElement(testcase, "failure",
+                                             message=str(len(mismatches)) + " field(s) differ")
+            failure.text = "\n".join(diff["field"] + ": expected " + repr(diff["expected"]) + ", got "
+                                     + repr(diff["actual"]) + " (" + diff["status"] + ")" for diff in mismatches)
+        elif case["status"] == STATUS_ERROR:
+            ElementTree.SubElement(testcase, "error", message=case["error"])
+        elif case["status"] == STATUS_MISSING:
+            ElementTree.SubElement(testcase, "skipped", message="No expectations file")
+    write_atomic(path, ElementTree.tostring(suite, encoding="utf-8", xml_declaration=True))
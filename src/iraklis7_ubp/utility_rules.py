@@ -0,0 +1,317 @@
+import re
+import html
+import threading
+from pydantic import ValidationError
+from . import utility_model
+from . import utility_schema
+from .utility_cache import STAGE_EXTRACT, get_response_type
+from .utility_logging import get_logger
+
+# Placeholder the extraction schemas ask for, when a value doesn't exist on the bill
+NONE_PLACEHOLDER = "None"
+REDACTED_PLACEHOLDER = "[redacted]"
+LOCAL_EXTRACT_VERSION = "local-rules"
+
+_anchor_re = re.compile(r"<a id='[^']*'></a>")
+_cell_end_re = re.compile(r"</t[dh]>")
+_row_re = re.compile(r"</?tr>|<table[^>]*>|</table>")
+_tag_re = re.compile(r"<[^>]+>")
+_blank_re = re.compile(r"[ \t]*\n[ \t\n]*")
+_redacted_re = re.compile(r"^(?:\s*\[(?:redacted|illegible)\]\s*)+$")
+
+
+def normalize_markdown(markdown):
+    # Flatten ADE markdown to plain text: one chunk / table row per line, table cells separated by ' | '
+    text = _anchor_re.sub("\n", markdown)
+    text = _cell_end_re.sub(" | ", text)
+    text = _row_re.sub("\n", text)
+    text = _tag_re.sub("", text)
+    text = html.unescape(text)
+    return _blank_re.sub("\n", text)
+
+
+def to_float(value):
+    # Greek amounts use ',' as the decimal separator and '.' for thousands ("1.325,62")
+    value = value.strip().replace("€", "").strip()
+    if "," in value:
+        value = value.replace(".", "").replace(",", ".")
+    return float(value)
+
+
+def to_date(value):
+    # dd/mm/yyyy or dd/mm/yy -> YYYY-MM-DD
+    day, month, year = value.strip().split("/")
+    if len(year) == 2:
+        year = "20" + year
+    return year + "-" + month.zfill(2) + "-" + day.zfill(2)
+
+
+def to_text(value):
+    value = " ".join(value.split())
+    if _redacted_re.match(value):
+        return REDACTED_PLACEHOLDER
+    return value
+
+
+class Regex_Rule(object):
+    # Value of a capture group of the first match of pattern
+    def __init__(self, pattern, group=1, convert=to_text, flags=re.MULTILINE):
+        self.pattern = re.compile(pattern, flags)
+        self.group = group
+        self.convert = convert
+
+    def __call__(self, text):
+        match = self.pattern.search(text)
+        if match is None:
+            return None
+        return self.convert(match.group(self.group))
+
+
+class Sum_Rule(object):
+    # Sum of a capture group over all matches of the patterns. A leading '-' subtracts a pattern's matches.
+    # The first pattern must match at least once, so that e.g. a lone discount is never reported as a total.
+    def __init__(self, *patterns, convert=to_float, flags=re.MULTILINE):
+        self.patterns = [(re.compile(p[1:] if p.startswith("-") else p, flags), -1 if p.startswith("-") else 1)
+                         for p in patterns]
+        self.convert = convert
+
+    def __call__(self, text):
+        total = 0.0
+        for i, (pattern, sign) in enumerate(self.patterns):
+            matches = list(pattern.finditer(text))
+            if i == 0 and not matches:
+                return None
+            for match in matches:
+                total += sign * self.convert(match.group(1))
+        return round(total, 6)
+
+
+class Const_Rule(object):
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, text):
+        return self.value
+
+
+class Issuer_Rules(object):
+    # Extraction rules for the bills of one issuer and bill type.
+    # fields maps model fields to rules; optional fields which aren't found get the 'None' placeholder,
+    # and redactable fields (customer details) get the '[redacted]' placeholder.
+    def __init__(self, name, model, markers, fields, optional=(), redactable=()):
+        self.name = name
+        self.model = model
+        self.markers = markers
+        self.fields = fields
+        self.optional = frozenset(optional)
+        self.redactable = frozenset(redactable)
+
+    def matches(self, text):
+        return all(marker in text for marker in self.markers)
+
+    def extract(self, text):
+        # Returns (values, missing_required_fields)
+        values = {}
+        missing = []
+        for field in self.model.model_fields:
+            rule = self.fields.get(field)
+            value = None
+            if rule is not None:
+                try:
+                    value = rule(text)
+                except (ValueError, IndexError):
+                    value = None
+            if value is None:
+                if field in self.optional:
+                    value = NONE_PLACEHOLDER
+                elif field in self.redactable:
+                    value = REDACTED_PLACEHOLDER
+                else:
+                    missing.append(field)
+                    continue
+            values[field] = value
+        return values, missing
+
+    def validate(self, values):
+        # Validate against the pydantic model; the 'None' placeholder of optional fields is accepted
+        try:
+            self.model.model_validate(values)
+        except ValidationError as e:
+            errors = [err for err in e.errors()
+                      if not (err["loc"] and err["loc"][0] in self.optional
+                              and values.get(err["loc"][0]) == NONE_PLACEHOLDER)]
+            if errors:
+                return errors
+        return []
+
+
+def build_extract_response(values, filename=""):
+    # Wrap locally extracted values like an ADE extract response, so callers don't need to tell them apart
+    return get_response_type(STAGE_EXTRACT)(
+        extraction=values,
+        extraction_metadata={},
+        metadata=dict(credit_usage=0.0, duration_ms=0, filename=filename or "", job_id="local",
+                      version=LOCAL_EXTRACT_VERSION),
+    )
+
+
+_issuer_rules = []
+
+
+def register_issuer_rules(rules):
+    _issuer_rules.append(rules)
+
+
+def get_issuer_rules():
+    return list(_issuer_rules)
+
+
+class Local_Extractor(object):
+    # Schema-less extraction of known issuers' bills from the parse markdown.
+    # extract() returns the extracted values, or None when ADE extraction is needed instead.
+    def __init__(self, logger=None):
+        self.__logger = logger if logger is not None else get_logger()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__fallbacks = 0
+
+    def __count(self, hit):
+        with self.__lock:
+            if hit:
+                self.__hits += 1
+            else:
+                self.__fallbacks += 1
+
+    def get_stats(self):
+        with self.__lock:
+            total = self.__hits + self.__fallbacks
+            return dict(hits=self.__hits, fallbacks=self.__fallbacks,
+                        hit_ratio=(self.__hits / total) if total else 0.0)
+
+    def extract(self, markdown, schema=None):
+        text = normalize_markdown(markdown)
+        for rules in _issuer_rules:
+            if not rules.matches(text):
+                continue
+            # Only answer for the schema that was asked for
+            if schema is not None and schema != utility_schema.get_model_schema(rules.model):
+                continue
+            values, missing = rules.extract(text)
+            if missing:
+                self.__logger.info("Local extraction (%s) is missing fields: %s", rules.name, ", ".join(missing))
+                break
+            errors = rules.validate(values)
+            if errors:
+                self.__logger.info("Local extraction (%s) failed validation: %s", rules.name, errors)
+                break
+            self.__logger.info("Local extraction (%s) succeeded, skipping the ADE extract API.", rules.name)
+            self.__count(True)
+            return values
+        self.__count(False)
+        return None
+
+
+_date = r"(\d{2}/\d{2}/\d{2,4})"
+_amount = r"(-?[\d.]*\d,\d+|-?\d+(?:\.\d+)?)"
+_zenith = "Εταιρεία Προμήθειας Αερίου Θεσσαλονίκης Θεσσαλίας Μονοπρόσωπη Α.Ε."
+_zenith_customer = dict(
+    customer_name=Regex_Rule(r"ΠΕΛΑΤΩΝ.*?Τ\.Κ\. \d{5}\n?(.+?) ?ήτου", flags=re.DOTALL),
+    customer_vat_number=Regex_Rule(r"ήτου.*?Α\.Φ\.Μ\. ?(\[\w+\]|\d{9})", flags=re.DOTALL),
+)
+
+register_issuer_rules(Issuer_Rules(
+    name="ZeniΘ natural gas",
+    model=utility_model.Utility_Bill_Gas,
+    markers=(_zenith, "ΠΡΟΜΗΘΕΙΑ ΦΥΣΙΚΟΥ ΑΕΡΙΟΥ"),
+    fields=dict(
+        _zenith_customer,
+        issuer_name=Const_Rule(_zenith),
+        document_number=Regex_Rule(r"ΗΜ\. ΕΚΔΟΣΗΣ \| ΑΡ\. ΕΓΓΡΑΦΟΥ \|.*\n\d{2}/\d{2}/\d{4} \| ([^|]+?) \|"),
+        customer_id_number=Regex_Rule(r"ΗΚΑΣΠ \| ΚΩΔ\. ΠΕΛΑΤΗ \| ΜΕΤΡΗΤΗΣ \|.*\n[^|]*\| ([^|]+?) \|"),
+        customer_meter_number=Regex_Rule(r"ΗΚΑΣΠ \| ΚΩΔ\. ΠΕΛΑΤΗ \| ΜΕΤΡΗΤΗΣ \|.*\n[^|]*\|[^|]*\| ([^|]+?) \|"),
+        bill_type=Regex_Rule(r"ΤΥΠΟΣ ΛΟΓΑΡΙΑΣΜΟΥ \| (Έναντι|Εκκαθαριστικός)"),
+        bill_pub_date=Regex_Rule(r"ΗΜ\. ΕΚΔΟΣΗΣ \| ΑΡ\. ΕΓΓΡΑΦΟΥ \|.*\n" + _date + " \\|", convert=to_date),
+        bill_period_start=Regex_Rule(r"ΑΠΟ \| " + _date + r" \| ΕΩΣ", convert=to_date),
+        bill_period_end=Regex_Rule(r"ΑΠΟ \| \d{2}/\d{2}/\d{4} \| ΕΩΣ " + _date, convert=to_date),
+        bill_due_date=Regex_Rule(r"Πληρωμή Τρέχοντος Λογαριασμού Έως \|.*\n" + _date, convert=to_date),
+        bill_total_fixed_charges=Sum_Rule(r"^Πάγιο \|.*\| " + _amount + r" \|$",
+                                          r"^Έκπτωση παγίου \|.*\| " + _amount + r" \|$"),
+        bill_vat_amount=Regex_Rule(r"Αξία Φ\.Π\.Α\.: " + _amount, convert=to_float),
+        bill_refund_amount=Regex_Rule(r"Αξία Έναντι[^:]*: " + _amount, convert=to_float),
+        bill_total_amount=Regex_Rule(r"\(Α\) Ποσό Πληρωμής Τρέχοντος Λογαριασμού: " + _amount, convert=to_float),
+        commission_of_natural_gas=Regex_Rule(r"Προμήθεια Φυσικού Αερίου[^:]*: " + _amount, convert=to_float),
+        distribution_of_natural_gas=Regex_Rule(r"Διανομή Φυσικού Αερίου[^:]*: " + _amount, convert=to_float),
+        transport_of_natural_gas=Regex_Rule(r"Μεταφορά Φυσικού Αερίου[^:]*: " + _amount, convert=to_float),
+        usage_cubic_meters=Regex_Rule(r"^ΑΠΟ \| .*\| " + _amount + r" \| [\d.,]+ \|$", convert=to_float),
+        usage_kilowatt_hours=Regex_Rule(r"^ΑΠΟ \| .*\| " + _amount + r" \|$", convert=to_float),
+        rate_per_kilowatt_hour=Regex_Rule(r"^Κατανάλωση \|.*\| " + _amount + r" \| [\d.,]+ \|$", convert=to_float),
+    ),
+    optional=("bill_refund_amount",),
+    redactable=("customer_name", "customer_address", "customer_vat_number"),
+))
+
+register_issuer_rules(Issuer_Rules(
+    name="ZeniΘ electricity",
+    model=utility_model.Utility_Bill_Power,
+    markers=(_zenith, "ΛΟΓΑΡΙΑΣΜΟΣ ΗΛΕΚΤΡΙΚΟΥ ΡΕΥΜΑΤΟΣ"),
+    fields=dict(
+        _zenith_customer,
+        issuer_name=Const_Rule(_zenith),
+        document_number=Regex_Rule(r"ΚΩΔΙΚΟΣ ΠΕΛΑΤΗ \| ΑΡ\. ΠΑΡΟΧΗΣ \| ΑΡ\. ΕΓΓΡΑΦΟΥ \|.*\n[^|]*\|[^|]*\| ([^|]+?) \|"),
+        customer_id_number=Regex_Rule(r"ΚΩΔΙΚΟΣ ΠΕΛΑΤΗ \| ΑΡ\. ΠΑΡΟΧΗΣ \|.*\n([^|]+?) \|"),
+        customer_meter_number=Regex_Rule(r"ΚΩΔΙΚΟΣ ΠΕΛΑΤΗ \| ΑΡ\. ΠΑΡΟΧΗΣ \|.*\n[^|]*\| ([^|]+?) \|"),
+        bill_type=Regex_Rule(r"ΤΥΠΟΣ ΛΟΓΑΡΙΑΣΜΟΥ \| (Έναντι|Εκκαθαριστικός)"),
+        bill_pub_date=Regex_Rule(r"ΚΩΔΙΚΟΣ ΠΕΛΑΤΗ \| ΑΡ\. ΠΑΡΟΧΗΣ \|.*\n(?:[^|]*\|){3} " + _date, convert=to_date),
+        bill_period_start=Regex_Rule(r"ΚΩΔΙΚΟΣ ΠΕΛΑΤΗ \| ΑΡ\. ΠΑΡΟΧΗΣ \|.*\n.*\| " + _date + r" - \d{2}/\d{2}/\d{4} \|",
+                                     convert=to_date),
+        bill_period_end=Regex_Rule(r"ΚΩΔΙΚΟΣ ΠΕΛΑΤΗ \| ΑΡ\. ΠΑΡΟΧΗΣ \|.*\n.*\| \d{2}/\d{2}/\d{4} - " + _date + r" \|",
+                                   convert=to_date),
+        bill_due_date=Regex_Rule(r"Πληρωμή Τρέχοντος Λογαριασμού Έως \|.*\n" + _date, convert=to_date),
+        # Only trusted when the fixed charge is a cell of its own, parsed cells are often merged here
+        bill_total_fixed_charges=Sum_Rule(r"Πάγιο Τέλος \(€\): \|\s*\|\s*(\d{1,3},\d{2}) \|",
+                                          r"^Έκπτωση παγίου \(€\): \|.*?\| (-\d+,\d{2}) \|"),
+        bill_vat_amount=Regex_Rule(r"Αξία Φ\.Π\.Α\. \(€\): " + _amount, convert=to_float),
+        bill_refund_amount=Regex_Rule(r"Αξία Έναντι \(€\): " + _amount, convert=to_float),
+        bill_total_amount=Regex_Rule(r"\(Α\) Ποσό Πληρωμής Τρέχοντος Λογαριασμού: " + _amount, convert=to_float),
+        commission_of_power_charges=Regex_Rule(r"Προμήθεια Ρεύματος[^:]*: " + _amount, convert=to_float),
+        adjustable_power_charges=Regex_Rule(r"Ρυθμιζόμενες Χρεώσεις \(€\): " + _amount, convert=to_float),
+        bill_fees_amount=Sum_Rule(r"^(?:Ε\.Τ\.Μ\.Ε\.Α\.Ρ\.|Ειδικός Φόρος Κατανάλωσης|Ειδ\. Τέλος).*\| " + _amount + r" \|$"),
+        usage_kilowatt_hours=Regex_Rule(r"^ΗΜΕΡΑΣ \|(?:[^|\n]*\|){4} (\d+) \|", convert=to_float),
+        rate_per_kilowatt_hour=Sum_Rule(r"^Ημερήσια Κατανάλωση.*?\| ([\d,]+) €/kWh",
+                                        r"-^Έκπτωση συνέπειας.*?\| ([\d,]+) €/kWh"),
+        municipality_fee=Regex_Rule(r"^ΣΥΝΟΛΟ ΓΙΑ ΔΗΜΟ[^|]*(?:\|\s*)+" + _amount + r" \|", convert=to_float),
+        television_fee=Regex_Rule(r"^(?:ΕΡΤ|Ε\.Ρ\.Τ\.)[^|]*(?:\|\s*)+" + _amount + r" \|", convert=to_float),
+    ),
+    optional=("bill_refund_amount", "television_fee"),
+    redactable=("customer_name", "customer_address", "customer_vat_number"),
+))
+
+register_issuer_rules(Issuer_Rules(
+    name="ΕΥΑΘ water",
+    model=utility_model.Utility_Bill_Water,
+    markers=("Εταιρεία Ύδρευσης & Αποχέτευσης Θεσσαλονίκης Α.Ε.",),
+    fields=dict(
+        issuer_name=Const_Rule("Εταιρεία Ύδρευσης & Αποχέτευσης Θεσσαλονίκης Α.Ε."),
+        document_number=Regex_Rule(r"ΑΡ\. ΠΑΡΑΣΤΑΤΙΚΟΥ: (\S+)"),
+        customer_id_number=Regex_Rule(r"Αρ\. καταναλωτή: ([\d-]+)"),
+        customer_name=Regex_Rule(r"Υπόχρεος: (.+?)Διεύθυνση:"),
+        customer_address=Regex_Rule(r"Υπόχρεος: .+?Διεύθυνση: (.+?)(?=[A-ZΑ-Ω]{3}\d{8}|$)"),
+        customer_meter_number=Regex_Rule(r"Αρ\. υδρομέτρου: (\S+)"),
+        # Water bills are neither 'Έναντι' nor 'Εκκαθαριστικός'
+        bill_type=Const_Rule(NONE_PLACEHOLDER),
+        bill_pub_date=Regex_Rule(r"Εκδόθηκε: " + _date, convert=to_date),
+        bill_period_start=Regex_Rule(r"ΠΕΡΙΟΔΟΣ ΚΑΤΑΝΑΛΩΣΗΣ\s*Από: " + _date, convert=to_date),
+        bill_period_end=Regex_Rule(r"ΠΕΡΙΟΔΟΣ ΚΑΤΑΝΑΛΩΣΗΣ\s*Από: \d{2}/\d{2}/\d{4} Έως: " + _date, convert=to_date),
+        bill_due_date=Regex_Rule(r"ΗΜ\. ΛΗΞΗΣ ΠΛΗΡΩΜΗΣ: " + _date, convert=to_date),
+        bill_total_fixed_charges=Regex_Rule(r"^ΠΑΓΙΟ ΤΕΛΟΣ[^|]*\| " + _amount + r" \|", convert=to_float),
+        bill_vat_amount=Regex_Rule(r"ΣΥΝΟΛΟ ΦΠΑ \| (?:[\d.,]+ )?" + _amount + r" \|", convert=to_float),
+        bill_refund_amount=Regex_Rule(r"^ΕΠΙΣΤΡΟΦΗ[^|]*\| " + _amount + r" \|", convert=to_float),
+        bill_total_amount=Regex_Rule(r"ΣΥΝΟΛΟ ΤΡΕΧΟΝΤΟΣ ΛΟΓΑΡΙΑΣΜΟΥ \| " + _amount + r" \|", convert=to_float),
+        water_charges=Regex_Rule(r"^ΝΕΡΟ \([^)]*\) \| " + _amount + r" \|", convert=to_float),
+        sewage_charges=Regex_Rule(r"^ΑΠΟΧΕΤΕΥΣΗ[^|]*\| " + _amount + r" \|", convert=to_float),
+        bill_fees_amount=Sum_Rule(r"^(?!ΠΑΓΙΟ)[^|\n]*ΤΕΛΟΣ[^|\n]*\| " + _amount + r" \|"),
+        usage_cubic_meters=Regex_Rule(r"Χρέωση κυβικών \(m³\): (\d+)", convert=to_float),
+    ),
+    optional=("bill_refund_amount",),
+    redactable=("customer_name", "customer_address", "customer_vat_number"),
+))
@@ -0,0 +1,84 @@
+import re
+import json
+import threading
+from . import utility_model
+from .utility_logging import get_logger
+
+_logger = get_logger()
+
+# Bill type classifier registry: (marker, model) pairs in priority order.
+# When a bill contains markers of several types, the first registered one wins.
+_registry = []
+_registry_lock = threading.Lock()
+# Compiled form of the registry: (pattern, {marker: (priority, model)}), swapped atomically
+_classifier = (None, {})
+_schemas = {}
+
+
+def register_bill_type(marker, model):
+    # Register a text marker that identifies bills of the given utility_model class.
+    # The registry is compiled into a single regular expression, so adding issuers or bill types
+    # doesn't add another scan of the markdown.
+    global _classifier
+    with _registry_lock:
+        _registry.append((marker, model))
+        markers = {}
+        for priority, (m, bill_model) in enumerate(_registry):
+            markers.setdefault(m, (priority, bill_model))
+        # Longer markers first, so that a marker which is a prefix of another one doesn't shadow it
+        pattern = re.compile("|".join(re.escape(m) for m in sorted(markers, key=len, reverse=True)))
+        _classifier = (pattern, markers)
+
+
+def get_bill_types():
+    return list(_registry)
+
+
+def get_bill_type(markdown):
+    # Determine the utility_model class that matches the parsed markdown, in a single pass
+    pattern, markers = _classifier
+    best = None
+    if pattern is not None:
+        for match in pattern.finditer(markdown):
+            candidate = markers[match.group(0)]
+            if best is None or candidate[0] < best[0]:
+                best = candidate
+                if best[0] == 0:
+                    break
+    if best is None:
+        bill_type = utility_model.Utility_Bill
+        _logger.warning("Unrecognized utility bill type. Defaulting to base Utility_Bill schema.")
+    else:
+        bill_type = best[1]
+    _logger.info("Determined bill type schema: %s", bill_type)
+    return bill_type
+
+
+def _get_cached_schema(model):
+    cached = _schemas.get(model)
+    if cached is None:
+        # Imported here, landingai_ade is slow to import and only needed for extraction
+        from landingai_ade.lib import pydantic_to_json_schema
+        schema = pydantic_to_json_schema(model)
+        cached = (schema, json.loads(schema))
+        _schemas[model] = cached
+    return cached
+
+
+def get_model_schema(model):
+    # JSON schema string of a utility_model class, generated once per class
+    return _get_cached_schema(model)[0]
+
+
+def get_model_schema_dict(model):
+    # Parsed form of get_model_schema(), shared between callers: don't modify it
+    return _get_cached_schema(model)[1]
+
+
+def get_schema(markdown):
+    return get_model_schema(get_bill_type(markdown))
+
+
+register_bill_type("ΠΡΟΜΗΘΕΙΑ ΦΥΣΙΚΟΥ ΑΕΡΙΟΥ", utility_model.Utility_Bill_Gas)
+register_bill_type("ΛΟΓΑΡΙΑΣΜΟΣ ΗΛΕΚΤΡΙΚΟΥ ΡΕΥΜΑΤΟΣ", utility_model.Utility_Bill_Power)
+register_bill_type("Ύδρευσης", utility_model.Utility_Bill_Water)
@@ -0,0 +1,252 @@
+import os
+import csv
+import json
+import sqlite3
+import threading
+from typing import Optional
+from functools import lru_cache
+
+DEFAULT_BATCH_SIZE = 500
+# Leading columns of every record, followed by the fields of the bill type.
+# bill_class is the utility_model class name (the models already have a bill_type field)
+RECORD_FIELDS = ("file", "bill_class")
+
+
+@lru_cache(maxsize=None)
+def get_record_model(bill_type):
+    # Nullable variant of a utility_model class: the 'None' placeholder becomes a NULL column value
+    from pydantic import create_model
+    fields = {name: (Optional[field.annotation], None) for name, field in bill_type.model_fields.items()}
+    return create_model(bill_type.__name__ + "_Record", **fields)
+
+
+def get_columns(bill_type):
+    return RECORD_FIELDS + tuple(bill_type.model_fields)
+
+
+def to_record(result):
+    # Flat, validated row of a successfully processed Utility_Bill_Result.
+    # pydantic and the bill models are imported on first use, keeping the CLI's start-up fast.
+    from . import utility_model
+    from .utility_rules import NONE_PLACEHOLDER
+    bill_type = result.bill_type or utility_model.Utility_Bill
+    model = get_record_model(bill_type)
+    values = {name: (None if value == NONE_PLACEHOLDER else value)
+              for name, value in result.extract_response.extraction.items() if name in model.model_fields}
+    record = dict(file=result.filename, bill_class=bill_type.__name__)
+    record.update(model.model_validate(values).model_dump(mode="json"))
+    return record
+
+
+class Utility_Bill_Sink(object):
+    # Base class of the result sinks. Records are buffered and handed to _write_batch() every batch_size
+    # records, so memory use stays constant no matter how many bills are processed.
+    # Thread-safe: a processor shared between worker threads writes to a single sink.
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE):
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1, got " + str(batch_size))
+        self.__batch_size = batch_size
+        self.__lock = threading.Lock()
+        self.__pending = []
+        self.__written = 0
+        self.__closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, result):
+        from . import utility_model
+        self.write_record(result.bill_type or utility_model.Utility_Bill, to_record(result))
+
+    def write_record(self, bill_type, record):
+        with self.__lock:
+            if self.__closed:
+                raise ValueError("Sink is closed")
+            self.__pending.append((bill_type, record))
+            if len(self.__pending) >= self.__batch_size:
+                self.__flush()
+
+    def flush(self):
+        with self.__lock:
+            self.__flush()
+
+    def close(self):
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__flush()
+            self.__closed = True
+            self._close()
+
+    def get_count(self):
+        # Number of records written out so far, not counting buffered ones
+        return self.__written
+
+    def __flush(self):
+        # Records stay pending until written, so a failed batch is tried again with the next flush
+        if not self.__pending:
+            return
+        self._write_batch(self.__pending)
+        self.__written += len(self.__pending)
+        self.__pending = []
+
+    def _write_batch(self, batch):
+        # batch is a list of (bill_type, record) pairs
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+
+class NDJSON_Sink(Utility_Bill_Sink):
+    # One JSON document per line, all bill types in a single file
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE, append=False):
+        super().__init__(batch_size)
+        self.__file = open(path, "a" if append else "w", encoding="utf-8")
+
+    def _write_batch(self, batch):
+        self.__file.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for _, record in batch))
+        self.__file.flush()
+
+    def _close(self):
+        self.__file.close()
+
+
+class CSV_Sink(Utility_Bill_Sink):
+    # One <bill type>.csv file per bill type in directory, with that type's fields as columns
+    def __init__(self, directory, batch_size=DEFAULT_BATCH_SIZE):
+        super().__init__(batch_size)
+        self.__directory = directory
+        self.__files = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def __get_writer(self, bill_type):
+        entry = self.__files.get(bill_type)
+        if entry is None:
+            path = os.path.join(self.__directory, bill_type.__name__ + ".csv")
+            new = not os.path.exists(path) or os.path.getsize(path) == 0
+            f = open(path, "a", encoding="utf-8", newline="")
+            writer = csv.DictWriter(f, fieldnames=get_columns(bill_type))
+            if new:
+                writer.writeheader()
+            entry = self.__files[bill_type] = (f, writer)
+        return entry
+
+    def _write_batch(self, batch):
+        touched = set()
+        for bill_type, record in batch:
+            f, writer = self.__get_writer(bill_type)
+            writer.writerow(record)
+            touched.add(f)
+        for f in touched:
+            f.flush()
+
+    def _close(self):
+        for f, _ in self.__files.values():
+            f.close()
+
+
+class Parquet_Sink(Utility_Bill_Sink):
+    # One <bill type>.parquet file per bill type in directory, one row group per batch. Requires pyarrow.
+    def __init__(self, directory, batch_size=DEFAULT_BATCH_SIZE):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("Parquet_Sink requires pyarrow, install it with: pip install pyarrow") from e
+        super().__init__(batch_size)
+        self.__pa = pyarrow
+        self.__pq = pyarrow.parquet
+        self.__directory = directory
+        self.__writers = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def __get_writer(self, bill_type):
+        entry = self.__writers.get(bill_type)
+        if entry is None:
+            pa = self.__pa
+            fields = [pa.field(name, pa.string()) for name in RECORD_FIELDS]
+            for name, field in bill_type.model_fields.items():
+                fields.append(pa.field(name, pa.float64() if field.annotation is float else pa.string()))
+            schema = pa.schema(fields)
+            path = os.path.join(self.__directory, bill_type.__name__ + ".parquet")
+            entry = self.__writers[bill_type] = (self.__pq.ParquetWriter(path, schema), schema)
+        return entry
+
+    def _write_batch(self, batch):
+        by_type = {}
+        for bill_type, record in batch:
+            by_type.setdefault(bill_type, []).append(record)
+        for bill_type, records in by_type.items():
+            writer, schema = self.__get_writer(bill_type)
+            writer.write_table(self.__pa.Table.from_pylist(records, schema=schema))
+
+    def _close(self):
+        for writer, _ in self.__writers.values():
+            writer.close()
+
+
+class SQLite_Sink(Utility_Bill_Sink):
+    # One table per bill type (named after it) in a SQLite database, keyed by file name:
+    # re-processing a bill replaces its row. Each batch is written in a single transaction.
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        super().__init__(batch_size)
+        # Written from whichever worker thread fills a batch, always under the sink's lock
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__tables = set()
+
+    def __create_table(self, bill_type):
+        columns = ["file TEXT PRIMARY KEY", "bill_class TEXT NOT NULL"]
+        for name, field in bill_type.model_fields.items():
+            columns.append(name + (" REAL" if field.annotation is float else " TEXT"))
+        self.__conn.execute("CREATE TABLE IF NOT EXISTS " + bill_type.__name__ + " (" + ", ".join(columns) + ")")
+        self.__tables.add(bill_type)
+
+    def _write_batch(self, batch):
+        by_type = {}
+        for bill_type, record in batch:
+            by_type.setdefault(bill_type, []).append(record)
+        with self.__conn:
+            for bill_type, records in by_type.items():
+                if bill_type not in self.__tables:
+                    self.__create_table(bill_type)
+                columns = get_columns(bill_type)
+                self.__conn.executemany(
+                    "INSERT OR REPLACE INTO " + bill_type.__name__ + " (" + ", ".join(columns) + ") VALUES ("
+                    + ", ".join("?" * len(columns)) + ")",
+                    [tuple(record[column] for column in columns) for record in records])
+
+    def _close(self):
+        self.__conn.close()
+
+
+SINK_FORMATS = {
+    "ndjson": NDJSON_Sink,
+    "csv": CSV_Sink,
+    "parquet": Parquet_Sink,
+    "sqlite": SQLite_Sink,
+}
+
+_SINK_EXTENSIONS = {
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+    ".db": "sqlite",
+    ".sqlite": "sqlite",
+    ".sqlite3": "sqlite",
+}
+
+
+def open_sink(path, format=None, batch_size=DEFAULT_BATCH_SIZE):
+    # format defaults to the one matching path's extension; csv and parquet write into a directory
+    if format is None:
+        format = _SINK_EXTENSIONS.get(os.path.splitext(str(path))[1].lower())
+        if format is None:
+            raise ValueError("Cannot tell the sink format of " + str(path) + ", choose one of: "
+                             + ", ".join(SINK_FORMATS))
+    if format not in SINK_FORMATS:
+        raise ValueError("Unknown sink format: " + str(format))
+    return SINK_FORMATS[format](path, batch_size=batch_size)
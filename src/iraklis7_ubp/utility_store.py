@@ -0,0 +1,257 @@
+import math
+import struct
+import threading
+from urllib.parse import quote
+from .utility_logging import get_logger
+
+DEFAULT_KEY_PREFIX = "ubp:"
+# Keys per multi-get round trip, and writes per pipeline
+DEFAULT_READ_BATCH_SIZE = 256
+DEFAULT_WRITE_BATCH_SIZE = 64
+# Buffered writes are sent at the latest this many seconds after the first of them
+DEFAULT_FLUSH_INTERVAL = 0.05
+# Round trips a store runs at the same time, further lookups are queued and sent together
+DEFAULT_MAX_READS_IN_FLIGHT = 4
+
+# created_at and the size of main_value, following the codec name
+_RECORD_HEADER = struct.Struct("!dI")
+
+_logger = get_logger()
+
+
+def pack_record(record):
+    # A cache entry as stored by Utility_Bill_Cache, (codec, main_value, payload, created_at), as bytes
+    codec, main_value, payload, created_at = record
+    return (codec.encode("ascii") + b"\0" + _RECORD_HEADER.pack(created_at, len(main_value))
+            + main_value + payload)
+
+
+def unpack_record(data):
+    end = data.index(b"\0")
+    created_at, main_size = _RECORD_HEADER.unpack_from(data, end + 1)
+    start = end + 1 + _RECORD_HEADER.size
+    return (data[:end].decode("ascii"), data[start:start + main_size], data[start + main_size:], created_at)
+
+
+def _key_part(value):
+    # Percent-encoded, so that a stage or model can't contain the separator or match as a glob pattern
+    return quote(value, safe="-._~")
+
+
+class _Read_Batch(object):
+    def __init__(self):
+        self.keys = []
+        self.results = {}
+        self.error = None
+        self.done = threading.Event()
+
+
+class Cache_Store(object):
+    # Base class of the shared cache stores: a second tier behind the local index of a Utility_Bill_Cache,
+    # through which processors on several hosts share their ADE responses. Entries are keyed by
+    # (stage, content_digest, schema_digest, model) tuples and stored as packed records.
+    # Lookups run at most max_reads_in_flight round trips at a time, and lookups arriving meanwhile are
+    # sent together as one multi-get, so batching grows with load without delaying a lone lookup.
+    # Writes are buffered and sent write_batch_size at a time, or flush_interval seconds after the first.
+    # Subclasses implement _get_many(), _put_many() and _delete(). Thread-safe.
+    def __init__(self, write_batch_size=DEFAULT_WRITE_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_reads_in_flight=DEFAULT_MAX_READS_IN_FLIGHT):
+        if write_batch_size < 1:
+            raise ValueError("write_batch_size must be at least 1, got " + str(write_batch_size))
+        if max_reads_in_flight < 1:
+            raise ValueError("max_reads_in_flight must be at least 1, got " + str(max_reads_in_flight))
+        self.__write_batch_size = write_batch_size
+        self.__flush_interval = flush_interval
+        self.__max_reads_in_flight = max_reads_in_flight
+        self.__read_lock = threading.Lock()
+        self.__reads_in_flight = 0
+        self.__queued_reads = None
+        self.__write_lock = threading.Lock()
+        self.__pending_writes = []
+        self.__flush_timer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def get(self, key):
+        # The record stored under key, or None
+        with self.__read_lock:
+            batch = None
+            if self.__reads_in_flight < self.__max_reads_in_flight:
+                self.__reads_in_flight += 1
+            else:
+                batch = self.__queued_reads
+                if batch is None:
+                    batch = self.__queued_reads = _Read_Batch()
+                batch.keys.append(key)
+        if batch is not None:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return batch.results.get(key)
+        try:
+            return self.get_many([key]).get(key)
+        finally:
+            self.__finish_read()
+
+    def __finish_read(self):
+        # Before giving up its round trip, a reader sends the lookups queued in the meantime
+        while True:
+            with self.__read_lock:
+                batch = self.__queued_reads
+                self.__queued_reads = None
+                if batch is None:
+                    self.__reads_in_flight -= 1
+                    return
+            try:
+                batch.results = self.get_many(list(dict.fromkeys(batch.keys)))
+            except Exception as e:
+                batch.error = e
+            except BaseException as e:
+                # Interrupted: fail the lookups waiting on this reader rather than leave them blocked
+                with self.__read_lock:
+                    queued = self.__queued_reads
+                    self.__queued_reads = None
+                    self.__reads_in_flight -= 1
+                batch.error = e
+                if queued is not None:
+                    queued.error = e
+                    queued.done.set()
+                raise
+            finally:
+                batch.done.set()
+
+    def get_many(self, keys):
+        # Dict of the records found for keys, in as few round trips as the store allows
+        if not keys:
+            return {}
+        return self._get_many(keys)
+
+    def put(self, key, record, ttl=None):
+        # Store record under key, expiring after ttl seconds when given. Buffered, see flush().
+        with self.__write_lock:
+            self.__pending_writes.append((key, record, ttl))
+            full = len(self.__pending_writes) >= self.__write_batch_size
+            if not full and self.__flush_timer is None:
+                self.__flush_timer = threading.Timer(self.__flush_interval, self.__flush_pending)
+                self.__flush_timer.daemon = True
+                self.__flush_timer.start()
+        if full:
+            self.flush()
+
+    def __flush_pending(self):
+        # Timer thread: errors can't reach a caller, so log them
+        try:
+            self.flush()
+        except Exception as e:
+            _logger.warning("Writing to the shared cache store failed: %s", e)
+
+    def flush(self):
+        with self.__write_lock:
+            writes, self.__pending_writes = self.__pending_writes, []
+            if self.__flush_timer is not None:
+                self.__flush_timer.cancel()
+                self.__flush_timer = None
+        if writes:
+            self._put_many(writes)
+
+    def delete(self, stage=None, model=None, before=None):
+        # Delete the entries matching all of the given criteria, as Utility_Bill_Cache.invalidate().
+        # Returns the number of deleted entries.
+        self.flush()
+        return self._delete(stage, model, before)
+
+    def close(self):
+        self.flush()
+
+    def _get_many(self, keys):
+        raise NotImplementedError
+
+    def _put_many(self, writes):
+        # writes: list of (key, record, ttl)
+        raise NotImplementedError
+
+    def _delete(self, stage, model, before):
+        raise NotImplementedError
+
+
+class Redis_Store(Cache_Store):
+    # Cache store on a Redis-protocol server (Redis, Valkey, KeyDB, ...): one string value per entry,
+    # looked up with MGET and written through non-transactional pipelines, with the TTL set by the server.
+    # client is a redis.Redis-compatible client; without one, a client is created from url (requires redis).
+    def __init__(self, client=None, url=None, prefix=DEFAULT_KEY_PREFIX, read_batch_size=DEFAULT_READ_BATCH_SIZE,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.__owns_client = client is None
+        if client is None:
+            if url is None:
+                raise ValueError("Redis_Store needs a client or a url")
+            try:
+                import redis
+            except ImportError as e:
+                raise ImportError("Redis_Store requires redis, install it with: pip install redis") from e
+            client = redis.Redis.from_url(url)
+        self.__client = client
+        self.__prefix = prefix
+        self.__read_batch_size = read_batch_size
+
+    def __to_redis_key(self, key):
+        # Stage and model first, so that invalidation can match them with a pattern
+        stage, content_digest, schema_digest, model = key
+        return self.__prefix + _key_part(stage) + ":" + _key_part(model) + ":" + content_digest + ":" + schema_digest
+
+    def _get_many(self, keys):
+        results = {}
+        for start in range(0, len(keys), self.__read_batch_size):
+            chunk = keys[start:start + self.__read_batch_size]
+            for key, value in zip(chunk, self.__client.mget([self.__to_redis_key(key) for key in chunk])):
+                if value is not None:
+                    results[key] = unpack_record(value)
+        return results
+
+    def _put_many(self, writes):
+        pipeline = self.__client.pipeline(transaction=False)
+        for key, record, ttl in writes:
+            # Redis rejects zero or negative expiry times
+            px = max(1, math.ceil(ttl * 1000)) if ttl is not None else None
+            pipeline.set(self.__to_redis_key(key), pack_record(record), px=px)
+        pipeline.execute()
+
+    def _delete(self, stage, model, before):
+        pattern = (self.__prefix + (_key_part(stage) if stage else "*") + ":" + (_key_part(model) if model else "*")
+                   + ":*")
+        keys = list(self.__client.scan_iter(match=pattern, count=1000))
+        deleted = 0
+        for start in range(0, len(keys), self.__read_batch_size):
+            chunk = keys[start:start + self.__read_batch_size]
+            if before is not None:
+                chunk = [name for name, value in zip(chunk, self.__client.mget(chunk))
+                         if value is not None and unpack_record(value)[3] < before]
+            if chunk:
+                deleted += self.__client.delete(*chunk)
+        return deleted
+
+    def close(self):
+        super().close()
+        if self.__owns_client:
+            self.__client.close()
+
+
+# URL schemes and the stores serving them
+STORE_SCHEMES = {
+    "redis": Redis_Store,
+    "rediss": Redis_Store,
+    "unix": Redis_Store,
+}
+
+
+def open_store(url, **kwargs):
+    # Shared cache store for a URL, e.g. redis://cache-host:6379/0
+    scheme = url.split("://", 1)[0].lower() if "://" in url else None
+    if scheme not in STORE_SCHEMES:
+        raise ValueError("Unsupported cache store URL: " + str(url) + ", use one of: "
+                         + ", ".join(scheme + "://" for scheme in STORE_SCHEMES))
+    return STORE_SCHEMES[scheme](url=url, **kwargs)
@@ -0,0 +1,316 @@
+import time
+import random
+import sqlite3
+import threading
+from functools import lru_cache
+from .utility_metrics import NULL_METRICS
+from .utility_logging import get_logger
+
+DEFAULT_MAX_CONNECTIONS = 32
+
+_logger = get_logger()
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_retryable_errors():
+    # Errors worth retrying: the request may succeed if simply sent again later.
+    # Resolved on first use, so that importing this module doesn't import landingai_ade.
+    from landingai_ade import APIConnectionError, APITimeoutError, RateLimitError, InternalServerError
+    return (APIConnectionError, APITimeoutError, RateLimitError, InternalServerError)
+
+
+def get_shared_http_client():
+    # One pooled HTTP client per process, shared by all processors, so connections (and TLS sessions)
+    # to the ADE servers are reused across requests and processor instances
+    global _http_client
+    import httpx
+    from landingai_ade import DefaultHttpxClient
+    with _http_client_lock:
+        if _http_client is None or _http_client.is_closed:
+            _http_client = DefaultHttpxClient(limits=httpx.Limits(max_connections=DEFAULT_MAX_CONNECTIONS,
+                                                                  max_keepalive_connections=DEFAULT_MAX_CONNECTIONS))
+        return _http_client
+
+
+class Circuit_Open_Error(Exception):
+    # Raised instead of calling the ADE API while the circuit breaker is open
+    pass
+
+
+class Retry_Policy(object):
+    # Exponential backoff with full jitter: before retry n (1-based), sleep a random time between 0 and
+    # min(max_delay, base_delay * 2 ** (n - 1)), or as long as the server asked for with Retry-After.
+    # retryable is a tuple of exception types, get_retryable_errors() by default.
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=20.0, retryable=None, seed=None):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1, got " + str(max_attempts))
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retryable = retryable
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+
+    def is_retryable(self, error):
+        return isinstance(error, self.retryable if self.retryable is not None else get_retryable_errors())
+
+    def get_delay(self, attempt, error=None):
+        retry_after = _get_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        with self.__lock:
+            return self.__random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+NO_RETRY = Retry_Policy(max_attempts=1)
+
+
+def _get_retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class Token_Bucket(object):
+    # Thread-safe token bucket: rate requests per second on average, bursts of up to capacity
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        if rate <= 0:
+            raise ValueError("rate must be positive, got " + str(rate))
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        self.__tokens = self.capacity
+        self.__updated = clock()
+
+    def reserve(self):
+        # Take a token if one is available and return 0, or return the seconds to wait before trying again
+        with self.__lock:
+            now = self.__clock()
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+            self.__updated = now
+            if self.__tokens >= 1:
+                self.__tokens -= 1
+                return 0.0
+            return (1 - self.__tokens) / self.rate
+
+
+class Shared_Token_Bucket(object):
+    # Token bucket shared by all processes using the same SQLite file, e.g. parallel batch jobs
+    # under one API key. Its state is updated in an immediate (write-locking) transaction.
+    def __init__(self, path, rate, capacity=None, name="ade"):
+        if rate <= 0:
+            raise ValueError("rate must be positive, got " + str(rate))
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.__path = path
+        self.__name = name
+        self.__local = threading.local()
+        conn = self.__connect()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets "
+                         "(name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                         (name, self.capacity, time.time()))
+
+    def __connect(self):
+        conn = getattr(self.__local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.__path, timeout=30, isolation_level=None)
+            self.__local.conn = conn
+        return conn
+
+    def reserve(self):
+        conn = self.__connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tokens, updated = conn.execute("SELECT tokens, updated FROM buckets WHERE name = ?",
+                                           (self.__name,)).fetchone()
+            # Wall clock time, as it is compared across processes
+            now = time.time()
+            tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            conn.execute("UPDATE buckets SET tokens = ?, updated = ? WHERE name = ?", (tokens, now, self.__name))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+class Circuit_Breaker(object):
+    # After failure_threshold consecutive retryable failures the circuit opens and calls fail fast with
+    # Circuit_Open_Error. After reset_timeout seconds a single trial call is let through (half-open):
+    # success closes the circuit again, failure re-opens it.
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        self.__failures = 0
+        self.__opened_at = None
+        self.__trial = False
+
+    def get_state(self):
+        with self.__lock:
+            if self.__opened_at is None:
+                return "closed"
+            if self.__clock() - self.__opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def before_call(self):
+        # Returns True when the call is the half-open trial, see release_trial()
+        with self.__lock:
+            if self.__opened_at is None:
+                return False
+            if self.__clock() - self.__opened_at < self.reset_timeout or self.__trial:
+                raise Circuit_Open_Error("ADE circuit breaker is open after " + str(self.__failures)
+                                         + " consecutive failures")
+            self.__trial = True
+            return True
+
+    def release_trial(self):
+        # The trial call was interrupted (e.g. cancelled) without an outcome: let the next call try again
+        with self.__lock:
+            self.__trial = False
+
+    def record_success(self):
+        with self.__lock:
+            self.__failures = 0
+            self.__opened_at = None
+            self.__trial = False
+
+    def record_failure(self):
+        with self.__lock:
+            self.__failures += 1
+            if self.__trial or self.__failures >= self.failure_threshold:
+                self.__opened_at = self.__clock()
+                self.__trial = False
+
+
+class ADE_Transport(object):
+    # Policy layer around an ADE client (LandingAIADE, or a stand-in exposing parse() / extract()):
+    # rate limiting, retries with backoff and jitter on retryable errors, and an optional circuit breaker.
+    def __init__(self, client, retry_policy=None, rate_limiter=None, circuit_breaker=None,
+                 metrics=NULL_METRICS, sleep=time.sleep):
+        self.client = client
+        self.__retry_policy = retry_policy if retry_policy is not None else Retry_Policy()
+        self.__rate_limiter = rate_limiter
+        self.__circuit_breaker = circuit_breaker
+        self.__metrics = metrics
+        self.__sleep = sleep
+
+    def parse(self, **kwargs):
+        return self.__call("parse", self.client.parse, kwargs)
+
+    def extract(self, **kwargs):
+        return self.__call("extract", self.client.extract, kwargs)
+
+    def __call(self, endpoint, method, kwargs):
+        attempt = 1
+        while True:
+            if self.__rate_limiter is not None:
+                wait = self.__rate_limiter.reserve()
+                while wait > 0:
+                    self.__metrics.inc("rate_limited", endpoint=endpoint)
+                    self.__sleep(wait)
+                    wait = self.__rate_limiter.reserve()
+            trial = self.__circuit_breaker is not None and self.__circuit_breaker.before_call()
+            try:
+                response = method(**kwargs)
+            except Exception as e:
+                delay = _handle_failure(self.__retry_policy, self.__circuit_breaker, self.__metrics,
+                                        endpoint, attempt, e)
+                self.__sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                if trial:
+                    self.__circuit_breaker.release_trial()
+                raise
+            if self.__circuit_breaker is not None:
+                self.__circuit_breaker.record_success()
+            return response
+
+
+class Async_ADE_Transport(object):
+    # asyncio counterpart of ADE_Transport, around an async client (e.g. AsyncLandingAIADE)
+    def __init__(self, client, retry_policy=None, rate_limiter=None, circuit_breaker=None,
+                 metrics=NULL_METRICS, sleep=None):
+        # asyncio is imported here, keeping it out of the synchronous processor's start-up
+        import asyncio
+        self.__to_thread = asyncio.to_thread
+        self.client = client
+        self.__retry_policy = retry_policy if retry_policy is not None else Retry_Policy()
+        self.__rate_limiter = rate_limiter
+        self.__circuit_breaker = circuit_breaker
+        self.__metrics = metrics
+        self.__sleep = sleep if sleep is not None else asyncio.sleep
+
+    async def parse(self, **kwargs):
+        return await self.__call("parse", self.client.parse, kwargs)
+
+    async def extract(self, **kwargs):
+        return await self.__call("extract", self.client.extract, kwargs)
+
+    async def close(self):
+        close = getattr(self.client, "close", None)
+        if close is not None:
+            await close()
+
+    async def __call(self, endpoint, method, kwargs):
+        attempt = 1
+        while True:
+            if self.__rate_limiter is not None:
+                # A shared bucket does file I/O, keep it off the event loop
+                wait = await self.__to_thread(self.__rate_limiter.reserve)
+                while wait > 0:
+                    self.__metrics.inc("rate_limited", endpoint=endpoint)
+                    await self.__sleep(wait)
+                    wait = await self.__to_thread(self.__rate_limiter.reserve)
+            trial = self.__circuit_breaker is not None and self.__circuit_breaker.before_call()
+            try:
+                response = await method(**kwargs)
+            except Exception as e:
+                delay = _handle_failure(self.__retry_policy, self.__circuit_breaker, self.__metrics,
+                                        endpoint, attempt, e)
+                await self.__sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                # e.g. asyncio.CancelledError
+                if trial:
+                    self.__circuit_breaker.release_trial()
+                raise
+            if self.__circuit_breaker is not None:
+                self.__circuit_breaker.record_success()
+            return response
+
+
+def _handle_failure(retry_policy, circuit_breaker, metrics, endpoint, attempt, error):
+    # Re-raises error unless the call should be retried, in which case the delay before the retry is returned
+    retryable = retry_policy.is_retryable(error)
+    if circuit_breaker is not None:
+        if retryable:
+            circuit_breaker.record_failure()
+        else:
+            # e.g. a rejected request: the server is reachable
+            circuit_breaker.record_success()
+    if not retryable or attempt >= retry_policy.max_attempts:
+        raise error
+    delay = retry_policy.get_delay(attempt, error)
+    metrics.inc("api_retries", endpoint=endpoint, error=type(error).__name__)
+    _logger.warning("ADE %s call failed (attempt %d of %d): %s. Retrying in %.2fs.",
+                    endpoint, attempt, retry_policy.max_attempts, error, delay)
+    return delay
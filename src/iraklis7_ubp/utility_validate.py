@@ -0,0 +1,315 @@
+import math
+import datetime
+import statistics
+from array import array
+from . import utility_model
+from .utility_rules import NONE_PLACEHOLDER, REDACTED_PLACEHOLDER
+from .utility_logging import get_logger
+
+# numpy is optional: columns are numpy arrays and checks run as vector operations when it is installed,
+# and array.array columns checked in a single pass per check otherwise
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Amounts are compared to the cent, with this tolerance for rounding on the bills
+DEFAULT_AMOUNT_TOLERANCE = 0.015
+# Products (e.g. rate x kWh) are compared with this relative tolerance, rates being rounded on the bills
+DEFAULT_RELATIVE_TOLERANCE = 0.02
+# Robust z-score (distance from the median, in scaled median absolute deviations) beyond which a value
+# is flagged as an outlier, and the minimum number of values needed to tell
+DEFAULT_OUTLIER_THRESHOLD = 3.5
+MIN_OUTLIER_SAMPLES = 8
+
+_MISSING_VALUES = (None, "", NONE_PLACEHOLDER, REDACTED_PLACEHOLDER)
+
+_logger = get_logger()
+
+
+def _is_date_field(field):
+    return "YYYY-MM-DD" in (field.description or "")
+
+
+def _to_float(value):
+    # NaN for missing values, None for values that aren't numbers
+    if value in _MISSING_VALUES:
+        return math.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_day(value):
+    # Dates as day ordinals (float, NaN for missing values), None for values that aren't YYYY-MM-DD dates
+    if value in _MISSING_VALUES:
+        return math.nan
+    try:
+        return float(datetime.date.fromisoformat(value).toordinal())
+    except (TypeError, ValueError):
+        return None
+
+
+def _new_column(values):
+    if numpy is not None:
+        return numpy.array(values, dtype=numpy.float64)
+    return array("d", values)
+
+
+# Column operations, on numpy arrays or array.array columns. Row indices are returned in ascending order.
+def _add(columns):
+    # Row sums, missing values counting as zero
+    if numpy is not None:
+        return numpy.nansum(numpy.vstack(columns), axis=0)
+    return array("d", (math.fsum(v for v in row if v == v) for row in zip(*columns)))
+
+
+def _sub(a, b):
+    if numpy is not None:
+        return a - b
+    return array("d", (x - y for x, y in zip(a, b)))
+
+
+def _mul(a, b):
+    if numpy is not None:
+        return a * b
+    return array("d", (x * y for x, y in zip(a, b)))
+
+
+def _find_mismatches(a, b, abs_tol, rel_tol):
+    # Rows where both values are present and differ by more than abs_tol + rel_tol * |b|
+    if numpy is not None:
+        with numpy.errstate(invalid="ignore"):
+            return numpy.flatnonzero(numpy.abs(a - b) > abs_tol + rel_tol * numpy.abs(b)).tolist()
+    return [i for i, (x, y) in enumerate(zip(a, b)) if abs(x - y) > abs_tol + rel_tol * abs(y)]
+
+
+def _find_greater(a, b):
+    # Rows where both values are present and a > b (comparisons with NaN are false)
+    if numpy is not None:
+        with numpy.errstate(invalid="ignore"):
+            return numpy.flatnonzero(a > b).tolist()
+    return [i for i, (x, y) in enumerate(zip(a, b)) if x > y]
+
+
+def _find_outliers(column, threshold):
+    if numpy is not None:
+        present = column[~numpy.isnan(column)]
+        if len(present) < MIN_OUTLIER_SAMPLES:
+            return []
+        median = numpy.median(present)
+        mad = numpy.median(numpy.abs(present - median)) * 1.4826
+        if mad == 0:
+            return []
+        with numpy.errstate(invalid="ignore"):
+            return numpy.flatnonzero(numpy.abs(column - median) > threshold * mad).tolist()
+    present = [v for v in column if v == v]
+    if len(present) < MIN_OUTLIER_SAMPLES:
+        return []
+    median = statistics.median(present)
+    mad = statistics.median(abs(v - median) for v in present) * 1.4826
+    if mad == 0:
+        return []
+    return [i for i, v in enumerate(column) if abs(v - median) > threshold * mad]
+
+
+def sum_check(total, components, tolerance=DEFAULT_AMOUNT_TOLERANCE):
+    # total == sum(components), missing components counting as zero
+    def check(frame):
+        return _find_mismatches(frame.get_column(total),
+                                _add([frame.get_column(name) for name in components]), tolerance, 0.0)
+    check.fields = (total,) + tuple(components)
+    return check
+
+
+def order_check(earlier, later):
+    # earlier <= later, for dates or amounts
+    def check(frame):
+        return _find_greater(frame.get_column(earlier), frame.get_column(later))
+    check.fields = (earlier, later)
+    return check
+
+
+def product_check(factors, value, minus=None, tolerance=DEFAULT_RELATIVE_TOLERANCE):
+    # factors[0] * factors[1] == value (- minus), e.g. rate x kWh == energy charges
+    def check(frame):
+        product = _mul(frame.get_column(factors[0]), frame.get_column(factors[1]))
+        expected = frame.get_column(value)
+        if minus is not None:
+            expected = _sub(expected, frame.get_column(minus))
+        return _find_mismatches(product, expected, DEFAULT_AMOUNT_TOLERANCE, tolerance)
+    check.fields = tuple(factors) + (value,) + ((minus,) if minus is not None else ())
+    return check
+
+
+# Cross-field invariants: (bill type, name, check) triples. Checks registered for a bill type apply to
+# its subclasses too, so those registered for Utility_Bill apply to all bills.
+_checks = []
+
+
+def register_check(bill_type, name, check):
+    _checks.append((bill_type, name, check))
+
+
+def get_checks(bill_type):
+    return [(name, check) for registered_type, name, check in _checks if issubclass(bill_type, registered_type)]
+
+
+class Utility_Bill_Frame(object):
+    # Column-oriented batch of extractions of one bill type, coerced once into typed columns:
+    # amounts as float64 (NaN when missing), dates as day ordinals (NaN when missing), text as lists
+    # (None when missing or redacted). Values that can't be coerced become missing, and are reported
+    # by validate() as 'type' issues.
+    def __init__(self, bill_type, extractions, files=None):
+        self.bill_type = bill_type
+        extractions = list(extractions)
+        self.files = list(files) if files is not None else [None] * len(extractions)
+        if len(self.files) != len(extractions):
+            raise ValueError("Got " + str(len(self.files)) + " files for " + str(len(extractions)) + " extractions")
+        self.__columns = {}
+        self.__kinds = {}
+        self.__type_errors = []
+        for name, field in bill_type.model_fields.items():
+            raw = [extraction.get(name) for extraction in extractions]
+            if field.annotation is float:
+                kind, convert = "amount", _to_float
+            elif _is_date_field(field):
+                kind, convert = "date", _to_day
+            else:
+                self.__columns[name] = [None if value in _MISSING_VALUES else value for value in raw]
+                self.__kinds[name] = "text"
+                continue
+            values = list(map(convert, raw))
+            for row, value in enumerate(values):
+                if value is None:
+                    self.__type_errors.append((row, name))
+                    values[row] = math.nan
+            self.__columns[name] = _new_column(values)
+            self.__kinds[name] = kind
+
+    def __len__(self):
+        return len(self.files)
+
+    def get_column(self, name):
+        return self.__columns[name]
+
+    def get_kind(self, name):
+        # "amount", "date" or "text"
+        return self.__kinds[name]
+
+    def get_dates(self, name):
+        # A date column as datetime.date values (None when missing)
+        return [None if day != day else datetime.date.fromordinal(int(day)) for day in self.__columns[name]]
+
+    def validate(self, outlier_threshold=DEFAULT_OUTLIER_THRESHOLD):
+        # Run the registered checks of the bill type, and look for outlying amounts. Returns a list of
+        # issues, dicts of (file, bill_class, check, fields, row), ordered by check.
+        issues = [self.__issue(row, "type", (name,)) for row, name in self.__type_errors]
+        for name, check in get_checks(self.bill_type):
+            issues.extend(self.__issue(row, name, check.fields) for row in check(self))
+        if outlier_threshold is not None:
+            for name, kind in self.__kinds.items():
+                if kind == "amount":
+                    issues.extend(self.__issue(row, "outlier", (name,))
+                                  for row in _find_outliers(self.__columns[name], outlier_threshold))
+        _logger.info("Validated %d %s bills: %d issues", len(self), self.bill_type.__name__, len(issues))
+        return issues
+
+    def __issue(self, row, check, fields):
+        return dict(file=self.files[row], bill_class=self.bill_type.__name__, check=check, fields=list(fields),
+                    row=row)
+
+    def to_dict(self):
+        # Plain columns (lists), dates as ISO strings
+        columns = {}
+        for name, kind in self.__kinds.items():
+            if kind == "date":
+                columns[name] = [None if day is None else day.isoformat() for day in self.get_dates(name)]
+            elif kind == "amount":
+                columns[name] = [None if value != value else value for value in self.__columns[name]]
+            else:
+                columns[name] = list(self.__columns[name])
+        return dict(file=list(self.files), **columns)
+
+    def to_pandas(self):
+        # DataFrame with float64 amounts and datetime64 dates. Requires pandas.
+        try:
+            import pandas
+        except ImportError as e:
+            raise ImportError("to_pandas() requires pandas, install it with: pip install pandas") from e
+        frame = pandas.DataFrame(self.to_dict())
+        for name, kind in self.__kinds.items():
+            if kind == "date":
+                frame[name] = pandas.to_datetime(frame[name])
+            elif kind == "amount":
+                frame[name] = frame[name].astype("float64")
+        return frame
+
+    def to_arrow(self):
+        # pyarrow Table with float64 amounts and date32 dates. Requires pyarrow.
+        try:
+            import pyarrow
+        except ImportError as e:
+            raise ImportError("to_arrow() requires pyarrow, install it with: pip install pyarrow") from e
+        types = dict(amount=pyarrow.float64(), date=pyarrow.date32(), text=pyarrow.string())
+        columns = self.to_dict()
+        arrays = [pyarrow.array(self.files, type=pyarrow.string())]
+        for name, kind in self.__kinds.items():
+            values = self.get_dates(name) if kind == "date" else columns[name]
+            arrays.append(pyarrow.array(values, type=types[kind]))
+        return pyarrow.Table.from_arrays(arrays, names=["file"] + list(self.__kinds))
+
+
+def build_frames(results):
+    # One Utility_Bill_Frame per bill type from successfully processed Utility_Bill_Results
+    grouped = {}
+    for result in results:
+        if not result.ok():
+            continue
+        bill_type = result.bill_type or utility_model.Utility_Bill
+        files, extractions = grouped.setdefault(bill_type, ([], []))
+        files.append(result.filename)
+        extractions.append(result.extract_response.extraction)
+    return {bill_type: Utility_Bill_Frame(bill_type, extractions, files)
+            for bill_type, (files, extractions) in grouped.items()}
+
+
+def build_frames_from_records(records):
+    # One Utility_Bill_Frame per bill type from sink records (e.g. the lines of an NDJSON sink)
+    grouped = {}
+    for record in records:
+        bill_type = getattr(utility_model, record.get("bill_class") or "", utility_model.Utility_Bill)
+        files, extractions = grouped.setdefault(bill_type, ([], []))
+        files.append(record.get("file"))
+        extractions.append(record)
+    return {bill_type: Utility_Bill_Frame(bill_type, extractions, files)
+            for bill_type, (files, extractions) in grouped.items()}
+
+
+def validate_results(results, outlier_threshold=DEFAULT_OUTLIER_THRESHOLD):
+    # Issues of a batch of Utility_Bill_Results, checked per bill type
+    issues = []
+    for frame in build_frames(results).values():
+        issues.extend(frame.validate(outlier_threshold))
+    return issues
+
+
+register_check(utility_model.Utility_Bill, "period_order",
+               order_check("bill_period_start", "bill_period_end"))
+register_check(utility_model.Utility_Bill, "due_after_publication",
+               order_check("bill_pub_date", "bill_due_date"))
+# The fixed charges are part of the gas commission, and aren't summed separately
+register_check(utility_model.Utility_Bill_Gas, "total_amount",
+               sum_check("bill_total_amount", ("commission_of_natural_gas", "distribution_of_natural_gas",
+                                               "transport_of_natural_gas", "bill_vat_amount",
+                                               "bill_refund_amount")))
+register_check(utility_model.Utility_Bill_Gas, "energy_charges",
+               product_check(("rate_per_kilowatt_hour", "usage_kilowatt_hours"), "commission_of_natural_gas",
+                             minus="bill_total_fixed_charges"))
+register_check(utility_model.Utility_Bill_Power, "energy_charges",
+               product_check(("rate_per_kilowatt_hour", "usage_kilowatt_hours"), "commission_of_power_charges",
+                             minus="bill_total_fixed_charges"))
+register_check(utility_model.Utility_Bill_Water, "total_amount",
+               sum_check("bill_total_amount", ("bill_total_fixed_charges", "water_charges", "sewage_charges",
+                                               "bill_fees_amount", "bill_vat_amount", "bill_refund_amount")))
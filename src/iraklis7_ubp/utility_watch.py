@@ -0,0 +1,332 @@
+import os
+import queue
+import select
+import struct
+import fnmatch
+import threading
+import time
+from .utility_batch import STATE_QUEUED, STATE_EXTRACTED, STATE_FAILED, Utility_Bill_Journal, record_result
+from .utility_logging import get_logger
+
+DEFAULT_PATTERNS = ("*.pdf",)
+# Seconds a file's size and mtime must stay unchanged before it is processed, unless its writer is seen
+# closing it (inotify only)
+DEFAULT_SETTLE = 2.0
+DEFAULT_POLL_INTERVAL = 1.0
+# Bytes at the end of a PDF searched for its end-of-file marker
+PDF_TAIL_SIZE = 1024
+# The journal is compacted on start-up and after this many processed files
+COMPACT_INTERVAL = 1000
+
+# inotify(7) constants
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# Events after which a file is complete, as far as its writer is concerned
+IN_COMPLETE = IN_CLOSE_WRITE | IN_MOVED_TO
+_EVENT_HEADER = struct.Struct("iIII")
+
+_logger = get_logger()
+
+
+def is_complete_pdf(input_path):
+    # PDF writers finish with an %%EOF marker, so a PDF without one is most likely still being written
+    try:
+        with open(input_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - PDF_TAIL_SIZE))
+            return b"%%EOF" in f.read()
+    except OSError:
+        return False
+
+
+class Inotify_Source(object):
+    # Change events of the files in a directory, from the Linux inotify API (through ctypes, no dependency).
+    # Raises OSError where inotify isn't available.
+    def __init__(self, directory):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available on this platform")
+        self.__fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+        if libc.inotify_add_watch(self.__fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.__fd)
+            raise OSError(errno, "inotify_add_watch failed for " + str(directory))
+
+    def read(self, timeout):
+        # (name, mask) events, waiting up to timeout seconds for the first
+        if not select.select([self.__fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.__fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            events.append((os.fsdecode(data[offset:offset + length].rstrip(b"\0")), mask))
+            offset += length
+        return events
+
+    def close(self):
+        os.close(self.__fd)
+
+
+class Utility_Bill_Watcher(object):
+    # Long-running ingestion of the bills landing in an inbox directory. The inbox is watched with inotify
+    # where available, and polled every poll_interval seconds otherwise. A new or changed file is processed
+    # once it has settled: its writer closed it (inotify), or its size and mtime stayed the same for settle
+    # seconds, and, for PDFs, it ends with an end-of-file marker.
+    # Settled files go through a bounded queue (queue_size, so a burst of files can't outrun the workers
+    # without limit) to max_workers threads running processor.process(). Results reach the processor's sink
+    # and on_result(result) when given. Only files not processed in their current state are queued: with
+    # journal_path (a Utility_Bill_Journal), this is remembered across restarts, and a restarted watcher
+    # only processes what arrived or changed in the meantime, going by size and mtime, without re-hashing.
+    # The journal is compacted every compact_interval files, dropping the files gone from the inbox.
+    def __init__(self, processor, inbox, journal_path=None, patterns=DEFAULT_PATTERNS, max_workers=4,
+                 queue_size=None, settle=DEFAULT_SETTLE, poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=None,
+                 on_result=None, compact_interval=COMPACT_INTERVAL):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1, got " + str(max_workers))
+        self.__processor = processor
+        self.__inbox = os.path.abspath(inbox)
+        self.__patterns = tuple(patterns)
+        self.__max_workers = max_workers
+        self.__queue = queue.Queue(maxsize=queue_size if queue_size is not None else max_workers * 4)
+        self.__settle = settle
+        self.__poll_interval = poll_interval
+        self.__use_inotify = use_inotify
+        self.__on_result = on_result
+        self.__journal = Utility_Bill_Journal(journal_path) if journal_path is not None else None
+        self.__compact_interval = compact_interval
+        self.__recorded = 0
+        # (size, mtime_ns) of the files processed or being processed, and unsettled files:
+        # path -> [size, mtime_ns, last change, closed by its writer]
+        self.__processed = {}
+        self.__candidates = {}
+        self.__lock = threading.Lock()
+        self.__stopping = threading.Event()
+        self.__idle = threading.Condition(self.__lock)
+        self.__busy = 0
+        self.__running = False
+        if self.__journal is not None:
+            for path, record in self.__journal.get_states().items():
+                if record["state"] in (STATE_EXTRACTED, STATE_FAILED):
+                    self.__processed[path] = (record["size"], record["mtime_ns"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __matches(self, name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.__patterns)
+
+    def __open_source(self):
+        if self.__use_inotify is False:
+            return None
+        try:
+            return Inotify_Source(self.__inbox)
+        except OSError as e:
+            if self.__use_inotify:
+                raise
+            _logger.info("inotify is unavailable (%s), polling %s every %ss", e, self.__inbox, self.__poll_interval)
+            return None
+
+    def run(self):
+        # Watch until stop() is called. Files already in the inbox are picked up first.
+        os.makedirs(self.__inbox, exist_ok=True)
+        self.__running = True
+        self.__compact_journal()
+        source = self.__open_source()
+        workers = [threading.Thread(target=self.__work, name="ubp-watch-" + str(number), daemon=True)
+                   for number in range(self.__max_workers)]
+        for worker in workers:
+            worker.start()
+        _logger.info("Watching %s (%s)", self.__inbox, "inotify" if source is not None else "polling")
+        try:
+            self.scan()
+            last_scan = time.monotonic()
+            while not self.__stopping.is_set():
+                tick = min(self.__poll_interval, max(self.__settle / 4, 0.01)) if self.__candidates \
+                    else self.__poll_interval
+                if source is not None:
+                    for name, mask in source.read(tick):
+                        if mask & IN_Q_OVERFLOW:
+                            # Events were dropped
+                            self.scan()
+                        elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                            _logger.warning("Inbox %s went away, falling back to polling", self.__inbox)
+                            source.close()
+                            source = None
+                            break
+                        elif name and self.__matches(name):
+                            self.__observe(os.path.join(self.__inbox, name), closed=bool(mask & IN_COMPLETE))
+                else:
+                    self.__stopping.wait(tick)
+                    if time.monotonic() - last_scan >= self.__poll_interval:
+                        self.scan()
+                        last_scan = time.monotonic()
+                self.__enqueue_settled()
+        finally:
+            self.__stopping.set()
+            for worker in workers:
+                worker.join()
+            while True:
+                try:
+                    self.__drop(self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self.__lock:
+                self.__running = False
+                self.__idle.notify_all()
+            if source is not None:
+                source.close()
+
+    def stop(self):
+        # Stop watching. Bills being processed are finished, queued ones are left for the next run.
+        self.__stopping.set()
+
+    def wait_idle(self, timeout=None):
+        # Wait until no file is unsettled, queued or being processed, or the watcher has stopped.
+        # Returns False on timeout.
+        with self.__idle:
+            return self.__idle.wait_for(lambda: self.__busy == 0 and (not self.__candidates or not self.__running),
+                                        timeout)
+
+    def close(self):
+        self.stop()
+        if self.__journal is not None:
+            self.__journal.close()
+
+    def __compact_journal(self):
+        if self.__journal is None:
+            return
+        self.__journal.compact(keep=lambda path, record: os.path.exists(path))
+        with self.__lock:
+            self.__processed = {path: state for path, state in self.__processed.items() if os.path.exists(path)}
+
+    def scan(self):
+        # Look at every file of the inbox: on start-up, when polling, and after lost inotify events.
+        # Only stats the files, processed ones are recognised by their size and mtime.
+        try:
+            entries = list(os.scandir(self.__inbox))
+        except OSError as e:
+            _logger.error("Scanning %s failed: %s", self.__inbox, e)
+            return
+        for entry in entries:
+            if self.__matches(entry.name) and entry.is_file():
+                self.__observe(entry.path)
+
+    def __observe(self, path, closed=False):
+        try:
+            st = os.stat(path)
+        except OSError:
+            with self.__lock:
+                self.__candidates.pop(path, None)
+                self.__idle.notify_all()
+            return
+        state = (st.st_size, st.st_mtime_ns)
+        with self.__lock:
+            if self.__processed.get(path) == state:
+                return
+            candidate = self.__candidates.get(path)
+            if candidate is None or (candidate[0], candidate[1]) != state:
+                self.__candidates[path] = [st.st_size, st.st_mtime_ns, time.monotonic(), closed]
+            elif closed:
+                candidate[3] = True
+
+    def __enqueue_settled(self):
+        now = time.monotonic()
+        with self.__lock:
+            candidates = list(self.__candidates.items())
+        for path, (size, mtime_ns, changed_at, closed) in candidates:
+            try:
+                st = os.stat(path)
+            except OSError:
+                settled = None
+            else:
+                if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+                    # Still being written
+                    self.__observe(path)
+                    continue
+                settled = closed or now - changed_at >= self.__settle
+            if settled is False:
+                continue
+            if settled and path.lower().endswith(".pdf") and not is_complete_pdf(path):
+                # Truncated, or its writer paused: look at it again after another settle period
+                with self.__lock:
+                    self.__candidates[path] = [size, mtime_ns, now, False]
+                continue
+            with self.__lock:
+                del self.__candidates[path]
+                if settled:
+                    self.__processed[path] = (size, mtime_ns)
+                    self.__busy += 1
+                self.__idle.notify_all()
+            if settled:
+                self.__put(path)
+
+    def __put(self, path):
+        if self.__journal is not None:
+            self.__journal.record(path, STATE_QUEUED)
+        # Blocks while the queue is full, applying backpressure to the watcher
+        while not self.__stopping.is_set():
+            try:
+                self.__queue.put(path, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+        self.__drop(path)
+
+    def __drop(self, path):
+        # A file queued but not processed because the watcher stopped: the next run picks it up again
+        with self.__lock:
+            self.__processed.pop(path, None)
+            self.__busy -= 1
+            self.__idle.notify_all()
+
+    def __work(self):
+        while True:
+            try:
+                path = self.__queue.get(timeout=0.2)
+            except queue.Empty:
+                if self.__stopping.is_set():
+                    return
+                continue
+            if self.__stopping.is_set():
+                self.__drop(path)
+                return
+            try:
+                result = self.__processor.process(path)
+                if self.__journal is not None:
+                    record_result(self.__journal, result)
+                    with self.__lock:
+                        self.__recorded += 1
+                        compact = self.__recorded % self.__compact_interval == 0
+                    if compact:
+                        self.__compact_journal()
+                if self.__on_result is not None:
+                    self.__on_result(result)
+            except Exception as e:
+                _logger.error("Handling of %s failed: %s", path, e)
+            finally:
+                with self.__lock:
+                    self.__busy -= 1
+                    self.__idle.notify_all()
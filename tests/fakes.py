@@ -0,0 +1,20 @@
+# Stand-ins for the Landing.AI ADE clients, shared by the tests
+
+
+class Failing_ADE_Client(object):
+    # Any call to the ADE client fails, so bills missing from the cache fail and a test proves results
+    # come from the cache only
+    def parse(self, **kwargs):
+        raise RuntimeError("ADE parse called")
+
+    def extract(self, **kwargs):
+        raise RuntimeError("ADE extract called")
+
+
+class Async_Failing_ADE_Client(object):
+    # Failing_ADE_Client for Async_Utility_Bill_Processor
+    async def parse(self, **kwargs):
+        raise RuntimeError("ADE parse called")
+
+    async def extract(self, **kwargs):
+        raise RuntimeError("ADE extract called")
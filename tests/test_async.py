@@ -0,0 +1,42 @@
+import asyncio
+from src.iraklis7_ubp.utility_async import Async_Utility_Bill_Processor
+from tests.fakes import Async_Failing_ADE_Client
+
+
+async def run_batch():
+    results = []
+    async with Async_Utility_Bill_Processor(output_dir="output/", use_cache=True, max_in_flight=2,
+                                            ade_client=Async_Failing_ADE_Client()) as processor:
+        async for result in processor.process_many("tests/invoices/*.pdf"):
+            results.append(result)
+    return results
+
+
+def test_async():
+    results = asyncio.run(run_batch())
+    print("{:<40} {:<10}".format('FILE', 'RESULT'))
+    for result in results:
+        print("{:<40} {:<10}".format(result.filename, "OK" if result.ok() else str(result.error)))
+
+    assert len(results) == 2
+    for result in results:
+        assert result.ok()
+
+
+async def run_local_extraction():
+    async with Async_Utility_Bill_Processor(output_dir="output/", use_cache=True, local_extraction=True,
+                                            ade_client=Async_Failing_ADE_Client()) as processor:
+        return await processor.process("tests/invoices/GasInvoice_2025-12-04.pdf")
+
+
+def test_async_local_extraction():
+    # Local extractions carry the bill's filename, as with the synchronous processor
+    result = asyncio.run(run_local_extraction())
+    assert result.ok()
+    assert result.extract_response.metadata.version == "local-rules"
+    assert result.extract_response.metadata.filename == "GasInvoice_2025-12-04.pdf"
+
+
+if __name__ == '__main__':
+    test_async()
+    test_async_local_extraction()
@@ -0,0 +1,19 @@
+from src.iraklis7_ubp.utility_proc import Utility_Bill_Processor
+
+
+def test_batch():
+    processor = Utility_Bill_Processor(env="eu", output_dir="output/", use_cache=True)
+
+    results = list(processor.process_many("tests/invoices/*.pdf", max_workers=2))
+    print("{:<40} {:<10}".format('FILE', 'RESULT'))
+    for result in results:
+        print("{:<40} {:<10}".format(result.filename, "OK" if result.ok() else str(result.error)))
+
+    assert len(results) == 2
+    for result in results:
+        assert result.ok()
+        assert result.extract_response.extraction["bill_total_amount"] is not None
+
+
+if __name__ == '__main__':
+    test_batch()
@@ -0,0 +1,174 @@
+import os
+import glob
+import json
+import shutil
+import sqlite3
+from landingai_ade.types.parse_response import ParseResponse
+from src.iraklis7_ubp import utility_cache
+from src.iraklis7_ubp.utility_cache import Utility_Bill_Cache, Cache_Policy, CACHE_INDEX_NAME
+from src.iraklis7_ubp.utility_schema import get_schema
+
+
+def test_cache_migration(tmp_path):
+    for sidecar in glob.glob("output/*.json"):
+        shutil.copy(sidecar, tmp_path)
+    cache = Utility_Bill_Cache(str(tmp_path))
+
+    # A renamed copy of a bill hits the same cache entry
+    renamed = tmp_path / "renamed.pdf"
+    shutil.copy("tests/invoices/GasInvoice_2025-12-04.pdf", renamed)
+    parse_res = cache.get_parse(cache.get_file_digest(renamed), input_path=renamed)
+    assert parse_res is not None
+
+    extract_res = cache.get_extract(parse_res.markdown, get_schema(parse_res.markdown))
+    assert extract_res is not None
+    assert extract_res.extraction["document_number"] == "ΛΦΑ 192434411"
+
+    # A different model id is a different cache entry
+    assert cache.get_parse(cache.get_file_digest(renamed), model="dpt-1") is None
+    cache.close()
+
+
+def test_cache_legacy_rekey(tmp_path):
+    # Migrated entries cost each file at most one MD5 pass, and those no bill claims are dropped in the end
+    for sidecar in glob.glob("output/GasInvoice_2025-12-04.pdf.*.json") + glob.glob("output/AKN*.json"):
+        shutil.copy(sidecar, tmp_path)
+    cache = Utility_Bill_Cache(str(tmp_path))
+    bill = tmp_path / "bill.pdf"
+    shutil.copy("tests/invoices/GasInvoice_2025-12-04.pdf", bill)
+    new_bill = tmp_path / "new.pdf"
+    new_bill.write_bytes(b"%PDF-1.4 not cached")
+
+    md5_passes = []
+    digest_file = utility_cache.digest_file
+    utility_cache.digest_file = lambda path, algorithm="blake2b": (md5_passes.append(algorithm == "md5"),
+                                                                   digest_file(path, algorithm))[1]
+    try:
+        assert cache.get_parse(cache.get_file_digest(bill), input_path=bill) is not None
+        assert md5_passes.count(True) == 1
+        for _ in range(2):
+            assert cache.get_parse(cache.get_file_digest(new_bill), input_path=new_bill) is None
+        assert md5_passes.count(True) == 2
+        cache.close()
+
+        conn = sqlite3.connect(str(tmp_path / CACHE_INDEX_NAME))
+        with conn:
+            conn.execute("UPDATE meta SET value = '0' WHERE name = 'sidecars_migrated_at'")
+        cache = Utility_Bill_Cache(str(tmp_path))
+        other_bill = tmp_path / "other.pdf"
+        other_bill.write_bytes(b"%PDF-1.4 not cached either")
+        assert cache.get_parse(cache.get_file_digest(other_bill), input_path=other_bill) is None
+        assert md5_passes.count(True) == 2
+        assert conn.execute("SELECT COUNT(*) FROM entries WHERE content_digest LIKE 'md5:%'").fetchone()[0] == 0
+        conn.close()
+    finally:
+        utility_cache.digest_file = digest_file
+    cache.close()
+
+
+def test_cache_stat_fast_path(tmp_path):
+    cache = Utility_Bill_Cache(str(tmp_path / "cache"))
+    bill = tmp_path / "bill.pdf"
+    bill.write_bytes(b"first version")
+    first = cache.get_file_digest(bill)
+    assert first.startswith("blake2b:")
+
+    # Same size and restored mtime: the recorded digest is trusted
+    st = os.stat(bill)
+    bill.write_bytes(b"other version")
+    os.utime(bill, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert cache.get_file_digest(bill) == first
+
+    # Strict mode always re-hashes
+    strict_cache = Utility_Bill_Cache(str(tmp_path / "cache"), strict=True)
+    assert strict_cache.get_file_digest(bill) != first
+
+    # A changed mtime invalidates the recorded digest
+    os.utime(bill, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    assert cache.get_file_digest(bill) != first
+    cache.close()
+    strict_cache.close()
+
+
+def test_cache_compact_payloads(tmp_path):
+    with open("output/GasInvoice_2025-12-04.pdf.parse.json", encoding="utf-8") as f:
+        parse_json = json.load(f)
+    for codec in ["json", "zlib"]:
+        cache = Utility_Bill_Cache(str(tmp_path / codec), codec=codec)
+        cache.put_parse("blake2b:00", ParseResponse(**parse_json))
+
+        # Only the markdown is decoded on a hit, the rest of the response on first use
+        response = cache.get_parse("blake2b:00")
+        assert response.markdown == parse_json["markdown"]
+        assert len(response.chunks) == len(parse_json["chunks"])
+        assert isinstance(response.get_response(), ParseResponse)
+        assert cache.get_markdown("blake2b:00") == parse_json["markdown"]
+        cache.close()
+
+    sizes = {codec: os.path.getsize(tmp_path / codec / "cache.sqlite3") for codec in ["json", "zlib"]}
+    print("{:<10} {:<10}".format('CODEC', 'BYTES'))
+    for codec, size in sizes.items():
+        print("{:<10} {:<10}".format(codec, size))
+
+
+def test_cache_lifecycle(tmp_path):
+    with open("output/GasInvoice_2025-12-04.pdf.parse.json", encoding="utf-8") as f:
+        response = ParseResponse(**json.load(f))
+    cache = Utility_Bill_Cache(str(tmp_path))
+    for i in range(20):
+        cache.put_parse("blake2b:%02d" % i, response, model="dpt-" + str(i % 2))
+    # Recently hit entries survive LFU eviction
+    for i in range(15, 20):
+        assert cache.get_parse("blake2b:%02d" % i, model="dpt-" + str(i % 2)) is not None
+    assert cache.enforce_limits(Cache_Policy(max_entries=10, eviction="lfu")) == 11
+    assert cache.get_stats()["entries"] == 9
+    for i in range(15, 20):
+        assert cache.get_markdown("blake2b:%02d" % i, model="dpt-" + str(i % 2)) is not None
+
+    # Invalidation by model version
+    assert cache.invalidate(model="dpt-0") == 4
+    stats = cache.get_stats()
+    print("{:<10} {:<10} {:<10} {:<10} {:<10}".format('STAGE', 'MODEL', 'ENTRIES', 'BYTES', 'HITS'))
+    for stage in stats["stages"]:
+        print("{:<10} {:<10} {:<10} {:<10} {:<10}".format(stage["stage"], stage["model"], stage["entries"],
+                                                          stage["bytes"], stage["hits"]))
+    assert [stage["model"] for stage in stats["stages"]] == ["dpt-1"]
+    cache.close()
+
+    # Expired entries are misses, and are deleted by prune()
+    cache = Utility_Bill_Cache(str(tmp_path), policy=Cache_Policy(ttl={"parse": 0}))
+    assert cache.get_parse("blake2b:19", model="dpt-1") is None
+    assert cache.prune(vacuum=True)["expired"] == 5
+    assert cache.get_stats()["entries"] == 0
+    cache.close()
+
+
+def test_cache_limits(tmp_path):
+    # A bounded cache stays within its limits as entries are written, going by its running totals
+    with open("output/GasInvoice_2025-12-04.pdf.parse.json", encoding="utf-8") as f:
+        response = ParseResponse(**json.load(f))
+    cache = Utility_Bill_Cache(str(tmp_path), policy=Cache_Policy(max_entries=10))
+    for i in range(25):
+        cache.put_parse("blake2b:%02d" % i, response)
+        assert cache.get_stats()["entries"] <= 10
+    # Overwrites, invalidation and pruning keep the totals right
+    cache.put_parse("blake2b:24", response)
+    cache.invalidate(model="dpt-0")
+    cache.prune()
+    stats = cache.get_stats()
+    cache.close()
+    conn = sqlite3.connect(str(tmp_path / CACHE_INDEX_NAME))
+    totals = dict(conn.execute("SELECT name, value FROM meta WHERE name IN ('total_entries', 'total_bytes')"))
+    conn.close()
+    assert (int(totals["total_entries"]), int(totals["total_bytes"])) == (stats["entries"], stats["bytes"])
+
+
+if __name__ == '__main__':
+    import tempfile
+    from pathlib import Path
+    test_cache_migration(Path(tempfile.mkdtemp()))
+    test_cache_legacy_rekey(Path(tempfile.mkdtemp()))
+    test_cache_stat_fast_path(Path(tempfile.mkdtemp()))
+    test_cache_compact_payloads(Path(tempfile.mkdtemp()))
+    test_cache_lifecycle(Path(tempfile.mkdtemp()))
+    test_cache_limits(Path(tempfile.mkdtemp()))
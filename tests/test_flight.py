@@ -0,0 +1,117 @@
+import json
+import time
+import asyncio
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from landingai_ade.types.parse_response import ParseResponse
+from landingai_ade.types.extract_response import ExtractResponse
+from src.iraklis7_ubp.utility_proc import Utility_Bill_Processor
+from src.iraklis7_ubp.utility_async import Async_Utility_Bill_Processor
+from src.iraklis7_ubp.utility_metrics import Utility_Bill_Metrics
+
+
+class Slow_ADE_Client(object):
+    # Counts calls, and is slow enough for duplicate requests to overlap
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.parse_calls = 0
+        self.extract_calls = 0
+        with open("output/GasInvoice_2025-12-04.pdf.parse.json", encoding="utf-8") as f:
+            self.parse_json = json.load(f)
+        with open("output/GasInvoice_2025-12-04.pdf.extract.json", encoding="utf-8") as f:
+            self.extract_json = json.load(f)
+
+    def parse(self, **kwargs):
+        with self.lock:
+            self.parse_calls += 1
+        time.sleep(self.delay)
+        return ParseResponse(**self.parse_json)
+
+    def extract(self, **kwargs):
+        with self.lock:
+            self.extract_calls += 1
+        time.sleep(self.delay)
+        return ExtractResponse(**self.extract_json)
+
+
+def copy_bills(tmp_path, count):
+    paths = []
+    for i in range(count):
+        path = tmp_path / ("upload_" + str(i) + ".pdf")
+        shutil.copy("tests/invoices/GasInvoice_2025-12-04.pdf", path)
+        paths.append(str(path))
+    return paths
+
+
+def test_flight_in_process(tmp_path):
+    client = Slow_ADE_Client()
+    metrics = Utility_Bill_Metrics()
+    processor = Utility_Bill_Processor(output_dir=str(tmp_path / "cache"), ade_client=client, metrics=metrics)
+    results = list(processor.process_many(copy_bills(tmp_path, 4), max_workers=4))
+    processor.close()
+
+    print("{:<15} {:<15} {:<15}".format('PARSE CALLS', 'EXTRACT CALLS', 'COALESCED'))
+    print("{:<15} {:<15} {:<15}".format(client.parse_calls, client.extract_calls,
+                                        metrics.get_counter("coalesced_calls", stage="parse")))
+    # Four uploads of the same bill, one paid call per stage
+    assert all(result.ok() for result in results)
+    assert client.parse_calls == 1
+    assert client.extract_calls == 1
+    assert metrics.get_counter("coalesced_calls", stage="parse") == 3
+
+
+def test_flight_cross_process(tmp_path):
+    # Two processors stand in for two processes sharing a cache directory and a lock directory
+    client = Slow_ADE_Client()
+    processors = [Utility_Bill_Processor(output_dir=str(tmp_path / "cache"), use_cache=True, ade_client=client,
+                                         lock_dir=str(tmp_path / "locks")) for _ in range(2)]
+    paths = copy_bills(tmp_path, 2)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(lambda args: args[0].process(args[1]), zip(processors, paths)))
+    for processor in processors:
+        processor.close()
+
+    assert all(result.ok() for result in results)
+    assert client.parse_calls == 1
+    assert client.extract_calls == 1
+
+
+class Async_Slow_ADE_Client(object):
+    def __init__(self):
+        self.client = Slow_ADE_Client()
+
+    async def parse(self, **kwargs):
+        return await asyncio.to_thread(self.client.parse, **kwargs)
+
+    async def extract(self, **kwargs):
+        return await asyncio.to_thread(self.client.extract, **kwargs)
+
+
+async def run_async_cross_process(tmp_path, paths):
+    # A single executor thread: a lock waiter occupying it must not keep the holder from finishing
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=1))
+    client = Async_Slow_ADE_Client()
+    processors = [Async_Utility_Bill_Processor(output_dir=str(tmp_path / "cache"), use_cache=True, ade_client=client,
+                                               lock_dir=str(tmp_path / "locks")) for _ in range(2)]
+    results = await asyncio.wait_for(
+        asyncio.gather(*[processor.process(path) for processor, path in zip(processors, paths)]), timeout=30)
+    for processor in processors:
+        await processor.close()
+    return client.client, results
+
+
+def test_flight_async_cross_process(tmp_path):
+    client, results = asyncio.run(run_async_cross_process(tmp_path, copy_bills(tmp_path, 2)))
+    assert all(result.ok() for result in results)
+    assert client.parse_calls == 1
+    assert client.extract_calls == 1
+
+
+if __name__ == '__main__':
+    import tempfile
+    from pathlib import Path
+    test_flight_in_process(Path(tempfile.mkdtemp()))
+    test_flight_cross_process(Path(tempfile.mkdtemp()))
+    test_flight_async_cross_process(Path(tempfile.mkdtemp()))
@@ -0,0 +1,50 @@
+import os
+import ast
+import glob
+import json
+from src.iraklis7_ubp.utility_proc import Utility_Bill_Processor
+from src.iraklis7_ubp.utility_rules import Local_Extractor
+
+
+def test_local_extraction_accuracy():
+    # Every bill the local rules accept must match the expected values exactly
+    extractor = Local_Extractor()
+    print("{:<40} {:<10}".format('FILE', 'RESULT'))
+    for parse_file in sorted(glob.glob("output/*.parse.json")):
+        filename = os.path.basename(parse_file)[:-len(".parse.json")]
+        with open(parse_file, 'r', encoding='utf-8') as f:
+            markdown = json.load(f)['markdown']
+        with open("tests/expected/" + filename + ".exp", 'r', encoding='utf-8') as f:
+            expected_values = ast.literal_eval(f.read())
+
+        values = extractor.extract(markdown)
+        print("{:<40} {:<10}".format(filename, "local" if values is not None else "fallback"))
+        if values is None:
+            continue
+        for key, value in values.items():
+            exp_value = expected_values[key]
+            if exp_value is None:
+                exp_value = "None"
+            assert value == exp_value, key + ": " + str(value) + " != " + str(exp_value)
+
+    stats = extractor.get_stats()
+    print("Hits: " + str(stats["hits"]) + ", fallbacks: " + str(stats["fallbacks"]))
+    assert stats["hits"] >= 2
+
+
+def test_local_extraction_fallback():
+    # Bills the rules can't fully extract fall back to the (cached) ADE extract results
+    processor = Utility_Bill_Processor(env="eu", output_dir="output/", use_cache=True, local_extraction=True)
+    results = list(processor.process_many("tests/invoices/*.pdf", max_workers=2))
+    assert all(result.ok() for result in results)
+    versions = {result.filename: result.extract_response.metadata.version for result in results}
+    assert versions["GasInvoice_2025-12-04.pdf"] == "local-rules"
+    assert {result.extract_response.metadata.filename for result in results
+            if result.extract_response.metadata.version == "local-rules"} == {"GasInvoice_2025-12-04.pdf"}
+    assert versions["ElectricityInvoice_2025-11-04.pdf"] != "local-rules"
+    assert processor.get_local_extraction_stats() == dict(hits=1, fallbacks=1, hit_ratio=0.5)
+
+
+if __name__ == '__main__':
+    test_local_extraction_accuracy()
+    test_local_extraction_fallback()
@@ -0,0 +1,62 @@
+import logging
+from src.iraklis7_ubp.utility_proc import Utility_Bill_Processor
+from src.iraklis7_ubp.utility_logging import LOGGER_NAME, get_payload_logger, configure_logging, shutdown_logging
+
+
+def get_own_handlers(logger):
+    # Ignore handlers added by the test runner's log capturing
+    return [handler for handler in logger.handlers if handler.get_name() == LOGGER_NAME]
+
+
+def test_logging(tmp_path):
+    root_handlers = list(logging.getLogger().handlers)
+    processors = [Utility_Bill_Processor(env="eu", output_dir="output/", use_cache=True) for _ in range(3)]
+
+    # Using the package leaves logging to the application
+    logger = logging.getLogger(LOGGER_NAME)
+    assert get_own_handlers(logger) == []
+    assert logger.propagate and logger.level == logging.NOTSET
+    # Full response dumps are opt-in
+    assert not get_payload_logger().isEnabledFor(logging.DEBUG)
+
+    # log_payloads is per processor, and leaves the process-wide setting alone
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    get_payload_logger().addHandler(handler)
+    try:
+        logging_processor = Utility_Bill_Processor(env="eu", output_dir="output/", use_cache=True, log_payloads=True)
+        quiet_processor = Utility_Bill_Processor(env="eu", output_dir="output/", use_cache=True, log_payloads=False)
+        assert not get_payload_logger().isEnabledFor(logging.DEBUG)
+        assert quiet_processor.process("tests/invoices/GasInvoice_2025-12-04.pdf").ok()
+        assert records == []
+        assert logging_processor.process("tests/invoices/GasInvoice_2025-12-04.pdf").ok()
+        assert [record.getMessage().split(":")[0] for record in records] == ["Parse response from cache",
+                                                                             "Extract response from cache"]
+        logging_processor.close()
+        quiet_processor.close()
+    finally:
+        get_payload_logger().removeHandler(handler)
+
+    # Handlers are added once per process, and never to the root logger
+    log_file = tmp_path / "ubp.log"
+    for _ in range(3):
+        configure_logging(log_file=str(log_file))
+    print("{:<30} {:<10}".format('LOGGER', 'HANDLERS'))
+    print("{:<30} {:<10}".format(LOGGER_NAME, len(get_own_handlers(logger))))
+    assert len(get_own_handlers(logger)) == 1
+    assert logging.getLogger().handlers == root_handlers
+    assert not logger.propagate
+    logger.debug("configured")
+    shutdown_logging()
+    assert "configured" in log_file.read_text(encoding="utf-8")
+    assert get_own_handlers(logger) == [] and logger.propagate
+
+    for processor in processors:
+        processor.close()
+
+
+if __name__ == '__main__':
+    import tempfile
+    from pathlib import Path
+    test_logging(Path(tempfile.mkdtemp()))
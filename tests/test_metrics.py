@@ -0,0 +1,37 @@
+from src.iraklis7_ubp.utility_proc import Utility_Bill_Processor
+from src.iraklis7_ubp.utility_metrics import Utility_Bill_Metrics
+
+
+def test_metrics():
+    metrics = Utility_Bill_Metrics()
+    processor = Utility_Bill_Processor(env="eu", output_dir="output/", use_cache=True, metrics=metrics)
+
+    results = list(processor.process_many("tests/invoices/*.pdf", max_workers=2))
+    processor.close()
+
+    print("{:<20} {:<40} {:<10} {:<10}".format('STAGE', 'LABELS', 'COUNT', 'SUM (s)'))
+    for timer in metrics.snapshot()["timers"]:
+        print("{:<20} {:<40} {:<10} {:<10.6f}".format(timer["stage"], str(timer["labels"]), timer["count"],
+                                                       timer["sum_s"]))
+
+    assert all(result.ok() for result in results)
+    # Both bills are served from the committed cache, the ADE API is never called
+    assert metrics.get_counter("cache_hits", stage="parse") == 2
+    assert metrics.get_counter("cache_hits", stage="extract") == 2
+    stages = set(timer["stage"] for timer in metrics.snapshot()["timers"])
+    assert set(["parse", "schema", "extract", "cache_read"]) <= stages
+    assert "api" not in stages
+    # The full responses are only built when asked for
+    assert "cache_build" not in stages
+    assert results[0].parse_response.metadata.page_count > 0
+    stages = set(timer["stage"] for timer in metrics.snapshot()["timers"])
+    assert "cache_build" in stages
+
+    text = metrics.to_openmetrics()
+    assert 'ubp_stage_seconds_count{stage="parse"} 2' in text
+    assert 'ubp_cache_hits_total{stage="extract"} 2' in text
+    assert text.endswith("# EOF\n")
+
+
+if __name__ == '__main__':
+    test_metrics()
@@ -0,0 +1,77 @@
+import glob
+import json
+import threading
+from landingai_ade.types.parse_response import ParseResponse
+from src.iraklis7_ubp.utility_proc import Utility_Bill_Processor
+from src.iraklis7_ubp.utility_pages import Page_Splitter, split_pdf, split_and_digest
+from src.iraklis7_ubp.utility_metrics import Utility_Bill_Metrics
+
+
+def split_text_pages(input_path):
+    # Stand-in for split_pdf: "documents" are text files with form feed separated pages
+    with open(input_path, "rb") as f:
+        return f.read().split(b"\f")
+
+
+class Page_ADE_Client(object):
+    # Parses a page into its text, and records which pages were sent
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = []
+        with open("output/GasInvoice_2025-12-04.pdf.parse.json", encoding="utf-8") as f:
+            self.parse_json = json.load(f)
+
+    def parse(self, document, **kwargs):
+        filename, data = document
+        with self.lock:
+            self.pages.append(data.decode("utf-8"))
+        return ParseResponse(**dict(self.parse_json, markdown=data.decode("utf-8")))
+
+
+def test_page_cache(tmp_path):
+    client = Page_ADE_Client()
+    metrics = Utility_Bill_Metrics()
+    splitter = Page_Splitter(max_workers=2, split=split_text_pages)
+    processor = Utility_Bill_Processor(output_dir=str(tmp_path / "cache"), use_cache=True, ade_client=client,
+                                       metrics=metrics, page_splitter=splitter)
+    november = tmp_path / "statement_11.pdf"
+    november.write_bytes(b"summary 11\fdetails\fterms")
+    december = tmp_path / "statement_12.pdf"
+    december.write_bytes(b"summary 12\fdetails\fterms")
+
+    response = processor.parse(str(november))
+    assert response.markdown == "summary 11\n\ndetails\n\nterms"
+    assert response.metadata.page_count == 3
+    assert sorted(set(chunk.grounding.page for chunk in response.chunks)) == [0, 1, 2]
+
+    # Only the changed page of the next statement is sent to ADE
+    response = processor.parse(str(december))
+    assert response.markdown == "summary 12\n\ndetails\n\nterms"
+    processor.close()
+    splitter.close()
+
+    print("{:<10} {:<10}".format('SOURCE', 'PAGES'))
+    for source in ["api", "cache"]:
+        print("{:<10} {:<10}".format(source, metrics.get_counter("pages", source=source)))
+    assert sorted(client.pages) == ["details", "summary 11", "summary 12", "terms"]
+    assert metrics.get_counter("pages", source="cache") == 2
+
+
+def test_split_pdf_digests():
+    # Page digests are only reused if splitting a PDF again writes the same bytes
+    for input_path in sorted(glob.glob("tests/invoices/*.pdf")):
+        try:
+            first = [digest for digest, page in split_and_digest(split_pdf, input_path)]
+        except ImportError as e:
+            print(str(e) + ", skipping")
+            return
+        assert len(first) > 0
+        assert [digest for digest, page in split_and_digest(split_pdf, input_path)] == first, input_path
+        print(input_path + ": " + str(len(first)) + " pages")
+
+
+if __name__ == '__main__':
+    import tempfile
+    from pathlib import Path
+    test_page_cache(Path(tempfile.mkdtemp()))
+    test_split_pdf_digests()
@@ -1,7 +1,10 @@
-import glob
-import ast
-from pathlib import Path
+import os
+import json
+import tempfile
+from xml.etree import ElementTree
 from src.iraklis7_ubp.utility_proc import Utility_Bill_Processor
+from src.iraklis7_ubp.utility_regression import (Utility_Bill_Regression, compare_fields, find_regressions,
+                                                 is_failure, write_json_report, write_junit_report)
 
 
 class bcolors:
@@ -17,60 +20,79 @@ class bcolors:
 
 
 def test_regression():
-    total_differences = 0
-    expected_values_path = "tests/expected"
-    processor = Utility_Bill_Processor(env="eu", output_dir="output/", use_cache=True)
-    filelist = glob.glob("tests/invoices/*.pdf")
-    for i in range(len(filelist)):
-        print("Processing file: " + filelist[i])
-
-        try:
-            parse_res = processor.parse(filelist[i])
-            schema = processor.get_schema(parse_res.markdown)
-            extract_res = processor.extract(parse_res.markdown, schema)
-        except Exception as e:
-            print("Error processing file " + filelist[i] + ": " + str(e))
-            continue
-
-        ext_values = extract_res.extraction
-
-        print("{:<30} {:<30} {:<30} {:<10}".format('FIELD', 'VALUE', 'EXPECTED', 'RESULT'))
-
-        expected_values_from_file = None
-        exp_file = Path(expected_values_path + "/" + processor.get_filename() + ".exp")
-        try:
-            with open(Path(exp_file), 'r') as sc_file:
-                expected_values_from_file = sc_file.read()
-                sc_file.close()
-        except FileNotFoundError as e:
-            print("Error reading expected values from file: " + str(e))
-            return
-        expected_values = ast.literal_eval(expected_values_from_file)
-        total_differences += compare_results(ext_values, expected_values)
+    # Served from the cache: the corpus is compared without calling the ADE API
+    processor = Utility_Bill_Processor(env="eu", output_dir="output/", use_cache=True, offline=True)
+    report = Utility_Bill_Regression(processor, "tests/expected").run(["tests/invoices/*.pdf"], max_workers=8)
+    processor.close()
 
+    for case in report["cases"]:
+        print("Processing file: " + case["file"] + " (" + case["status"] + ")")
+        if case["error"] is not None:
+            print("Error processing file " + case["file"] + ": " + case["error"])
+        print_diffs(case["diffs"])
+
+    summary = report["summary"]
+    total_differences = summary["field_mismatches"]
     if (total_differences == 0):
         print(f"{bcolors.OKGREEN}Total Differences: {total_differences}{bcolors.ENDC}")
     else:
         print(f"{bcolors.FAIL}Total Differences: {total_differences}{bcolors.ENDC}")
+    print("Unmatched expectations: " + str(summary["unmatched_expectations"]))
+    assert summary["total"] == 2
+    assert summary["passed"] == 2
+    assert not is_failure(report)
+
 
+def print_diffs(diffs):
+    print("{:<30} {:<30} {:<30} {:<10}".format('FIELD', 'VALUE', 'EXPECTED', 'RESULT'))
+    for diff in diffs:
+        values_match_c = u'\N{check mark}' if diff["status"] == "match" else u'\N{cross mark}'
+        print("{:<30} {:<30} {:<30} {:<10}".format(diff["field"], str(diff["actual"]), str(diff["expected"]),
+                                                   values_match_c))
+    print("\n")
 
-def compare_results(extracted_values, expected_values):
-    mismatches = 0
 
-    for key, value in extracted_values.items():
-        if value is None:
-            value = "None"
-        exp_value = expected_values[key]
-        if exp_value is None:
-            exp_value = "None"
+def test_compare_fields():
+    expected = dict(total=329, rate=0.1234, name="ACME", due='None', refund=None, meter="A1")
+    actual = dict(total=329.004, rate=0.1334, name="ACME", due=None, refund='None', extra=1)
+    diffs = {diff["field"]: diff["status"] for diff in compare_fields(actual, expected)}
+    print_diffs(compare_fields(actual, expected))
+    assert diffs == dict(total="match", rate="mismatch", name="match", due="match", refund="match",
+                         meter="missing", extra="unexpected")
+    # Relative tolerance
+    assert compare_fields(dict(total=1010.0), dict(total=1000), abs_tol=0, rel_tol=0.01)[0]["status"] == "match"
+    assert compare_fields(dict(total=1011.0), dict(total=1000), abs_tol=0, rel_tol=0.01)[0]["status"] == "mismatch"
+
+
+def test_reports():
+    case = dict(file="a.pdf", bill_class="Utility_Bill_Gas", status="failed", error=None,
+                diffs=[dict(field="total", expected=10, actual=11, status="mismatch"),
+                       dict(field="rate", expected=1, actual=1, status="match")])
+    baseline_case = dict(case, diffs=[dict(field="total", expected=10, actual=11, status="mismatch"),
+                                      dict(field="rate", expected=1, actual=2, status="mismatch")])
+    summary = dict(total=1, passed=0, failed=1, error=0, missing_expectations=0, elapsed_s=0.1)
+    report = dict(cases=[case], summary=summary)
+    baseline = dict(cases=[baseline_case], summary=summary)
+
+    # total was already wrong in the baseline: a known failure, not a regression
+    assert is_failure(report)
+    assert find_regressions(report, baseline) == []
+    assert not is_failure(report, baseline)
+    assert [regression["field"] for regression in find_regressions(baseline, report)] == ["rate"]
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        write_json_report(report, os.path.join(work_dir, "report.json"))
+        write_junit_report(report, os.path.join(work_dir, "report.xml"))
+        with open(os.path.join(work_dir, "report.json"), encoding="utf-8") as f:
+            assert json.load(f) == report
+        suite = ElementTree.parse(os.path.join(work_dir, "report.xml")).getroot()
+    print(ElementTree.tostring(suite, encoding="unicode"))
+    assert suite.get("failures") == "1"
+    assert suite.find("testcase").get("name") == "a.pdf"
+    assert "total: expected 10, got 11" in suite.find("testcase/failure").text
 
-        values_match_c = u'\N{check mark}'
-        if (value != exp_value):
-            mismatches += 1
-            values_match_c = u'\N{cross mark}'
-        print("{:<30} {:<30} {:<30} {:<10}".format(key, value, exp_value, values_match_c))
-    print("\n")
-    return mismatches
 
 if __name__ == '__main__':
-    test_regression()
\ No newline at end of file
+    test_compare_fields()
+    test_reports()
+    test_regression()
@@ -0,0 +1,78 @@
+import os
+import json
+import shutil
+from src.iraklis7_ubp.utility_proc import Utility_Bill_Processor
+from src.iraklis7_ubp.utility_batch import Utility_Bill_Batch, Utility_Bill_Journal, STATE_QUEUED, STATE_EXTRACTED, \
+    STATE_FAILED
+from tests.fakes import Failing_ADE_Client
+
+
+def test_resume(tmp_path):
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    for bill in ["GasInvoice_2025-12-04.pdf", "ElectricityInvoice_2025-11-04.pdf"]:
+        shutil.copy("tests/invoices/" + bill, inbox / bill)
+    # Not a bill the cache knows
+    (inbox / "broken.pdf").write_bytes(b"not a pdf")
+    journal_path = str(tmp_path / "journal.ndjson")
+    processor = Utility_Bill_Processor(env="eu", output_dir="output/", use_cache=True,
+                                       ade_client=Failing_ADE_Client())
+
+    with Utility_Bill_Batch(processor, journal_path, results_dir=str(tmp_path / "results")) as runner:
+        first = list(runner.run(str(inbox / "*.pdf"), max_workers=2))
+        summary = runner.get_journal().get_summary()
+    assert len(first) == 3
+    assert summary == {STATE_EXTRACTED: 2, STATE_FAILED: 1}
+    record = runner.get_journal().get(str(inbox / "GasInvoice_2025-12-04.pdf"))
+    with open(tmp_path / "results" / record["result"], encoding="utf-8") as f:
+        assert json.load(f)["document_number"] == "ΛΦΑ 192434411"
+    assert not [name for name in os.listdir(tmp_path / "results") if name.endswith(".tmp")]
+
+    # A crash may leave a truncated last line behind
+    with open(journal_path, "a", encoding="utf-8") as f:
+        f.write('{"path": "trunc')
+
+    # Resuming skips done and failed files, unless failures are retried explicitly
+    with Utility_Bill_Batch(processor, journal_path) as runner:
+        assert list(runner.run(str(inbox / "*.pdf"))) == []
+        retried = list(runner.retry_failures())
+    processor.close()
+
+    print("{:<40} {:<10}".format('FILE', 'STATE'))
+    states = Utility_Bill_Journal(journal_path).get_states()
+    for path, record in states.items():
+        print("{:<40} {:<10}".format(os.path.basename(path), record["state"]))
+    assert [result.filename for result in retried] == ["broken.pdf"]
+    # The records written after the truncated line survive a reload, the first one included
+    assert len(states) == 3
+    assert states[str(inbox / "broken.pdf")]["state"] == STATE_FAILED
+    with open(journal_path, encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    assert lines[-2]["path"] == str(inbox / "broken.pdf") and lines[-2]["state"] == STATE_QUEUED
+
+
+def test_results_same_name(tmp_path):
+    # Same-named bills from different directories get results of their own
+    for directory, bill in [("a", "GasInvoice_2025-12-04.pdf"), ("b", "ElectricityInvoice_2025-11-04.pdf")]:
+        (tmp_path / directory).mkdir()
+        shutil.copy("tests/invoices/" + bill, tmp_path / directory / "bill.pdf")
+    processor = Utility_Bill_Processor(env="eu", output_dir="output/", use_cache=True,
+                                       ade_client=Failing_ADE_Client())
+    with Utility_Bill_Batch(processor, str(tmp_path / "journal.ndjson"), results_dir=str(tmp_path / "results")) \
+            as runner:
+        assert all(result.ok() for result in runner.run([str(tmp_path / "a" / "bill.pdf"),
+                                                          str(tmp_path / "b" / "bill.pdf")]))
+        states = runner.get_journal().get_states()
+    processor.close()
+    assert len(os.listdir(tmp_path / "results")) == 2
+    for directory, document_number in [("a", "ΛΦΑ 192434411"), ("b", "ΛΗΕ196789485")]:
+        with open(tmp_path / "results" / states[str(tmp_path / directory / "bill.pdf")]["result"],
+                  encoding="utf-8") as f:
+            assert json.load(f)["document_number"] == document_number
+
+
+if __name__ == '__main__':
+    import tempfile
+    from pathlib import Path
+    test_resume(Path(tempfile.mkdtemp()))
+    test_results_same_name(Path(tempfile.mkdtemp()))
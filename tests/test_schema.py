@@ -0,0 +1,24 @@
+import json
+from src.iraklis7_ubp import utility_model
+from src.iraklis7_ubp.utility_schema import get_bill_type, get_schema, get_model_schema, get_model_schema_dict
+
+
+def test_bill_type():
+    assert get_bill_type("... ΠΡΟΜΗΘΕΙΑ ΦΥΣΙΚΟΥ ΑΕΡΙΟΥ ...") is utility_model.Utility_Bill_Gas
+    assert get_bill_type("... ΛΟΓΑΡΙΑΣΜΟΣ ΗΛΕΚΤΡΙΚΟΥ ΡΕΥΜΑΤΟΣ ...") is utility_model.Utility_Bill_Power
+    assert get_bill_type("Εταιρεία Ύδρευσης") is utility_model.Utility_Bill_Water
+    assert get_bill_type("unknown") is utility_model.Utility_Bill
+    # Gas takes precedence, wherever its marker appears
+    assert get_bill_type("ΛΟΓΑΡΙΑΣΜΟΣ ΗΛΕΚΤΡΙΚΟΥ ΡΕΥΜΑΤΟΣ ΠΡΟΜΗΘΕΙΑ ΦΥΣΙΚΟΥ ΑΕΡΙΟΥ") is utility_model.Utility_Bill_Gas
+
+
+def test_schema_memoized():
+    schema = get_schema("Ύδρευσης")
+    assert schema is get_schema("Ύδρευσης")
+    assert schema is get_model_schema(utility_model.Utility_Bill_Water)
+    assert json.loads(schema) == get_model_schema_dict(utility_model.Utility_Bill_Water)
+
+
+if __name__ == '__main__':
+    test_bill_type()
+    test_schema_memoized()
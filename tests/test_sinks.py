@@ -0,0 +1,87 @@
+import csv
+import json
+import sqlite3
+from src.iraklis7_ubp.utility_proc import Utility_Bill_Processor
+from src.iraklis7_ubp.utility_sinks import Utility_Bill_Sink, NDJSON_Sink, CSV_Sink, SQLite_Sink, open_sink
+
+
+def test_sinks(tmp_path):
+    sinks = [NDJSON_Sink(str(tmp_path / "bills.ndjson"), batch_size=1),
+             CSV_Sink(str(tmp_path / "csv")),
+             open_sink(str(tmp_path / "bills.db"))]
+    for sink in sinks:
+        processor = Utility_Bill_Processor(env="eu", output_dir="output/", use_cache=True, sink=sink)
+        results = list(processor.process_many("tests/invoices/*.pdf", max_workers=2))
+        processor.close()
+        sink.close()
+        assert all(result.ok() for result in results)
+        assert sink.get_count() == 2
+
+    records = [json.loads(line) for line in open(tmp_path / "bills.ndjson", encoding="utf-8")]
+    print("{:<40} {:<20} {:<10}".format('FILE', 'BILL TYPE', 'TOTAL'))
+    for record in records:
+        print("{:<40} {:<20} {:<10}".format(record["file"], record["bill_class"], record["bill_total_amount"]))
+    assert sorted(record["bill_class"] for record in records) == ["Utility_Bill_Gas", "Utility_Bill_Power"]
+    for record in records:
+        assert isinstance(record["bill_total_amount"], float)
+
+    with open(tmp_path / "csv" / "Utility_Bill_Gas.csv", encoding="utf-8", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 1
+    assert "usage_cubic_meters" in rows[0]
+
+    conn = sqlite3.connect(str(tmp_path / "bills.db"))
+    assert conn.execute("SELECT COUNT(*) FROM Utility_Bill_Power").fetchone()[0] == 1
+    conn.close()
+
+
+def test_sqlite_sink_replace(tmp_path):
+    # Re-processing a bill replaces its row, also across sinks on the same database
+    for run in range(2):
+        with SQLite_Sink(str(tmp_path / "bills.db"), batch_size=1) as sink:
+            processor = Utility_Bill_Processor(env="eu", output_dir="output/", use_cache=True, sink=sink)
+            results = list(processor.process_many("tests/invoices/*.pdf", max_workers=2))
+            processor.close()
+        assert all(result.ok() for result in results)
+        assert sink.get_count() == 2
+
+    conn = sqlite3.connect(str(tmp_path / "bills.db"))
+    for table in ("Utility_Bill_Gas", "Utility_Bill_Power"):
+        assert conn.execute("SELECT COUNT(*) FROM " + table).fetchone()[0] == 1
+    assert conn.execute("SELECT bill_class FROM Utility_Bill_Gas").fetchone()[0] == "Utility_Bill_Gas"
+    conn.close()
+
+
+class Flaky_Sink(Utility_Bill_Sink):
+    # Fails its first write
+    def __init__(self):
+        super().__init__(batch_size=1)
+        self.records = []
+        self.failed = False
+
+    def _write_batch(self, batch):
+        if not self.failed:
+            self.failed = True
+            raise OSError("disk full")
+        self.records.extend(record for _, record in batch)
+
+
+def test_sink_error():
+    # A sink error is reported apart from the bill's result, and the records are written by the next flush
+    sink = Flaky_Sink()
+    processor = Utility_Bill_Processor(env="eu", output_dir="output/", use_cache=True, sink=sink)
+    results = list(processor.process_many("tests/invoices/*.pdf", max_workers=1))
+    processor.close()
+    assert all(result.ok() for result in results)
+    assert [result.sink_error is not None for result in results] == [True, False]
+    sink.close()
+    assert sink.get_count() == 2
+    assert sorted(record["bill_class"] for record in sink.records) == ["Utility_Bill_Gas", "Utility_Bill_Power"]
+
+
+if __name__ == '__main__':
+    import tempfile
+    from pathlib import Path
+    test_sinks(Path(tempfile.mkdtemp()))
+    test_sqlite_sink_replace(Path(tempfile.mkdtemp()))
+    test_sink_error()
@@ -0,0 +1,38 @@
+import sys
+import json
+import subprocess
+from src.iraklis7_ubp.utility_proc import Utility_Bill_Processor, Offline_Error
+
+
+def test_startup_imports(tmp_path):
+    # Importing and constructing a processor leaves the ADE SDK, httpx and pydantic unimported
+    code = ("import sys, json\n"
+            "from src.iraklis7_ubp.utility_proc import Utility_Bill_Processor\n"
+            "Utility_Bill_Processor(output_dir=sys.argv[1])\n"
+            "print(json.dumps([m for m in ('landingai_ade', 'httpx', 'pydantic') if m in sys.modules]))\n")
+    output = subprocess.check_output([sys.executable, "-c", code, str(tmp_path / "cache")], text=True,
+                                     stderr=subprocess.DEVNULL)
+    print("{:<30}".format('HEAVY MODULES'))
+    print("{:<30}".format(output.strip()))
+    assert json.loads(output.strip().splitlines()[-1]) == []
+    # The cache directory is only created on first use
+    assert not (tmp_path / "cache").exists()
+
+
+def test_offline(tmp_path):
+    processor = Utility_Bill_Processor(output_dir=str(tmp_path), offline=True)
+    try:
+        processor.parse("tests/invoices/GasInvoice_2025-12-04.pdf")
+        assert False, "Expected an Offline_Error on a cache miss"
+    except Offline_Error:
+        pass
+    result = processor.process("tests/invoices/GasInvoice_2025-12-04.pdf")
+    assert isinstance(result.error, Offline_Error)
+    processor.close()
+
+
+if __name__ == '__main__':
+    import tempfile
+    from pathlib import Path
+    test_startup_imports(Path(tempfile.mkdtemp()))
+    test_offline(Path(tempfile.mkdtemp()))
@@ -0,0 +1,245 @@
+import json
+import time
+import shutil
+import fnmatch
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from landingai_ade.types.parse_response import ParseResponse
+from src.iraklis7_ubp.utility_cache import Utility_Bill_Cache, Cache_Policy
+from src.iraklis7_ubp.utility_metrics import Utility_Bill_Metrics
+from src.iraklis7_ubp.utility_proc import Utility_Bill_Processor
+from src.iraklis7_ubp.utility_store import Redis_Store, pack_record, unpack_record, open_store
+
+BILL = "tests/invoices/GasInvoice_2025-12-04.pdf"
+
+
+class Fake_Redis(object):
+    # Local stand-in for a Redis server shared by several hosts: the subset of the redis.Redis API used
+    # by Redis_Store, counting round trips, with an optional delay per round trip
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.data = {}
+        self.expiry = {}
+        self.round_trips = {"mget": 0, "pipeline": 0}
+        self.lock = threading.Lock()
+
+    def __round_trip(self, name):
+        with self.lock:
+            self.round_trips[name] = self.round_trips.get(name, 0) + 1
+        time.sleep(self.latency)
+
+    def __live(self, key):
+        expires = self.expiry.get(key)
+        if expires is not None and expires < time.time():
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+        return key in self.data
+
+    def mget(self, keys):
+        self.__round_trip("mget")
+        with self.lock:
+            return [self.data[key] if self.__live(key) else None for key in keys]
+
+    def pipeline(self, transaction=True):
+        return Fake_Pipeline(self)
+
+    def execute(self, commands):
+        self.__round_trip("pipeline")
+        with self.lock:
+            for key, value, px in commands:
+                self.data[key] = value
+                self.expiry.pop(key, None)
+                if px is not None:
+                    self.expiry[key] = time.time() + px / 1000
+        return [True] * len(commands)
+
+    def scan_iter(self, match="*", count=None):
+        with self.lock:
+            return [key for key in list(self.data) if self.__live(key) and fnmatch.fnmatchcase(key, match)]
+
+    def delete(self, *keys):
+        with self.lock:
+            return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+
+class Fake_Pipeline(object):
+    def __init__(self, server):
+        self.server = server
+        self.commands = []
+
+    def set(self, key, value, px=None):
+        self.commands.append((key, value, px))
+
+    def execute(self):
+        return self.server.execute(self.commands)
+
+
+def load_parse_response():
+    with open("output/GasInvoice_2025-12-04.pdf.parse.json", encoding="utf-8") as f:
+        return ParseResponse(**json.load(f))
+
+
+def test_record_packing():
+    record = ("zlib", b"main\0value", b"payload", 1700000000.25)
+    assert unpack_record(pack_record(record)) == record
+    try:
+        open_store("memcached://localhost")
+        assert False, "unsupported scheme accepted"
+    except ValueError as e:
+        print(e)
+
+
+def test_shared_cache(tmp_path):
+    # Two hosts, each with its own output directory, sharing one store
+    server = Fake_Redis()
+    metrics = Utility_Bill_Metrics()
+    host_a = Utility_Bill_Cache(str(tmp_path / "a"), store=Redis_Store(server))
+    host_b = Utility_Bill_Cache(str(tmp_path / "b"), store=Redis_Store(server), metrics=metrics)
+    bill = tmp_path / "bill.pdf"
+    shutil.copy(BILL, bill)
+
+    digest = host_a.get_file_digest(bill)
+    host_a.put_parse(digest, load_parse_response())
+    host_a.close()
+
+    # Host B finds host A's response, and keeps a copy: the second lookup doesn't go to the store
+    response = host_b.get_parse(host_b.get_file_digest(bill))
+    assert response is not None and "ΛΦΑ 192434411" in response.markdown
+    assert response.metadata.page_count == load_parse_response().metadata.page_count
+    lookups = server.round_trips["mget"]
+    assert host_b.get_parse(digest) is not None
+    assert server.round_trips["mget"] == lookups
+    assert metrics.get_counter("shared_cache", stage="parse", result="hit") == 1
+    assert host_b.get_parse("blake2b:00") is None
+    assert metrics.get_counter("shared_cache", stage="parse", result="miss") == 1
+
+    # Invalidation reaches the store, or the entry would come back from it
+    assert host_b.invalidate(stage="parse") == 2
+    assert server.data == {}
+    host_b.close()
+
+    # A store which can't be reached is a miss, not an error
+    broken = Fake_Redis()
+    broken.mget = None
+    host_c = Utility_Bill_Cache(str(tmp_path / "c"), store=Redis_Store(broken), metrics=metrics)
+    assert host_c.get_parse(digest) is None
+    assert metrics.get_counter("shared_cache", stage="parse", result="error") == 1
+    host_c.close()
+
+
+def test_store_ttl(tmp_path):
+    server = Fake_Redis()
+    cache = Utility_Bill_Cache(str(tmp_path), store=Redis_Store(server), policy=Cache_Policy(ttl={"parse": 60}))
+    cache.put_parse("blake2b:00", load_parse_response())
+    cache.close()
+    (key,) = server.data
+    assert 59 < server.expiry[key] - time.time() <= 60
+
+
+def test_store_batching():
+    # Concurrent lookups share multi-gets, and writes are pipelined
+    server = Fake_Redis(latency=0.01)
+    store = Redis_Store(server, max_reads_in_flight=2, write_batch_size=32, flush_interval=10)
+    record = ("json", b"{}", b"{}", time.time())
+    keys = [("parse", "blake2b:%02d" % number, "", "dpt-2-latest") for number in range(200)]
+    for key in keys:
+        store.put(key, record)
+    store.flush()
+    print("Pipelines: " + str(server.round_trips["pipeline"]))
+    assert server.round_trips["pipeline"] == 7
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        results = list(executor.map(store.get, keys + [("parse", "blake2b:missing", "", "dpt-2-latest")]))
+    print("Lookups: " + str(len(results)) + ", round trips: " + str(server.round_trips["mget"]))
+    assert results[:-1] == [record] * len(keys)
+    assert results[-1] is None
+    assert server.round_trips["mget"] < len(keys) / 4
+    assert store.get_many(keys[:3]) == {key: record for key in keys[:3]}
+
+    # Writes are sent after flush_interval even when the batch isn't full
+    store = Redis_Store(server, flush_interval=0.01)
+    store.put(("extract", "00", "11", "extract-latest"), record)
+    time.sleep(0.2)
+    assert "ubp:extract:extract-latest:00:11" in server.data
+    assert store.delete(stage="extract") == 1
+    assert store.delete(before=0) == 0
+
+    # Model names are matched literally, also when they look like patterns or contain the separator
+    for model in ("dpt-2", "dpt-*", "dpt-2:eu", "dpt-[2]"):
+        store.put(("parse", "blake2b:00", "", model), record)
+    assert store.delete(model="dpt-*") == 1
+    assert store.delete(model="dpt-2") == 1
+    assert store.delete(model="dpt-[2]") == 1
+    assert store.get(("parse", "blake2b:00", "", "dpt-2:eu")) == record
+    store.close()
+
+
+class Interrupted_Store(Redis_Store):
+    # Store whose first lookup waits for release, and whose next one is interrupted
+    def __init__(self, server):
+        super().__init__(server, max_reads_in_flight=1)
+        self.release = threading.Event()
+        self.calls = 0
+
+    def _get_many(self, keys):
+        self.calls += 1
+        if self.calls == 1:
+            self.release.wait()
+        elif self.calls == 2:
+            raise KeyboardInterrupt()
+        return super()._get_many(keys)
+
+
+def test_store_interrupted_read():
+    # Lookups queued on an interrupted round trip fail instead of blocking, and the store stays usable
+    store = Interrupted_Store(Fake_Redis())
+    key = ("parse", "blake2b:00", "", "dpt-2-latest")
+    errors = []
+
+    def read():
+        try:
+            store.get(key)
+        except BaseException as e:
+            errors.append(e)
+
+    first = threading.Thread(target=read, daemon=True)
+    first.start()
+    while store.calls == 0:
+        time.sleep(0.01)
+    queued = threading.Thread(target=read, daemon=True)
+    queued.start()
+    time.sleep(0.1)
+    store.release.set()
+    first.join(timeout=5)
+    queued.join(timeout=5)
+    assert not first.is_alive() and not queued.is_alive()
+    assert len(errors) == 2 and all(isinstance(e, KeyboardInterrupt) for e in errors)
+    assert store.get(key) is None
+    store.close()
+
+
+def test_shared_processor(tmp_path):
+    # An offline processor on another host serves a bill parsed elsewhere
+    server = Fake_Redis()
+    bill = tmp_path / "bill.pdf"
+    shutil.copy(BILL, bill)
+    cache = Utility_Bill_Cache(str(tmp_path / "a"), store=Redis_Store(server))
+    cache.put_parse(cache.get_file_digest(bill), load_parse_response())
+    cache.close()
+
+    store = Redis_Store(server)
+    processor = Utility_Bill_Processor(output_dir=str(tmp_path / "b"), offline=True, cache_store=store)
+    assert "ΛΦΑ 192434411" in processor.parse(str(bill)).markdown
+    processor.close()
+    store.close()
+
+
+if __name__ == '__main__':
+    import tempfile
+    from pathlib import Path
+    test_record_packing()
+    test_shared_cache(Path(tempfile.mkdtemp()))
+    test_store_ttl(Path(tempfile.mkdtemp()))
+    test_store_batching()
+    test_store_interrupted_read()
+    test_shared_processor(Path(tempfile.mkdtemp()))
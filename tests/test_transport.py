@@ -0,0 +1,171 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from landingai_ade import LandingAIADE
+from src.iraklis7_ubp.utility_proc import Utility_Bill_Processor
+from src.iraklis7_ubp.utility_metrics import Utility_Bill_Metrics
+from src.iraklis7_ubp.utility_transport import (Retry_Policy, Token_Bucket, Circuit_Breaker, Circuit_Open_Error,
+                                                ADE_Transport, Async_ADE_Transport, get_shared_http_client)
+
+BILL = "tests/invoices/GasInvoice_2025-12-04.pdf"
+
+
+class Fake_ADE_Server(ThreadingHTTPServer):
+    # Local stand-in for the ADE API, replaying recorded responses after failing the first `failures` calls
+    daemon_threads = True
+
+    def __init__(self, failures=0, status=429):
+        super().__init__(("127.0.0.1", 0), Fake_ADE_Handler)
+        self.failures = failures
+        self.status = status
+        self.calls = 0
+        self.connections = set()
+        self.lock = threading.Lock()
+        with open("output/GasInvoice_2025-12-04.pdf.parse.json", encoding="utf-8") as f:
+            self.parse_body = f.read().encode("utf-8")
+        with open("output/GasInvoice_2025-12-04.pdf.extract.json", encoding="utf-8") as f:
+            self.extract_body = f.read().encode("utf-8")
+
+    def get_base_url(self):
+        return "http://127.0.0.1:" + str(self.server_address[1])
+
+
+class Fake_ADE_Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("content-length", 0)))
+        server = self.server
+        with server.lock:
+            server.calls += 1
+            server.connections.add(self.client_address)
+            fail = server.calls <= server.failures
+        if fail:
+            body = json.dumps(dict(message="try again")).encode("utf-8")
+            self.send_response(server.status)
+            self.send_header("retry-after", "0")
+        else:
+            body = server.parse_body if self.path.endswith("/parse") else server.extract_body
+            self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_server(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def get_client(server):
+    return LandingAIADE(apikey="dummy", base_url=server.get_base_url(), http_client=get_shared_http_client(),
+                        max_retries=0)
+
+
+def test_transport_retry(tmp_path):
+    server = Fake_ADE_Server(failures=2, status=429)
+    run_server(server)
+    metrics = Utility_Bill_Metrics()
+    processor = Utility_Bill_Processor(output_dir=str(tmp_path), ade_client=get_client(server), metrics=metrics,
+                                       retry_policy=Retry_Policy(max_attempts=3, base_delay=0.01),
+                                       rate_limiter=Token_Bucket(rate=100))
+    result = processor.process(BILL)
+    processor.close()
+    server.shutdown()
+
+    print("{:<10} {:<10} {:<10}".format('CALLS', 'RETRIES', 'CONNECTIONS'))
+    print("{:<10} {:<10} {:<10}".format(server.calls, metrics.get_counter("api_retries", endpoint="parse",
+                                                                           error="RateLimitError"),
+                                        len(server.connections)))
+    # Two rate limited parse calls are retried, then parse and extract succeed over one pooled connection
+    assert result.ok()
+    assert result.extract_response.extraction["document_number"] == "ΛΦΑ 192434411"
+    assert server.calls == 4
+    assert len(server.connections) == 1
+
+
+def test_transport_circuit_breaker(tmp_path):
+    server = Fake_ADE_Server(failures=1000, status=503)
+    run_server(server)
+    breaker = Circuit_Breaker(failure_threshold=2, reset_timeout=60)
+    processor = Utility_Bill_Processor(output_dir=str(tmp_path), ade_client=get_client(server),
+                                       retry_policy=Retry_Policy(max_attempts=3, base_delay=0.01),
+                                       circuit_breaker=breaker)
+    first = processor.process(BILL)
+    second = processor.process(BILL)
+    processor.close()
+    server.shutdown()
+
+    # The breaker opens after two failures, so the third attempt and the second bill never reach the server
+    assert not first.ok() and isinstance(first.error, Circuit_Open_Error)
+    assert not second.ok() and isinstance(second.error, Circuit_Open_Error)
+    assert server.calls == 2
+    assert breaker.get_state() == "open"
+
+
+class Interrupted_Client(object):
+    # parse() is interrupted (sync) or hangs until cancelled (async), extract() succeeds
+    def parse(self, **kwargs):
+        raise KeyboardInterrupt
+
+    def extract(self, **kwargs):
+        return "ok"
+
+
+class Async_Interrupted_Client(object):
+    async def parse(self, **kwargs):
+        import asyncio
+        await asyncio.sleep(60)
+
+    async def extract(self, **kwargs):
+        return "ok"
+
+
+def open_breaker(now):
+    breaker = Circuit_Breaker(failure_threshold=1, reset_timeout=10, clock=lambda: now[0])
+    breaker.record_failure()
+    now[0] += 10
+    assert breaker.get_state() == "half_open"
+    return breaker
+
+
+def test_transport_interrupted_trial():
+    # A half-open trial call interrupted without an outcome doesn't keep the breaker open for good
+    import asyncio
+    now = [0.0]
+    breaker = open_breaker(now)
+    transport = ADE_Transport(Interrupted_Client(), circuit_breaker=breaker)
+    try:
+        transport.parse()
+        assert False, "KeyboardInterrupt swallowed"
+    except KeyboardInterrupt:
+        pass
+    assert transport.extract() == "ok"
+    assert breaker.get_state() == "closed"
+
+    breaker = open_breaker(now)
+    transport = Async_ADE_Transport(Async_Interrupted_Client(), circuit_breaker=breaker)
+
+    async def cancel_trial():
+        try:
+            await asyncio.wait_for(transport.parse(), timeout=0.05)
+            assert False, "trial call not cancelled"
+        except asyncio.TimeoutError:
+            pass
+        return await transport.extract()
+
+    assert asyncio.run(cancel_trial()) == "ok"
+    assert breaker.get_state() == "closed"
+
+
+if __name__ == '__main__':
+    import tempfile
+    from pathlib import Path
+    test_transport_retry(Path(tempfile.mkdtemp()))
+    test_transport_circuit_breaker(Path(tempfile.mkdtemp()))
+    test_transport_interrupted_trial()
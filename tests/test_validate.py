@@ -0,0 +1,55 @@
+import ast
+import time
+import random
+from src.iraklis7_ubp import utility_model
+from src.iraklis7_ubp.utility_validate import Utility_Bill_Frame
+
+
+def load_expected(filename):
+    with open("tests/expected/" + filename + ".exp", "r") as f:
+        return ast.literal_eval(f.read())
+
+
+def test_validate_expected():
+    # The recorded bills satisfy their bill type's invariants
+    for filename, bill_type in [("GasInvoice_2025-12-04.pdf", utility_model.Utility_Bill_Gas),
+                                ("ElectricityInvoice_2025-11-04.pdf", utility_model.Utility_Bill_Power),
+                                ("AKN32864488.pdf", utility_model.Utility_Bill_Water)]:
+        frame = Utility_Bill_Frame(bill_type, [load_expected(filename)], [filename])
+        assert frame.validate() == []
+        assert frame.to_dict()["bill_period_start"] != [None]
+
+
+def test_validate_batch():
+    gas = load_expected("GasInvoice_2025-12-04.pdf")
+    rng = random.Random(0)
+    extractions = []
+    for i in range(5000):
+        extraction = dict(gas)
+        delta = round(rng.uniform(-2, 2), 2)
+        extraction["transport_of_natural_gas"] = round(gas["transport_of_natural_gas"] + delta, 2)
+        extraction["bill_total_amount"] = round(gas["bill_total_amount"] + delta, 2)
+        extractions.append(extraction)
+    extractions[10]["bill_period_start"], extractions[10]["bill_period_end"] = "2025-11-30", "2025-10-07"
+    extractions[20]["bill_total_amount"] += 5
+    extractions[30]["transport_of_natural_gas"] += 500
+    extractions[30]["bill_total_amount"] += 500
+    extractions[40]["bill_vat_amount"] = "n/a"
+
+    start = time.perf_counter()
+    frame = Utility_Bill_Frame(utility_model.Utility_Bill_Gas, extractions)
+    issues = frame.validate()
+    elapsed = time.perf_counter() - start
+
+    print("{:<10} {:<25} {:<40}".format('ROW', 'CHECK', 'FIELDS'))
+    for issue in issues:
+        print("{:<10} {:<25} {:<40}".format(issue["row"], issue["check"], ", ".join(issue["fields"])))
+    print("Validated " + str(len(frame)) + " bills in " + format(elapsed * 1000, ".1f") + " ms")
+    found = {(issue["row"], issue["check"]) for issue in issues}
+    assert found == {(10, "period_order"), (20, "total_amount"), (30, "outlier"), (40, "type"),
+                     (40, "total_amount")}
+
+
+if __name__ == '__main__':
+    test_validate_expected()
+    test_validate_batch()
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import threading
+from src.iraklis7_ubp.utility_proc import Utility_Bill_Result
+from src.iraklis7_ubp.utility_watch import Utility_Bill_Watcher, Inotify_Source, is_complete_pdf
+
+PDF_HEAD = b"%PDF-1.4\n1 0 obj << >> endobj\n"
+PDF_TAIL = b"trailer << >>\n%%EOF\n"
+
+
+class Recording_Processor(object):
+    # Stand-in for Utility_Bill_Processor, recording the files it is given
+    def __init__(self):
+        self.processed = []
+        self.lock = threading.Lock()
+
+    def process(self, input_path):
+        with self.lock:
+            self.processed.append(os.path.basename(input_path))
+        return Utility_Bill_Result(input_path)
+
+
+def start_watcher(processor, inbox, journal_path, use_inotify):
+    results = []
+    watcher = Utility_Bill_Watcher(processor, str(inbox), journal_path=str(journal_path), max_workers=2,
+                                   queue_size=2, settle=0.2, poll_interval=0.05, use_inotify=use_inotify,
+                                   on_result=results.append)
+    thread = threading.Thread(target=watcher.run)
+    thread.start()
+    return watcher, thread, results
+
+
+def stop_watcher(watcher, thread):
+    watcher.stop()
+    thread.join()
+    watcher.close()
+
+
+def check_watcher(tmp_path, use_inotify):
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    journal_path = tmp_path / "watch.journal"
+    (inbox / "old.pdf").write_bytes(PDF_HEAD + PDF_TAIL)
+    processor = Recording_Processor()
+    watcher, thread, results = start_watcher(processor, inbox, journal_path, use_inotify)
+
+    # A bill being written isn't processed before it is complete
+    with open(inbox / "new.pdf", "wb") as f:
+        f.write(PDF_HEAD)
+        f.flush()
+        time.sleep(0.5)
+        assert "new.pdf" not in processor.processed
+        f.write(PDF_TAIL)
+    (inbox / "notes.txt").write_text("not a bill")
+    assert watcher.wait_idle(timeout=10)
+    assert sorted(processor.processed) == ["new.pdf", "old.pdf"]
+    assert len(results) == 2 and all(result.ok() for result in results)
+
+    # Unchanged files aren't processed again, changed ones are
+    os.utime(inbox / "old.pdf", ns=(os.stat(inbox / "old.pdf").st_atime_ns, os.stat(inbox / "old.pdf").st_mtime_ns))
+    (inbox / "new.pdf").write_bytes(PDF_HEAD + b"% changed\n" + PDF_TAIL)
+    time.sleep(0.5)
+    assert watcher.wait_idle(timeout=10)
+    assert sorted(processor.processed) == ["new.pdf", "new.pdf", "old.pdf"]
+    stop_watcher(watcher, thread)
+
+    # A restarted watcher only processes what arrived in the meantime
+    (inbox / "later.pdf").write_bytes(PDF_HEAD + PDF_TAIL)
+    processor = Recording_Processor()
+    watcher, thread, results = start_watcher(processor, inbox, journal_path, use_inotify)
+    time.sleep(0.3)
+    assert watcher.wait_idle(timeout=10)
+    stop_watcher(watcher, thread)
+    print("Processed after restart: " + str(processor.processed))
+    assert processor.processed == ["later.pdf"]
+
+
+def test_watch_polling(tmp_path):
+    check_watcher(tmp_path, use_inotify=False)
+
+
+def test_watch_inotify(tmp_path):
+    try:
+        Inotify_Source(str(tmp_path)).close()
+    except OSError as e:
+        print("inotify is unavailable, skipping: " + str(e))
+        return
+    check_watcher(tmp_path, use_inotify=True)
+
+
+class Slow_Processor(Recording_Processor):
+    def process(self, input_path):
+        time.sleep(0.2)
+        return super().process(input_path)
+
+
+def test_watch_stop(tmp_path):
+    # Stopping with a backlog leaves the watcher idle, and the next run processes what was left
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    names = ["bill" + str(number) + ".pdf" for number in range(6)]
+    for name in names:
+        (inbox / name).write_bytes(PDF_HEAD + PDF_TAIL)
+    processor = Slow_Processor()
+    watcher = Utility_Bill_Watcher(processor, str(inbox), journal_path=str(tmp_path / "watch.journal"),
+                                   max_workers=1, queue_size=1, settle=0, poll_interval=0.05, use_inotify=False)
+    thread = threading.Thread(target=watcher.run)
+    thread.start()
+    time.sleep(0.3)
+    stop_watcher(watcher, thread)
+    assert watcher.wait_idle(timeout=5)
+    first = list(processor.processed)
+    assert 0 < len(first) < len(names)
+
+    processor = Recording_Processor()
+    watcher, thread, results = start_watcher(processor, inbox, tmp_path / "watch.journal", False)
+    time.sleep(0.3)
+    assert watcher.wait_idle(timeout=10)
+    stop_watcher(watcher, thread)
+    assert sorted(first + processor.processed) == sorted(names)
+
+
+def test_watch_journal_compaction(tmp_path):
+    # The journal holds one line per file still in the inbox after start-up, and is compacted as it grows
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    journal_path = tmp_path / "watch.journal"
+    for number in range(4):
+        (inbox / ("bill" + str(number) + ".pdf")).write_bytes(PDF_HEAD + PDF_TAIL)
+    processor = Recording_Processor()
+    watcher = Utility_Bill_Watcher(processor, str(inbox), journal_path=str(journal_path), settle=0,
+                                   poll_interval=0.05, use_inotify=False, compact_interval=2)
+    thread = threading.Thread(target=watcher.run)
+    thread.start()
+    time.sleep(0.3)
+    assert watcher.wait_idle(timeout=10)
+    stop_watcher(watcher, thread)
+    with open(journal_path, encoding="utf-8") as f:
+        lines = f.readlines()
+    # Every file is queued and then extracted: without compaction, that's 8 lines
+    assert len(lines) < 8
+
+    (inbox / "bill0.pdf").unlink()
+    processor = Recording_Processor()
+    watcher, thread, results = start_watcher(processor, inbox, journal_path, False)
+    time.sleep(0.3)
+    assert watcher.wait_idle(timeout=10)
+    stop_watcher(watcher, thread)
+    assert processor.processed == []
+    with open(journal_path, encoding="utf-8") as f:
+        states = [json.loads(line) for line in f]
+    assert sorted(os.path.basename(record["path"]) for record in states) == ["bill1.pdf", "bill2.pdf", "bill3.pdf"]
+
+
+def test_is_complete_pdf(tmp_path):
+    bill = tmp_path / "bill.pdf"
+    bill.write_bytes(PDF_HEAD)
+    assert not is_complete_pdf(bill)
+    bill.write_bytes(PDF_HEAD + PDF_TAIL)
+    assert is_complete_pdf(bill)
+    assert is_complete_pdf("tests/invoices/GasInvoice_2025-12-04.pdf")
+    assert not is_complete_pdf(tmp_path / "missing.pdf")
+
+
+if __name__ == '__main__':
+    import tempfile
+    from pathlib import Path
+    test_is_complete_pdf(Path(tempfile.mkdtemp()))
+    test_watch_polling(Path(tempfile.mkdtemp()))
+    test_watch_inotify(Path(tempfile.mkdtemp()))
+    test_watch_stop(Path(tempfile.mkdtemp()))
+    test_watch_journal_compaction(Path(tempfile.mkdtemp()))